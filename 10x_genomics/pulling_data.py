@@ -1,49 +1,50 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import os
+import sys
+from trimmed_means import read_cluster_names, open_trimmed_means_store
+# Figures are rendered by the batch renderer of visualisers
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', 'visualisers'))
+from BatchRenderer import BatchRenderer
 
 receptors = {"Drd":["Drd1","Drd2","Drd3","Drd4","Drd5"],"Htr":["Htr1a","Htr1b","Htr1d","Htr1e","Htr1f","Htr2a","Htr2b","Htr2c","Htr4","Htr5a","Htr5bp","Htr6","Htr7","Htr3a","Htr3b","Htr3c","Htr3d","Htr3e"],"Chrn":["Chrna1","Chrna2","Chrna3","Chrna4","Chrna5","Chrna6","Chrna7","Chrna8","Chrna9","Chrna10","Chrnb1","Chrnb2","Chrnb3","Chrnb4","Chrnd","Chrne","Chrng","Chrm1","Chrm2","Chrm3","Chrm4","Ch4m5"],"Cnr":["Cnr1","Cnr2"],"Opr":["Oprd1","Oprk1","Oprl1","Oprm1"],"Hrh":["Hrh1","Hrh2","Hrh3","Hrh4"],"P2r":["P2ry1","P2ry2","P2ry4","P2ry6","P2ry11","P2ry12","P2ry13","P2ry14","P2rx1","P2rx2","P2rx3","P2rx4","P2rx5","P2rx6","P2rx7"],"Grm":["Grm1","Grm2","Grm3","Grm4","Grm5","Grm6","Grm7","Grm8"],"Gabbr":["Gabbr1","Gabbr2"],"Endocannabinoid":["Faah","Mgll","Nat2","Napepld","Amt"],"Adr":["Adra1a","Adra2a","Adrb1","Adrb3","Adra1b","Adrad","Adra2b","Adra2c","Adrab2"]}
-df = pd.read_csv('/home/ikharitonov/Desktop/Allen_10X_Data/trimmed_means.csv')
 
-# get the names of clusters
-sheet_names = ['L2.3_IT','L4_IT','L5_IT','L6_IT','L5_PT']
-clusters = {}
-for name in sheet_names:
-    sheet_df = pd.read_excel('/home/ikharitonov/Desktop/Allen_10X_Data/Allen10x_5HT.xlsx',sheet_name=name)
-    # Removing columns which had identical names in excel (here they are added .1 in the end)
-    sheet_df = sheet_df.loc[:,sheet_df.columns.str.find('.') < 0]
-    column_list = list(sheet_df.columns)
-    column_list.remove('AVG')
-    column_list.remove('SD')
-    column_list.remove('Prevalence')
-    clusters[name] = column_list
+def family_cluster_statistics(df, receptors, clusters):
+    """
+    Computes MEAN, STD and Prevalence(%) of trimmed means of every receptor of every family over clusters of every cell type at once.
+    Rows of receptors are ordered once (by family and by position in the family's receptor list), statistics of all cell types are grouped column
+    reductions of the receptors x clusters array (products with a cell types x clusters membership matrix).
 
-# pull each of the clusters for each family of receptors
-# {receptor_family_1: {L5_PT: dataframe_1, L5_IT: dataframe_2, ...}, receptor_family_2: {...}}
-data = {}
-for family, receptor_list in receptors.items():
-    cluster_data = {}
-    # selecting data for clusters defined above and a family of receptors from dataframe
-    for cluster_name, cluster in clusters.items():
-        temp_df = df[df['feature'].isin(receptor_list)][df.columns.intersection(cluster)]
-        # Sorting the dataframe by feature - receptor list values
-        temp_df.sort_values(by="feature", key=lambda column: column.map(lambda e: receptor_list.index(e)), inplace=True)
-        # compute mean, sd and prevalence for single receptors
-        temp_df['MEAN'] = temp_df[cluster[1:]].mean(axis=1)
-        temp_df['STD'] = temp_df[cluster[1:]].std(axis=1)
-        temp_df['Prevalence(%)'] = temp_df[cluster[1:]].gt(0,axis = 0).sum(axis = 1) / len(cluster[1:]) * 100
-        cluster_data[cluster_name] = temp_df
-    data[family] = cluster_data
+        Returns:
+            statistics (pandas.DataFrame): tidy table with one row per family, cell type and receptor ('row' is the row of the receptor in trimmed_means.csv).
+    """
+    # Rows of receptors ordered by family and receptor list (a receptor of several families has a row in each of them)
+    membership = pd.DataFrame([(f, family, rank, receptor) for f, (family, receptor_list) in enumerate(receptors.items()) for rank, receptor in enumerate(receptor_list)], columns=['family_order', 'family', 'rank', 'feature'])
+    rows = membership.merge(df[['feature']].rename_axis('row').reset_index(), on='feature').sort_values(['family_order', 'rank'], kind='stable')
 
-print(data['Htr']['L5_IT'])
+    # Trimmed means of the receptors (rows) in all clusters (columns), and membership of clusters in cell types (first column of a sheet is 'feature')
+    cluster_columns = [c for c in df.columns if c != 'feature']
+    values = df.loc[rows['row'], cluster_columns].to_numpy(dtype=np.float64)
+    groups = np.array([[c in set(cluster[1:]) for c in cluster_columns] for cluster in clusters.values()], dtype=np.float64)
+    n = groups.sum(axis=1)
 
-# save results in separate excels for each family of receptors
-for family, clusters in data.items():
-    with pd.ExcelWriter(family+'_data.xlsx') as writer:
-        for sheet, df_data in clusters.items(): df_data.to_excel(writer, sheet_name=sheet)
+    sums = values @ groups.T
+    mean = sums / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(np.maximum(((values*values) @ groups.T - sums*mean) / (n - 1), 0))
+    prevalence = ((values > 0) @ groups.T) / n * 100
 
-# plot
-for family, clusters in data.items():
+    # Tidy table ordered by family, cell type and receptor
+    G, R = len(clusters), len(rows)
+    statistics = pd.DataFrame({'family_order': np.tile(rows['family_order'].to_numpy(), G), 'family': np.tile(rows['family'].to_numpy(), G), 'cell_type': np.repeat(list(clusters.keys()), R),
+                               'cell_type_order': np.repeat(np.arange(G), R), 'rank': np.tile(rows['rank'].to_numpy(), G), 'feature': np.tile(rows['feature'].to_numpy(), G),
+                               'row': np.tile(rows['row'].to_numpy(), G), 'MEAN': mean.T.ravel(), 'STD': std.T.ravel(), 'Prevalence(%)': prevalence.T.ravel()})
+    statistics = statistics.sort_values(['family_order', 'cell_type_order', 'rank'], kind='stable').drop(columns=['family_order', 'cell_type_order', 'rank'])
+    return statistics.reset_index(drop=True)
+
+def plot_family(clusters):
+    # Figure of MEAN (with STD) and prevalence of receptors of a family in every cell type, clusters is a dictionary of the form {cell_type: dataframe}
     fig, axes = plt.subplots(2, 5,figsize=(24,4),sharex=True)
     for sheet, df_data in clusters.items():
         i = list(clusters.keys()).index(sheet)
@@ -64,6 +65,46 @@ for family, clusters in data.items():
         axes[0][i].spines['bottom'].set_visible(False)
         axes[0][i].set_ylim([-1,12])
         axes[0][i].set_ylabel('avg. expr.(a.u.)')
-    plt.tight_layout()
-    plt.savefig(family+'.png')
-    plt.show()
\ No newline at end of file
+    fig.tight_layout()
+    return fig
+
+# Figures are rendered in worker processes, which import this script, so the analysis is only run when it is executed directly
+if __name__ == '__main__':
+    # get the names of clusters
+    sheet_names = ['L2.3_IT','L4_IT','L5_IT','L6_IT','L5_PT']
+    clusters = read_cluster_names('/home/ikharitonov/Desktop/Allen_10X_Data/Allen10x_5HT.xlsx', sheet_names)
+
+    # trimmed means matrix is converted once into a memory-mapped store, from which only rows of receptors and columns of the clusters above are read
+    store = open_trimmed_means_store('/home/ikharitonov/Desktop/Allen_10X_Data/trimmed_means.csv')
+    df = store.select(features=[r for receptor_list in receptors.values() for r in receptor_list], clusters=[c for cluster in clusters.values() for c in cluster])
+
+    statistics = family_cluster_statistics(df, receptors, clusters)
+    statistics.to_csv('family_cluster_statistics.csv', index=False)
+
+    # pull each of the clusters for each family of receptors from the table of statistics (with trimmed means of the cell type's clusters)
+    # {receptor_family_1: {L5_PT: dataframe_1, L5_IT: dataframe_2, ...}, receptor_family_2: {...}}
+    group_rows = statistics.groupby(['family', 'cell_type'], sort=False).indices
+    data = {}
+    for family in receptors:
+        cluster_data = {}
+        for cluster_name, cluster in clusters.items():
+            family_statistics = statistics.iloc[group_rows.get((family, cluster_name), [])]
+            temp_df = df.loc[family_statistics['row'], df.columns.intersection(cluster)]
+            temp_df['MEAN'] = family_statistics['MEAN'].to_numpy()
+            temp_df['STD'] = family_statistics['STD'].to_numpy()
+            temp_df['Prevalence(%)'] = family_statistics['Prevalence(%)'].to_numpy()
+            cluster_data[cluster_name] = temp_df
+        data[family] = cluster_data
+
+    print(data['Htr']['L5_IT'])
+
+    # save results in separate excels for each family of receptors
+    for family, clusters in data.items():
+        with pd.ExcelWriter(family+'_data.xlsx') as writer:
+            for sheet, df_data in clusters.items(): df_data.to_excel(writer, sheet_name=sheet)
+
+    # plot figures of all families in worker processes (headless), only figures whose data changed are rendered again
+    renderer = BatchRenderer('figures')
+    for family, clusters in data.items():
+        renderer.add(family, plot_family, {sheet: df_data[['feature','MEAN','STD','Prevalence(%)']] for sheet, df_data in clusters.items()})
+    print(renderer.render())
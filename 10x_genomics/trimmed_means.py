@@ -0,0 +1,155 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+def read_cluster_names(xlsx_path, sheet_names):
+    """
+    Reads names of clusters of every cell type from sheets of an Excel file (e.g. Allen10x_5HT.xlsx).
+
+        Parameters:
+            xlsx_path (str): path to the Excel file.
+            sheet_names (list): names of sheets (cell types).
+
+        Returns:
+            clusters (dict): dictionary of the form {sheet_name: [first column name, cluster names...]}.
+    """
+    clusters = {}
+    sheets = pd.read_excel(xlsx_path, sheet_name=list(sheet_names), nrows=0)
+    for name in sheet_names:
+        sheet_df = sheets[name]
+        # Removing columns which had identical names in excel (here they are added .1 in the end)
+        sheet_df = sheet_df.loc[:,sheet_df.columns.str.find('.') < 0]
+        column_list = list(sheet_df.columns)
+        column_list.remove('AVG')
+        column_list.remove('SD')
+        column_list.remove('Prevalence')
+        clusters[name] = column_list
+    return clusters
+
+def load_trimmed_means(csv_path, features=None, columns=None, chunksize=2000):
+    """
+    Reads rows of selected features (genes) and selected cluster columns of the trimmed means matrix (trimmed_means.csv).
+    The file is read in chunks of 'chunksize' rows, only the selected columns are parsed and rows of other features are dropped from every chunk,
+    so memory use depends on the selection and not on the size of the file.
+
+        Parameters:
+            csv_path (str): path to trimmed_means.csv.
+            features (list): features (values of the 'feature' column) to keep (all if None).
+            columns (list): cluster columns to read, columns which are not in the file are ignored (all if None).
+            chunksize (int): number of rows parsed at once.
+
+        Returns:
+            df (pandas.DataFrame): 'feature' column and the selected cluster columns (in the order of the file) of the selected features (in the order of the file),
+                                 indexed by row numbers in the file.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = list(header) if columns is None else ['feature'] + [c for c in header if c in set(columns) - {'feature'}]
+    features = None if features is None else set(features)
+
+    chunks = []
+    for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=chunksize):
+        if features is not None: chunk = chunk[chunk['feature'].isin(features)]
+        chunks.append(chunk)
+    if len(chunks) == 0: return pd.DataFrame(columns=usecols)
+    return pd.concat(chunks)
+
+def convert_trimmed_means(csv_path, store_path, chunksize=2000):
+    """
+    Converts the trimmed means matrix (trimmed_means.csv) into a store directory with a float32 matrix of features x clusters ('matrix.npy', memory-mapped when opened)
+    and names of features and clusters ('index.json'). The CSV file is read in chunks, which are written into the matrix on disk.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    clusters = [c for c in header if c != 'feature']
+    features = pd.read_csv(csv_path, usecols=['feature'], dtype={'feature': str})['feature'].tolist()
+
+    # Store is written into a temporary directory which replaces the previous store at the end, so an interrupted conversion never leaves a partial store
+    tmp_path = store_path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path): shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    matrix = np.lib.format.open_memmap(os.path.join(tmp_path, 'matrix.npy'), mode='w+', dtype=np.float32, shape=(len(features), len(clusters)))
+    row = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype={c: np.float32 for c in clusters}):
+        matrix[row:row+len(chunk)] = chunk[clusters].to_numpy(dtype=np.float32)
+        row += len(chunk)
+    matrix.flush()
+    del matrix
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as outfile: json.dump({'features': features, 'clusters': clusters}, outfile)
+
+    if os.path.exists(store_path): shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+class TrimmedMeansStore:
+    """
+    A class to access the trimmed means matrix converted by 'convert_trimmed_means'. The matrix (features x clusters, float32) is memory-mapped,
+    so only the accessed parts are read from disk, and features and clusters are located with hash indexes (dictionaries of names to positions).
+
+    Attributes
+    ----------
+    matrix : numpy.memmap
+        Read-only matrix of trimmed means (rows are features in the order of trimmed_means.csv, columns are clusters).
+    features : list
+        Names of features (genes).
+    clusters : list
+        Names of clusters.
+    feature_index : dict
+        Dictionary of the form {feature: row} (the first row of a feature which appears several times).
+    cluster_index : dict
+        Dictionary of the form {cluster: column}.
+
+    Methods
+    -------
+    feature(name):
+        Returns trimmed means of a feature in all clusters (view of the matrix row).
+    cluster(name):
+        Returns trimmed means of all features in a cluster (view of the matrix column).
+    value(feature, cluster):
+        Returns the trimmed mean of a feature in a cluster.
+    select(features, clusters):
+        Returns a DataFrame with trimmed means of the features in the clusters.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.matrix = np.load(os.path.join(store_path, 'matrix.npy'), mmap_mode='r')
+        with open(os.path.join(store_path, 'index.json'), 'r') as file: index = json.loads(file.read())
+        self.features = index['features']
+        self.clusters = index['clusters']
+        self.feature_index = {}
+        for i, feature in enumerate(self.features): self.feature_index.setdefault(feature, i)
+        self.cluster_index = {cluster: j for j, cluster in enumerate(self.clusters)}
+
+    def feature(self, name):
+        return self.matrix[self.feature_index[name]]
+
+    def cluster(self, name):
+        return self.matrix[:, self.cluster_index[name]]
+
+    def value(self, feature, cluster):
+        return self.matrix[self.feature_index[feature], self.cluster_index[cluster]]
+
+    def select(self, features=None, clusters=None):
+        """
+        Returns trimmed means of selected features and clusters as a DataFrame in the same form as 'load_trimmed_means':
+        'feature' column and cluster columns in the order of trimmed_means.csv, indexed by row numbers in the file. Names which are not in the store are ignored.
+        Only the selected rows are read from disk (the result is a copy, as the selection is not contiguous in general).
+        """
+        if features is None: rows = np.arange(len(self.features))
+        else: rows = np.array(sorted({self.feature_index[f] for f in features if f in self.feature_index}), dtype=np.int64)
+        columns = np.arange(len(self.clusters)) if clusters is None else np.array(sorted({self.cluster_index[c] for c in clusters if c in self.cluster_index}), dtype=np.int64)
+        values = self.matrix[rows][:, columns]
+        df = pd.DataFrame(values, index=rows, columns=[self.clusters[j] for j in columns])
+        df.insert(0, 'feature', [self.features[i] for i in rows])
+        return df
+
+def open_trimmed_means_store(csv_path, store_path=None):
+    """
+    Opens the store of the trimmed means matrix, converting trimmed_means.csv first if the store does not exist or is older than the CSV file.
+    By default the store is the 'trimmed_means_store' directory next to the CSV file.
+    """
+    if store_path is None: store_path = os.path.join(os.path.dirname(csv_path), 'trimmed_means_store')
+    matrix_path = os.path.join(store_path, 'matrix.npy')
+    if not os.path.isfile(matrix_path) or os.path.getmtime(matrix_path) < os.path.getmtime(csv_path):
+        print('Converting', csv_path, 'into', store_path)
+        convert_trimmed_means(csv_path, store_path)
+    return TrimmedMeansStore(store_path)
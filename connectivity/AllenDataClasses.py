@@ -1,14 +1,22 @@
 import os
+import copy
 import json
 from tqdm import tqdm
 import pickle
+import numpy as np
 import pandas as pd
 from RMALoaders import *
+from DownloadManager import UnionizedDataDownloadManager
+from UnionizedDataStore import UnionizedDataStore
+from Checkpoints import checkpointed_step
+from InjectionStructures import InjectionStructureIndex
 
 class AllenConnectivity:
     """
     A class to handle loading of unionized data, filtering of experiments, quality checks, thresholding, separation of ipsilateral and contralateral projections.
     """
+    midline_z = 5700 # z coordinate (in microns) separating left (hemisphere_id = 1) and right (hemisphere_id = 2) hemispheres
+
     def __init__(self, input_config, data_path, save_path):
         """
         Loads parameters from configuration file and metadata for experiments and brain areas. Copies configuration file into results directory and creates experiment list log.
@@ -27,18 +35,20 @@ class AllenConnectivity:
         self.data_path = data_path
         self.save_path = save_path
 
+        self.checkpoint_hashes = {}
+        self.preloaded_unionized_table = None
+        self.injection_summary = None
+
         self.parse_config()
-        
-        # Create folder for results and save a copy of configuration file there
-        self.centroids_folder_path = self.save_path / f'centroids_{self.projection_metric}_hem_id_{self.hemisphere_id_to_select}_inj_vol_thresh_{self.injection_volume_threshold}_target_vol_thresh_{self.projection_volume_threshold}_{self.target_structure_name}'
-        if os.path.isfile(self.centroids_folder_path / 'config.json'): os.remove(self.centroids_folder_path / 'config.json')
-        with open(self.mkdir(self.centroids_folder_path) / 'config.json', 'w') as f: json.dump(self.config, f)
+        self.create_centroids_folder()
 
         self.target_structure_object = RMAStructure(acronym=self.target_structure_name)
         self.target_structure_id = self.target_structure_object.id
 
 
         self.experiment_metadata = pd.read_csv(self.data_path / f'{self.target_structure_name}.csv')
+        # Injection structures of all experiments are parsed once
+        self.injection_structures = InjectionStructureIndex(self.experiment_metadata)
         structure_sets = RMAStructureSet()
         self.structure_set = structure_sets.get_structure_set(id=167587189) # Curated list of non-overlapping substructures at a mid-ontology level
 
@@ -54,19 +64,50 @@ class AllenConnectivity:
 
         self.save_experiment_list_log('step_1_collected_from_web_metadata', [self.experiment_list, '\n'.join(out_str)])
 
-    def save_experiment_list_log(self, key_to_write, value_to_write):
-        temp_dict = {}
-        filename = f'experiment_list_log.pkl'
+    def create_centroids_folder(self):
+        # Create folder for results and save a copy of configuration file there
+        self.centroids_folder_path = self.save_path / f'centroids_{self.projection_metric}_hem_id_{self.hemisphere_id_to_select}_inj_vol_thresh_{self.injection_volume_threshold}_target_vol_thresh_{self.projection_volume_threshold}_{self.target_structure_name}'
+        if os.path.isfile(self.centroids_folder_path / 'config.json'): os.remove(self.centroids_folder_path / 'config.json')
+        with open(self.mkdir(self.centroids_folder_path) / 'config.json', 'w') as f: json.dump(self.config, f)
 
-        # Reading from a file
-        if os.path.isfile(self.centroids_folder_path / filename):
-            with open(self.centroids_folder_path / filename, 'rb') as f: temp_dict = pickle.load(f)
+        # Experiment list log is kept in memory (starting from the log of a previous run in the same folder) and rewritten after every step
+        self.experiment_list_log = {}
+        self.experiment_list_log_keys = []
+        if os.path.isfile(self.centroids_folder_path / 'experiment_list_log.pkl'):
+            with open(self.centroids_folder_path / 'experiment_list_log.pkl', 'rb') as f: self.experiment_list_log = pickle.load(f)
+
+    def branch(self, input_config):
+        """
+        Returns a shallow copy of the object with a different configuration, so that the steps which were already done are shared between configurations.
+        Results folder of the new configuration is created and the experiment list log entries written so far are copied into it.
+        Steps never modify tables and experiment lists in place, so the copy and the original can be processed further independently.
+
+            Parameters:
+                input_config (dict): configuration of the copy.
+
+            Returns:
+                connectivity (AllenConnectivity): copy of the object.
+        """
+        connectivity = copy.copy(self)
+        connectivity.input_config = input_config
+        connectivity.checkpoint_hashes = dict(self.checkpoint_hashes)
+        connectivity.parse_config()
+        connectivity.create_centroids_folder()
+        connectivity.experiment_list_log.update({key: self.experiment_list_log[key] for key in self.experiment_list_log_keys})
+        connectivity.experiment_list_log_keys = list(self.experiment_list_log_keys)
+        connectivity.write_experiment_list_log()
+        return connectivity
 
-        temp_dict[key_to_write] = value_to_write
+    def save_experiment_list_log(self, key_to_write, value_to_write):
+        self.experiment_list_log[key_to_write] = value_to_write
+        if key_to_write not in self.experiment_list_log_keys: self.experiment_list_log_keys.append(key_to_write)
+        self.write_experiment_list_log()
 
-        # Saving to a file
-        if os.path.isfile(self.centroids_folder_path / filename): os.remove(self.centroids_folder_path / filename)
-        with open(self.centroids_folder_path / filename, 'wb') as f: pickle.dump(temp_dict, f)
+    def write_experiment_list_log(self):
+        # Saving to a temporary file first, so that an interrupted run never leaves a corrupted log
+        filename = f'experiment_list_log.pkl'
+        with open(self.centroids_folder_path / (filename + '.tmp'), 'wb') as f: pickle.dump(self.experiment_list_log, f)
+        os.replace(self.centroids_folder_path / (filename + '.tmp'), self.centroids_folder_path / filename)
        
     def parse_config(self):
         """
@@ -82,6 +123,10 @@ class AllenConnectivity:
             self.metric_for_projection_thresholding = self.config["metric_for_projection_thresholding"]
             self.read_unionized_data = self.config["read_unionized_data"]
             self.read_hemisphere_separated_experiment_list = self.config["read_hemisphere_separated_experiment_list"]
+            self.experiments_per_query = self.config.get("experiments_per_query", 100)
+            self.download_workers = self.config.get("download_workers", 8)
+            self.use_checkpoints = self.config.get("use_checkpoints", True)
+            self.remove_target_descendant_injections = self.config.get("remove_target_descendant_injections", False)
         elif type(self.input_config) == str:
             with open(self.input_config, 'r') as file: self.config = json.loads(file.read())
             self.target_structure_name = self.config["target_structure"]
@@ -92,6 +137,10 @@ class AllenConnectivity:
             self.metric_for_projection_thresholding = self.config["metric_for_projection_thresholding"]
             self.read_unionized_data = self.config["read_unionized_data"]
             self.read_hemisphere_separated_experiment_list = self.config["read_hemisphere_separated_experiment_list"]
+            self.experiments_per_query = self.config.get("experiments_per_query", 100)
+            self.download_workers = self.config.get("download_workers", 8)
+            self.use_checkpoints = self.config.get("use_checkpoints", True)
+            self.remove_target_descendant_injections = self.config.get("remove_target_descendant_injections", False)
         else:
             print('Input configuration has unsupported type.')
 
@@ -108,25 +157,18 @@ class AllenConnectivity:
 
         print(f'Number of experiments from metadata ({len(self.experiment_metadata)}) corresponds to the number of experiments matched with Allen structure set ({num_collected_exps}) ==> {len(self.experiment_metadata) == num_collected_exps}.')
     
+    @checkpointed_step(config_fields=['target_structure_id', 'remove_target_descendant_injections'], inputs=['experiment_list', 'experiment_metadata'], outputs=['experiment_list'])
     def remove_injection_target_overlap_areas(self):
         """
         Filtering out experiments with overlapping injection and target structures.
+        If 'remove_target_descendant_injections' is set in the config, experiments injected into substructures of the target are removed as well.
         """
-        experiment_list_inj_structs_removed = {}
-        exps_removed = []
-
-        for area_id, exps in self.experiment_list.items():
-            # if a V2m structure id is contained in injection-structures of an experiment, drop that experiment (id) from experiment_list
-            exps_ids_to_retain = []
-            for exp_id in exps:
-                # Loading and formatting dictionary with experiment's injection structures from Allen metadata
-                inj_structs_dict = json.loads(self.experiment_metadata[self.experiment_metadata['id']==exp_id]['injection-structures'].item().replace("=>",":"))
-                # Getting ids of experiment's injection structures
-                inj_structs_id_list = [x['id'] for x in inj_structs_dict]
-                if self.target_structure_id in inj_structs_id_list: exps_removed.append(exp_id)
-                else: exps_ids_to_retain.append(exp_id)
-            experiment_list_inj_structs_removed[area_id] = exps_ids_to_retain
-        
+        # if the target structure id (or one of its descendants) is contained in injection-structures of an experiment, drop that experiment (id) from experiment_list
+        ontology = get_ontology() if self.remove_target_descendant_injections else None
+        overlapping_experiments = set(self.injection_structures.experiments_injected_into(self.target_structure_id, ontology).tolist())
+        exps_removed = [e for exps in self.experiment_list.values() for e in exps if e in overlapping_experiments]
+        experiment_list_inj_structs_removed = {area_id: [e for e in exps if e not in overlapping_experiments] for area_id, exps in self.experiment_list.items()}
+
         out_str = []
         out_str.append(f'{len(exps_removed)} experiments removed:')
         print(out_str[-1])
@@ -142,38 +184,112 @@ class AllenConnectivity:
         if not os.path.exists(path): os.makedirs(path)
         return path
     
-    def load_unionized_data(self):
+    def read_unionized_table(self, experiment_list):
         """
-        Each csv file with unionized data is read into memory.
+        Unionized data of all experiments is read into one long-format table (columns 'experiment_id' and 'area' identify the experiment), keeping only the rows of the target structure and of the source area of each experiment.
+        If the consolidated store exists, only these rows are read from it, otherwise each csv file is read.
+
+            Parameters:
+                experiment_list (dict): experiments in the form {area_id_1: [experiment_id_1, experiment_id_2, ...], ...}.
+
+            Returns:
+                data (pandas.DataFrame): unionized data in long format.
+                loaded_experiments (set): IDs of experiments which were found.
         """
-        area_experiment_unionized_data = {}
         foldername = f'{self.target_structure_name}_unionized_data'
-        for area, experiments in tqdm(self.experiment_list.items(),'Loading unionized data'):
-            area_experiment_unionized_data[area] = {}
-            for e in experiments:
-                filename = f'area_{area}_experiment_{e}.csv'
-                temp_df = pd.read_csv(self.save_path / foldername / filename)
-                area_experiment_unionized_data[area][e] = temp_df
-        self.unionized_data = area_experiment_unionized_data
+        store = UnionizedDataStore(self.save_path / f'{foldername}.h5')
+        experiment_ids = [e for experiments in experiment_list.values() for e in experiments]
+        if store.exists():
+            structure_ids = [self.target_structure_id] + [area for area, experiments in experiment_list.items() if len(experiments) > 0]
+            data = store.load(experiment_ids=experiment_ids, structure_ids=structure_ids)
+            # Voxel coordinates are integers, as when they are read from csv files
+            for column in ['max_voxel_x','max_voxel_y','max_voxel_z']:
+                if not data[column].isna().any(): data[column] = data[column].astype('int64')
+            loaded_experiments = set(store.experiments()['experiment_id']) & set(experiment_ids)
+            missing = [e for e in experiment_ids if e not in loaded_experiments]
+            if missing: print(f'{len(missing)} experiments are missing from {store.path}: {missing}')
+        else:
+            frames = []
+            for area, experiments in tqdm(experiment_list.items(),'Loading unionized data'):
+                for e in experiments:
+                    filename = f'area_{area}_experiment_{e}.csv'
+                    temp_df = pd.read_csv(self.save_path / foldername / filename)
+                    frames.append(temp_df[(temp_df['structure_id']==self.target_structure_id) | (temp_df['structure_id']==area)].assign(experiment_id=e, area=area))
+            data = pd.concat(frames, ignore_index=True)
+            loaded_experiments = set(experiment_ids)
+
+        return data[(data['structure_id']==self.target_structure_id) | (data['structure_id']==data['area'])].reset_index(drop=True), loaded_experiments
+
+    def preload_unionized_data(self):
+        """
+        Reads unionized data of all experiments in the current experiment list once, so that 'load_unionized_data' of this object and its branches selects rows from memory.
+        """
+        preloaded_experiments = {e for experiments in self.experiment_list.values() for e in experiments}
+        self.preloaded_unionized_table = (preloaded_experiments,) + self.read_unionized_table(self.experiment_list)
+
+    def load_unionized_data(self):
+        experiment_ids = {e for experiments in self.experiment_list.values() for e in experiments}
+        if self.preloaded_unionized_table is not None and experiment_ids <= self.preloaded_unionized_table[0]:
+            _, data, loaded_experiments = self.preloaded_unionized_table
+            self.unionized_table = data[data['experiment_id'].isin(experiment_ids)].reset_index(drop=True)
+            loaded_experiments = loaded_experiments & experiment_ids
+        else:
+            self.unionized_table, loaded_experiments = self.read_unionized_table(self.experiment_list)
+        self.experiment_list = self.filter_experiment_list(self.experiment_list, loaded_experiments)
+
+    def filter_experiment_list(self, experiment_list, experiments_to_retain):
+        """
+        Returns a copy of {area_id: [experiment_id, ...]} dictionary with only the experiments contained in 'experiments_to_retain' (order of experiments is preserved).
+        """
+        return {area: [e for e in experiments if e in experiments_to_retain] for area, experiments in experiment_list.items()}
+
+    def count_experiments(self, experiment_list):
+        return sum(len(experiments) for experiments in experiment_list.values())
+
+    def experiment_list_to_dict(self, experiment_list, table):
+        """
+        Splits a long-format table into the {area_id: {experiment_id: pandas.DataFrame}} dictionary for experiments in 'experiment_list'.
+        """
+        grouped = dict(tuple(table.groupby('experiment_id', sort=False)))
+        empty = table.iloc[:0]
+        return {area: {e: grouped.get(e, empty).reset_index(drop=True) for e in experiments} for area, experiments in experiment_list.items()}
+
+    @property
+    def unionized_data(self):
+        # Dictionary of the form {area_id: {experiment_id: pandas.DataFrame}}, built from the long-format table
+        return self.experiment_list_to_dict(self.experiment_list, self.unionized_table)
+
+    @property
+    def ipsilateral_unionized_data(self):
+        return self.experiment_list_to_dict(self.ipsilateral_experiment_list, self.projection_table)
+
+    @property
+    def contralateral_unionized_data(self):
+        return self.experiment_list_to_dict(self.contralateral_experiment_list, self.projection_table)
 
     def download_unionized_data(self):
         """
         For each area, each experiment, download unionized data.
+        Downloads run concurrently and are recorded in a manifest, so an interrupted download can be restarted (experiments which were not completed are downloaded again).
         """
         if not self.read_unionized_data:
             foldername = f'{self.target_structure_name}_unionized_data'
-            path = self.mkdir(self.save_path / foldername)
-            for area, experiments in tqdm(self.experiment_list.items(),'Downloading'):
-                for e in experiments:
-                    filename = f'area_{area}_experiment_{e}.csv'
-                    # Skip if it already was downloaded
-                    if os.path.isfile(self.save_path / foldername / filename):
-                        continue
-                    else:
-                        temp_data = RMAUnionizedData(experiment_id=e).data
-                        temp_data.to_csv(self.save_path / foldername / filename)
+            download_manager = UnionizedDataDownloadManager(self.mkdir(self.save_path / foldername), num_workers=self.download_workers, experiments_per_query=self.experiments_per_query)
+            download_manager.download(self.experiment_list)
+            # Newly downloaded experiments are added to the consolidated store
+            num_imported = UnionizedDataStore(self.save_path / f'{foldername}.h5').import_csv_directory(self.save_path / foldername)
+            print(f'{num_imported} experiments added to the unionized data store.')
         else: print('Unionized data already downloaded.')
 
+    @property
+    def unionized_data_version(self):
+        # Experiments in the store (with their number of rows), or csv files with their sizes, identify the downloaded unionized data used by checkpointed steps
+        foldername = f'{self.target_structure_name}_unionized_data'
+        store = UnionizedDataStore(self.save_path / f'{foldername}.h5')
+        if store.exists(): return store.experiments()
+        if not os.path.exists(self.save_path / foldername): return None
+        return sorted((filename, os.path.getsize(self.save_path / foldername / filename)) for filename in os.listdir(self.save_path / foldername))
+
     def get_hemisphere_from_z_coordinate(self, unionized_data):
         """
         Returns the hemisphere_id of the row in passed unionized data with the biggest volume.
@@ -184,52 +300,92 @@ class AllenConnectivity:
             Returns:
                 hemisphere_id (int): 1 for left hemisphere and 2 for right hemisphere. If there is no injection structure with specified structure_id, 0 is returned.
         """
+        if len(unionized_data) == 0: return 0
         z_coord = unionized_data['max_voxel_z'].unique()
         # if there is data in both hemispheres, choose the one with higher volume
         if len(z_coord) > 1:
             z_coord = [unionized_data.iloc[unionized_data['volume'].idxmax()]['max_voxel_z']]
 
         if len(z_coord)==0: return 0
-        elif z_coord[0] < 5700: return 1
-        elif z_coord[0] >= 5700: return 2
+        elif z_coord[0] < self.midline_z: return 1
+        elif z_coord[0] >= self.midline_z: return 2
 
-    def check_hemisphere(self, experiment_id, structure_id):
+    def compute_injection_summary(self, area_experiment_pairs):
         """
-        Returns the hemisphere_id for a given injection structure and experiment id. If the injection spans both hemispheres, the one with higher volume is chosen.
-        
+        Queries injection unionized data of experiments in batches and summarises it into a table with one row per experiment: injection hemisphere (determined as in 'get_hemisphere_from_z_coordinate'),
+        injection volume per hemisphere and in the injection hemisphere, coordinates of the max voxel and IDs of all injection structures. Injection hemisphere and volumes are computed for the area where the experiment was injected.
+
             Parameters:
-                experiment_id (int): id of the experiment (section_data_set_id).
-                structure_id (int): id of the injection structure.
-                
+                area_experiment_pairs (list): list of (area_id, experiment_id) tuples.
+
             Returns:
-                hemisphere_id (int): 1 for left hemisphere and 2 for right hemisphere. If there is no injection structure with specified structure_id, 0 is returned.
+                summary (pandas.DataFrame): injection summary table.
+        """
+        frames = []
+        for i in tqdm(range(0, len(area_experiment_pairs), self.experiments_per_query), 'Querying injection unionized data'):
+            batch = area_experiment_pairs[i:i+self.experiments_per_query]
+            temp_data = RMABatchedUnionizedData(experiment_ids=[e for _, e in batch], is_injection=True, experiments_per_query=self.experiments_per_query).data
+            frames += [temp_data[e].assign(area=area) for area, e in batch if len(temp_data[e]) > 0]
+        injection_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['section_data_set_id','structure_id','hemisphere_id','max_voxel_x','max_voxel_y','max_voxel_z','volume','area'])
+        injection_df = injection_df.rename(columns={'section_data_set_id': 'experiment_id'})
+
+        summary = pd.DataFrame({'experiment_id': [e for _, e in area_experiment_pairs], 'area': [area for area, _ in area_experiment_pairs]}).set_index('experiment_id')
+        injection_structures = injection_df.groupby('experiment_id')['structure_id'].apply(lambda ids: sorted(set(ids)))
+        summary['injection_structures'] = [injection_structures.get(e, []) for e in summary.index]
+
+        # Injection hemisphere is taken from the z coordinate of the row with the biggest volume in the injected area
+        area_df = injection_df[injection_df['structure_id']==injection_df['area']]
+        max_volume_rows = area_df.loc[area_df.dropna(subset=['volume']).groupby('experiment_id', sort=False)['volume'].idxmax()].set_index('experiment_id')
+        for column in ['max_voxel_x','max_voxel_y','max_voxel_z']: summary[column] = max_volume_rows[column].reindex(summary.index)
+        summary['injection_hemisphere_id'] = np.where(summary['max_voxel_z'].isna(), 0, np.where(summary['max_voxel_z'] < self.midline_z, 1, 2))
+
+        volumes = area_df.groupby(['experiment_id','hemisphere_id'])['volume'].first().unstack()
+        for hem in [1,2,3]: summary[f'injection_volume_hem_{hem}'] = volumes[hem].reindex(summary.index) if hem in volumes.columns else np.nan
+        summary['injection_volume'] = [summary.at[e, f'injection_volume_hem_{hem}'] if hem else np.nan for e, hem in zip(summary.index, summary['injection_hemisphere_id'])]
+
+        return summary.reset_index()
+
+    def load_injection_summary(self):
+        """
+        Loads the injection summary table shared by all targets and configurations ('injection_summary.pkl' in 'save_path'). Experiments from the experiment list which are not in the table yet are queried and added to it.
         """
-        temp_data = RMAUnionizedData(experiment_id=experiment_id, is_injection=True, select_structure_id=structure_id).data.reset_index(drop=True)
+        experiment_ids = {e for experiments in self.experiment_list.values() for e in experiments}
+        if self.injection_summary is not None and experiment_ids <= set(self.injection_summary.index): return
 
-        return self.get_hemisphere_from_z_coordinate(temp_data)
-    
+        filename = 'injection_summary.pkl'
+        if os.path.isfile(self.save_path / filename): summary = pd.read_pickle(self.save_path / filename)
+        else: summary = None
+
+        known_experiments = set() if summary is None else set(zip(summary['area'], summary['experiment_id']))
+        missing = [(area, e) for area, experiments in self.experiment_list.items() for e in experiments if (area, e) not in known_experiments]
+        if missing:
+            new_summary = self.compute_injection_summary(missing)
+            summary = new_summary if summary is None else pd.concat([summary[~summary['experiment_id'].isin(new_summary['experiment_id'])], new_summary], ignore_index=True)
+            # Saving to a temporary file first, so that an interrupted run does not corrupt the table
+            summary.to_pickle(self.save_path / (filename + '.tmp'))
+            os.replace(self.save_path / (filename + '.tmp'), self.save_path / filename)
+
+        self.injection_summary = summary.set_index('experiment_id')
+
+    @checkpointed_step(config_fields=['hemisphere_id_to_select', 'read_hemisphere_separated_experiment_list'], inputs=['experiment_list'], outputs=['experiment_list'])
     def select_by_hemisphere(self):
         """
         Removing all experiments that were not injected in the specified hemisphere.
         """
         
         if self.read_hemisphere_separated_experiment_list:
-            # Reading from a file
-            filename = f'experiment_list_log.pkl'
-            with open(self.centroids_folder_path / filename, 'rb') as f: experiment_list_filtered_by_hemisphere = pickle.load(f)
-            experiment_list_filtered_by_hemisphere = experiment_list_filtered_by_hemisphere[f'step_3_hemisphere_id_{self.hemisphere_id_to_select}_only_selected'][0]
+            # Reading from the log of a previous run (loaded from 'experiment_list_log.pkl')
+            experiment_list_filtered_by_hemisphere = self.experiment_list_log[f'step_3_hemisphere_id_{self.hemisphere_id_to_select}_only_selected'][0]
             out_str = []
             out_str.append('Experiment list loaded from file.')
             print(out_str[-1])
         else:
-            # Copy the dictionary
-            experiment_list_filtered_by_hemisphere = {k:v.copy() for k,v in self.experiment_list.items()}
-            exps_removed = []
-            for area, exps in tqdm(experiment_list_filtered_by_hemisphere.items(), f'Only selecting experiments injectied in hemisphere_id = {self.hemisphere_id_to_select}'):
-                for e in exps:
-                    ind = exps.index(e)
-                    hem = self.check_hemisphere(e, area)
-                    if hem != self.hemisphere_id_to_select: exps_removed.append(experiment_list_filtered_by_hemisphere[area].pop(ind))
+            self.load_injection_summary()
+            # Injection hemisphere of every experiment is looked up in the injection summary table
+            injection_hemispheres = self.injection_summary['injection_hemisphere_id']
+            selected_experiments = set(injection_hemispheres.index[injection_hemispheres==self.hemisphere_id_to_select])
+            exps_removed = [e for exps in self.experiment_list.values() for e in exps if e not in selected_experiments]
+            experiment_list_filtered_by_hemisphere = self.filter_experiment_list(self.experiment_list, selected_experiments)
             out_str = []
             out_str.append(f'{len(exps_removed)} experiments removed:')
             print(out_str[-1])
@@ -245,146 +401,108 @@ class AllenConnectivity:
 
         self.save_experiment_list_log(f'step_3_hemisphere_id_{self.hemisphere_id_to_select}_only_selected', [self.experiment_list, '\n'.join(out_str)])
 
+    @checkpointed_step(config_fields=['target_structure_id', 'projection_metric'], inputs=['experiment_list', 'unionized_data_version'], outputs=['experiment_list', 'unionized_table'])
     def zero_projection_QC(self):
         # Load the data because it is needed now to check projection values
         self.load_unionized_data()
 
         out_str = []
-        out_str.append(f'number of experiments BEFORE zero-valued projection QC = {sum(len(self.unionized_data[area]) for area in self.unionized_data.keys())}')
+        out_str.append(f'number of experiments BEFORE zero-valued projection QC = {self.count_experiments(self.experiment_list)}')
         print(out_str[-1])
 
-        temp_experiment_list = {}
-        temp_dict = {}
-        for area in self.unionized_data:
-            temp_dict[area] = {}
-            temp_experiment_list[area] = []
-            for exp, exp_df in self.unionized_data[area].items():
-                if (exp_df[exp_df['structure_id']==self.target_structure_id][self.projection_metric] == 0).any():
-                    continue
-                else:
-                    temp_dict[area][exp] = exp_df
-                    temp_experiment_list[area].append(exp)
-
-        del self.unionized_data
-        self.unionized_data = temp_dict
-        del self.experiment_list
-        self.experiment_list = temp_experiment_list
+        # Experiments with any zero-valued projection metric in the target structure are removed
+        target_df = self.unionized_table[self.unionized_table['structure_id']==self.target_structure_id]
+        zero_projection_experiments = set(target_df.loc[target_df[self.projection_metric]==0, 'experiment_id'])
+        experiments_to_retain = {e for experiments in self.experiment_list.values() for e in experiments} - zero_projection_experiments
 
-        out_str.append(f'number of experiments AFTER zero-valued projection QC = {sum(len(self.unionized_data[area]) for area in self.unionized_data.keys())}')
+        self.experiment_list = self.filter_experiment_list(self.experiment_list, experiments_to_retain)
+        self.unionized_table = self.unionized_table[self.unionized_table['experiment_id'].isin(experiments_to_retain)].reset_index(drop=True)
+
+        out_str.append(f'number of experiments AFTER zero-valued projection QC = {self.count_experiments(self.experiment_list)}')
         print(out_str[-1])
 
         self.save_experiment_list_log(f'step_4_zero_value_projection_experiments_removed', [self.experiment_list, '\n'.join(out_str)])
 
-    def get_vol_from_downloaded_unionized_data(self, area, experiment):        
-        # Query data for injection structure and return volume of injection hemisphere
-        temp_data = RMAUnionizedData(experiment_id=experiment,is_injection=True,select_structure_id=area).data.reset_index(drop=True)
-        temp_data = temp_data[temp_data['hemisphere_id']==self.get_hemisphere_from_z_coordinate(temp_data)]
-        return temp_data['volume'].item()
-
+    @checkpointed_step(config_fields=['injection_volume_threshold'], inputs=['experiment_list', 'unionized_table'], outputs=['experiment_list', 'unionized_table'])
     def injection_volume_thresholding(self):
         out_str = []
-        out_str.append(f'number of experiments BEFORE injection volume thresholding = {sum(len(self.unionized_data[area]) for area in self.unionized_data.keys())}')
+        out_str.append(f'number of experiments BEFORE injection volume thresholding = {self.count_experiments(self.experiment_list)}')
         print(out_str[-1])
 
-        temp_dict = {}
-        temp_experiment_list = {}
-
-        for area in tqdm(self.unionized_data):
-            temp_dict[area] = {}
-            temp_experiment_list[area] = []
-            for exp, exp_df in self.unionized_data[area].items():
-                temp_vol = self.get_vol_from_downloaded_unionized_data(area, exp)
-                if temp_vol >= self.injection_volume_threshold:
-                    temp_dict[area][exp] = self.unionized_data[area][exp]
-                    temp_experiment_list[area].append(exp)
-        del self.unionized_data
-        self.unionized_data = temp_dict
-        del self.experiment_list
-        self.experiment_list = temp_experiment_list
+        # Injection volume (in the injection hemisphere) of every experiment is looked up in the injection summary table
+        self.load_injection_summary()
+        injection_volumes = self.injection_summary['injection_volume']
+        experiments_to_retain = set(injection_volumes.index[injection_volumes >= self.injection_volume_threshold])
+
+        self.experiment_list = self.filter_experiment_list(self.experiment_list, experiments_to_retain)
+        self.unionized_table = self.unionized_table[self.unionized_table['experiment_id'].isin(experiments_to_retain)].reset_index(drop=True)
 
-        out_str.append(f'number of experiments AFTER injection volume thresholding = {sum(len(self.unionized_data[area]) for area in self.unionized_data.keys())}')
+        out_str.append(f'number of experiments AFTER injection volume thresholding = {self.count_experiments(self.experiment_list)}')
         print(out_str[-1])
 
         self.save_experiment_list_log(f'step_5_injection_volume_thresholding_done', [self.experiment_list, '\n'.join(out_str)])
 
+    @checkpointed_step(config_fields=['target_structure_id', 'hemisphere_id_to_select', 'projection_metric', 'metric_for_projection_thresholding'], inputs=['experiment_list', 'unionized_table'], outputs=['projection_table', 'ipsilateral_experiment_list', 'contralateral_experiment_list'])
     def separate_by_projection_hemisphere(self):
-        # And collect experiments into two dictionaries based on hemisphere where projection metric is higher
-
-        self.ipsilateral_unionized_data = {}
-        self.contralateral_unionized_data = {}
+        # And collect experiments into two groups based on hemisphere where projection metric is higher
 
         hem_ids = [2,1] # for getting the index of contralateral hemisphere to the one specified in the config
         if self.projection_metric == self.metric_for_projection_thresholding: target_structure_fields_to_select = ['hemisphere_id',self.projection_metric]
         else: target_structure_fields_to_select = ['hemisphere_id',self.projection_metric,self.metric_for_projection_thresholding]
 
-        for area in self.unionized_data:
-            self.ipsilateral_unionized_data[area] = {}
-            self.contralateral_unionized_data[area] = {}
-            for exp, exp_df in self.unionized_data[area].items():
-                # Checking if unionized data of experiment has higher projection metric value in previosly selected hemisphere
-                if exp_df[(exp_df['hemisphere_id']==self.hemisphere_id_to_select) & (exp_df['structure_id']==self.target_structure_id)][self.projection_metric].item() > exp_df[(exp_df['hemisphere_id']==hem_ids[self.hemisphere_id_to_select-1]) & (exp_df['structure_id']==self.target_structure_id)][self.projection_metric].item():
-                    # Taking coordinates data from the Source structure and joining it with projection metric data from Target structure (for the convenience of access later) in one dataframe
-                    temp_df1 = exp_df[exp_df['structure_id']==area][['hemisphere_id','max_voxel_x','max_voxel_y','max_voxel_z']]
-                    temp_df2 = exp_df[exp_df['structure_id']==self.target_structure_id][target_structure_fields_to_select]
-                    self.ipsilateral_unionized_data[area][exp] = temp_df1.merge(temp_df2, on='hemisphere_id')
-                else: 
-                    temp_df1 = exp_df[exp_df['structure_id']==area][['hemisphere_id','max_voxel_x','max_voxel_y','max_voxel_z']]
-                    temp_df2 = exp_df[exp_df['structure_id']==self.target_structure_id][target_structure_fields_to_select]
-                    self.contralateral_unionized_data[area][exp] = temp_df1.merge(temp_df2, on='hemisphere_id')
+        table = self.unionized_table
+        target_df = table[table['structure_id']==self.target_structure_id]
+
+        # Checking if unionized data of experiment has higher projection metric value in previosly selected hemisphere
+        target_metric = target_df.pivot(index='experiment_id', columns='hemisphere_id', values=self.projection_metric)
+        selected_hem_metric = target_metric.get(self.hemisphere_id_to_select)
+        other_hem_metric = target_metric.get(hem_ids[self.hemisphere_id_to_select-1])
+        if selected_hem_metric is None or other_hem_metric is None: ipsilateral_experiments = set()
+        else: ipsilateral_experiments = set(target_metric.index[selected_hem_metric > other_hem_metric])
+
+        # Taking coordinates data from the Source structure and joining it with projection metric data from Target structure (for the convenience of access later) in one table
+        source_df = table[table['structure_id']==table['area']][['experiment_id','hemisphere_id','max_voxel_x','max_voxel_y','max_voxel_z']]
+        self.projection_table = source_df.merge(target_df[['experiment_id']+target_structure_fields_to_select], on=['experiment_id','hemisphere_id'])
+
+        self.ipsilateral_experiment_list = self.filter_experiment_list(self.experiment_list, ipsilateral_experiments)
+        self.contralateral_experiment_list = {area: [e for e in experiments if e not in ipsilateral_experiments] for area, experiments in self.experiment_list.items()}
 
         out_str = []
-        out_str.append(f'{sum(len(self.ipsilateral_unionized_data[area]) for area in self.ipsilateral_unionized_data.keys())} ipsilaterally projecting experiments.')
+        out_str.append(f'{self.count_experiments(self.ipsilateral_experiment_list)} ipsilaterally projecting experiments.')
         print(out_str[-1])
-        out_str.append(f'{sum(len(self.contralateral_unionized_data[area]) for area in self.contralateral_unionized_data.keys())} contralaterally projecting experiments.')
+        out_str.append(f'{self.count_experiments(self.contralateral_experiment_list)} contralaterally projecting experiments.')
         print(out_str[-1])
 
-        # Retrieving ipsilateral & contralateral experiment lists from unionized data to save them into the log file
-        ipsilateral_experiment_list = {area: list(self.ipsilateral_unionized_data[area].keys()) for area in self.ipsilateral_unionized_data.keys()}
-        contralateral_experiment_list = {area: list(self.contralateral_unionized_data[area].keys()) for area in self.contralateral_unionized_data.keys()}
-        self.save_experiment_list_log(f'step_6_separated_by_projection', [{'ipsilateral_experiment_list': ipsilateral_experiment_list, 'contralateral_experiment_list': contralateral_experiment_list}, '\n'.join(out_str)])
+        self.save_experiment_list_log(f'step_6_separated_by_projection', [{'ipsilateral_experiment_list': self.ipsilateral_experiment_list, 'contralateral_experiment_list': self.contralateral_experiment_list}, '\n'.join(out_str)])
 
+    @checkpointed_step(config_fields=['hemisphere_id_to_select', 'metric_for_projection_thresholding', 'projection_volume_threshold'], inputs=['projection_table', 'ipsilateral_experiment_list', 'contralateral_experiment_list'], outputs=['projection_table', 'ipsilateral_experiment_list', 'contralateral_experiment_list'])
     def projection_volume_thresholding(self):
         # In ipsilateral experiments, thresholding is done on target structure in the same hemisphere as 'hemisphere_id_to_select'. In contralateral, the opposite.
 
         out_str = []
-        out_str.append(f'Number of ipsilateral experiments BEFORE projection volume thresholding = {sum(len(self.ipsilateral_unionized_data[area]) for area in self.ipsilateral_unionized_data.keys())}')
+        out_str.append(f'Number of ipsilateral experiments BEFORE projection volume thresholding = {self.count_experiments(self.ipsilateral_experiment_list)}')
         print(out_str[-1])
-        out_str.append(f'Number of contralateral experiments BEFORE projection volume thresholding = {sum(len(self.contralateral_unionized_data[area]) for area in self.contralateral_unionized_data.keys())}')
+        out_str.append(f'Number of contralateral experiments BEFORE projection volume thresholding = {self.count_experiments(self.contralateral_experiment_list)}')
         print(out_str[-1])
 
         hem_ids = [2,1]
 
-        temp_ipsilateral_dict = {}
-        temp_contralateral_dict = {}
-
-        for area in tqdm(self.ipsilateral_unionized_data.keys(), 'ipsilateral'):
-            temp_ipsilateral_dict[area] = {}
-            for exp, exp_df in self.ipsilateral_unionized_data[area].items():
-                proj_vol = exp_df[exp_df['hemisphere_id']==self.hemisphere_id_to_select][self.metric_for_projection_thresholding].item()
-                if proj_vol >= self.projection_volume_threshold:
-                    temp_ipsilateral_dict[area][exp] = exp_df
-
-        for area in tqdm(self.contralateral_unionized_data.keys(), 'contralateral'):
-            temp_contralateral_dict[area] = {}
-            for exp, exp_df in self.contralateral_unionized_data[area].items():
-                proj_vol = exp_df[exp_df['hemisphere_id']==hem_ids[self.hemisphere_id_to_select-1]][self.metric_for_projection_thresholding].item()
-                if proj_vol >= self.projection_volume_threshold:
-                    temp_contralateral_dict[area][exp] = exp_df
-
-        del self.ipsilateral_unionized_data
-        del self.contralateral_unionized_data
-        self.ipsilateral_unionized_data = temp_ipsilateral_dict
-        self.contralateral_unionized_data = temp_contralateral_dict
-        
-        out_str.append(f'Number of ipsilateral experiments AFTER projection volume thresholding = {sum(len(self.ipsilateral_unionized_data[area]) for area in self.ipsilateral_unionized_data.keys())}')
+        table = self.projection_table
+        above_threshold = table[self.metric_for_projection_thresholding] >= self.projection_volume_threshold
+        ipsilateral_experiments = set(table.loc[above_threshold & (table['hemisphere_id']==self.hemisphere_id_to_select), 'experiment_id'])
+        contralateral_experiments = set(table.loc[above_threshold & (table['hemisphere_id']==hem_ids[self.hemisphere_id_to_select-1]), 'experiment_id'])
+
+        self.ipsilateral_experiment_list = self.filter_experiment_list(self.ipsilateral_experiment_list, ipsilateral_experiments)
+        self.contralateral_experiment_list = self.filter_experiment_list(self.contralateral_experiment_list, contralateral_experiments)
+        retained_experiments = {e for experiments in self.ipsilateral_experiment_list.values() for e in experiments} | {e for experiments in self.contralateral_experiment_list.values() for e in experiments}
+        self.projection_table = table[table['experiment_id'].isin(retained_experiments)].reset_index(drop=True)
+
+        out_str.append(f'Number of ipsilateral experiments AFTER projection volume thresholding = {self.count_experiments(self.ipsilateral_experiment_list)}')
         print(out_str[-1])
-        out_str.append(f'Number of contralateral experiments AFTER projection volume thresholding = {sum(len(self.contralateral_unionized_data[area]) for area in self.contralateral_unionized_data.keys())}')
+        out_str.append(f'Number of contralateral experiments AFTER projection volume thresholding = {self.count_experiments(self.contralateral_experiment_list)}')
         print(out_str[-1])
 
-        # Retrieving ipsilateral & contralateral experiment lists from unionized data to save them into the log file
-        ipsilateral_experiment_list = {area: list(self.ipsilateral_unionized_data[area].keys()) for area in self.ipsilateral_unionized_data.keys()}
-        contralateral_experiment_list = {area: list(self.contralateral_unionized_data[area].keys()) for area in self.contralateral_unionized_data.keys()}
-        self.save_experiment_list_log(f'step_7_projection_volume_thresholding_done', [{'ipsilateral_experiment_list': ipsilateral_experiment_list, 'contralateral_experiment_list': contralateral_experiment_list}, '\n'.join(out_str)])
+        self.save_experiment_list_log(f'step_7_projection_volume_thresholding_done', [{'ipsilateral_experiment_list': self.ipsilateral_experiment_list, 'contralateral_experiment_list': self.contralateral_experiment_list}, '\n'.join(out_str)])
 
     def xyz_weighted_centroid(self,coordinates):
         """
@@ -407,36 +525,30 @@ class AllenConnectivity:
         
         return centroid_point
 
+    @checkpointed_step(config_fields=['hemisphere_id_to_select', 'projection_metric'], inputs=['projection_table', 'ipsilateral_experiment_list', 'contralateral_experiment_list'], outputs=['ipsilateral_centroids_dict', 'contralateral_centroids_dict'])
     def compute_weighted_centroids(self):
-        hem_ids = [2,1] # for getting the index of contralateral hemisphere to the one specified before
-
-        self.ipsilateral_centroids_dict = {}
-        self.contralateral_centroids_dict = {}
-
-        ipsilateral_exp_list_to_log = {}
-        contralateral_exp_list_to_log = {}
-
-        for area in self.ipsilateral_unionized_data:
-            xyz_metric_selection = {exp_id:[exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_x'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_y'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_z'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select][self.projection_metric].item()] for exp_id, exp in self.ipsilateral_unionized_data[area].items()}
-            list_xyz_metric_selection = [l for l in xyz_metric_selection.values()]
-            if len(list_xyz_metric_selection) == 0: centroid_xyz = None
-            else: centroid_xyz = self.xyz_weighted_centroid(list_xyz_metric_selection)
-            if centroid_xyz: 
-                self.ipsilateral_centroids_dict[area] = centroid_xyz
-                ipsilateral_exp_list_to_log[area] = xyz_metric_selection
+        # Coordinates and projection metric of every experiment in the selected hemisphere, in the form {experiment_id: [x, y, z, projection_metric]}
+        table = self.projection_table[self.projection_table['hemisphere_id']==self.hemisphere_id_to_select]
+        xyz_metric = dict(zip(table['experiment_id'].tolist(), zip(table['max_voxel_x'].tolist(), table['max_voxel_y'].tolist(), table['max_voxel_z'].tolist(), table[self.projection_metric].tolist())))
+
+        def centroids_for_experiment_list(experiment_list):
+            centroids_dict = {}
+            exp_list_to_log = {}
+            for area, experiments in experiment_list.items():
+                xyz_metric_selection = {exp_id: list(xyz_metric[exp_id]) for exp_id in experiments if exp_id in xyz_metric}
+                if len(xyz_metric_selection) == 0: continue
+                centroids_dict[area] = self.xyz_weighted_centroid(list(xyz_metric_selection.values()))
+                exp_list_to_log[area] = xyz_metric_selection
+            return centroids_dict, exp_list_to_log
+
+        self.ipsilateral_centroids_dict, ipsilateral_exp_list_to_log = centroids_for_experiment_list(self.ipsilateral_experiment_list)
         out_str = []
-        out_str.append(f'{len(self.ipsilateral_centroids_dict.keys())} ipsilateral centroids computed out of {len(self.ipsilateral_unionized_data.keys())} regions')
+        out_str.append(f'{len(self.ipsilateral_centroids_dict.keys())} ipsilateral centroids computed out of {len(self.ipsilateral_experiment_list.keys())} regions')
         print(out_str[-1])
 
-        for area in self.contralateral_unionized_data:
-            xyz_metric_selection = {exp_id:[exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_x'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_y'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select]['max_voxel_z'].item(), exp[exp['hemisphere_id']==self.hemisphere_id_to_select][self.projection_metric].item()] for exp_id, exp in self.ipsilateral_unionized_data[area].items()}
-            list_xyz_metric_selection = [l for l in xyz_metric_selection.values()]
-            if len(list_xyz_metric_selection) == 0: centroid_xyz = None
-            else: centroid_xyz = self.xyz_weighted_centroid(list_xyz_metric_selection)
-            if centroid_xyz:
-                self.contralateral_centroids_dict[area] = centroid_xyz
-                contralateral_exp_list_to_log[area] = xyz_metric_selection
-        out_str.append(f'{len(self.contralateral_centroids_dict.keys())} contralateral centroids computed out of {len(self.contralateral_unionized_data.keys())} regions')
+        # Contralateral centroids are computed from the ipsilateral experiment list, as in the previous per-experiment implementation of this step
+        self.contralateral_centroids_dict, contralateral_exp_list_to_log = centroids_for_experiment_list(self.ipsilateral_experiment_list)
+        out_str.append(f'{len(self.contralateral_centroids_dict.keys())} contralateral centroids computed out of {len(self.contralateral_experiment_list.keys())} regions')
         print(out_str[-1])
 
         self.save_experiment_list_log(f'step_8_data_used_for_centroids_computation_zero_experiment_areas_removed', [{'ipsilateral_xyz_coordinates': ipsilateral_exp_list_to_log, 'contralateral_xyz_coordinates': contralateral_exp_list_to_log}, '\n'.join(out_str)])
@@ -0,0 +1,95 @@
+import os
+import pickle
+import hashlib
+import functools
+import pandas as pd
+
+def content_hash(value):
+    """
+    Returns a hash of a value. Tables are hashed with their column names, other values through their pickled representation.
+    """
+    sha256 = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        sha256.update(repr(list(value.columns)).encode())
+        sha256.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+    else:
+        sha256.update(pickle.dumps(value, protocol=4))
+    return sha256.hexdigest()
+
+class CheckpointStore:
+    """
+    A directory of step checkpoints. Every checkpoint is a pickle file named after the step and the hash of its inputs ('{step}_{key}.pkl'),
+    containing attributes set by the step and the experiment list log entries it has written.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(self.path): os.makedirs(self.path)
+
+    def filename(self, step_name, key):
+        return self.path / f'{step_name}_{key}.pkl'
+
+    def load(self, step_name, key):
+        if not os.path.isfile(self.filename(step_name, key)): return None
+        try:
+            with open(self.filename(step_name, key), 'rb') as f: return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError):
+            return None
+
+    def save(self, step_name, key, checkpoint):
+        # Writing into a temporary file first, so that an interrupted run never leaves a corrupted checkpoint
+        tmp_path = self.filename(step_name, key).with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f: pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.filename(step_name, key))
+
+def input_hash(obj, attribute):
+    """
+    Returns the hash identifying the current value of an attribute. Values set by checkpointed steps are identified by the key of the step which produced them,
+    so large tables are not hashed again by every step. Other values are hashed by content (the hash is reused while the attribute holds the same object).
+    """
+    value = getattr(obj, attribute)
+    recorded = obj.checkpoint_hashes.get(attribute)
+    if recorded is None or recorded[0] is not value:
+        recorded = (value, content_hash(value))
+        obj.checkpoint_hashes[attribute] = recorded
+    return recorded[1]
+
+def checkpointed_step(config_fields=(), inputs=(), outputs=(), version=1):
+    """
+    Decorator for pipeline steps (methods of AllenConnectivity) which stores the outputs of a step as a checkpoint and skips the step when it is rerun with unchanged inputs.
+    The checkpoint key is a hash of the step name, its version, values of 'config_fields' and hashes of 'inputs' attributes. Attributes listed in 'outputs' and
+    experiment list log entries written by the step are saved in 'save_path/checkpoints' and restored on a rerun with the same key.
+    A step has to be run again after changes of its code, which is done by increasing its 'version'.
+
+        Parameters:
+            config_fields (list): names of configuration attributes the step depends on.
+            inputs (list): names of attributes the step reads.
+            outputs (list): names of attributes the step sets.
+            version (int): version of the step implementation.
+    """
+    def decorator(step):
+        @functools.wraps(step)
+        def wrapper(self):
+            if not self.use_checkpoints: return step(self)
+
+            key_parts = [step.__name__, version] + [(field, getattr(self, field)) for field in config_fields] + [(attribute, input_hash(self, attribute)) for attribute in inputs]
+            key = hashlib.sha256(repr(key_parts).encode()).hexdigest()[:32]
+            store = CheckpointStore(self.save_path / 'checkpoints')
+
+            checkpoint = store.load(step.__name__, key)
+            if checkpoint is not None:
+                for attribute, value in checkpoint['outputs'].items(): setattr(self, attribute, value)
+                for log_key, log_value in checkpoint['log'].items():
+                    self.save_experiment_list_log(log_key, log_value)
+                    print(log_value[1])
+                print(f'{step.__name__} restored from checkpoint.')
+            else:
+                log_before = {k: self.experiment_list_log[k] for k in self.experiment_list_log_keys}
+                step(self)
+                log = {k: self.experiment_list_log[k] for k in self.experiment_list_log_keys if log_before.get(k) is not self.experiment_list_log[k]}
+                checkpoint = {'outputs': {attribute: getattr(self, attribute) for attribute in outputs}, 'log': log}
+                store.save(step.__name__, key, checkpoint)
+
+            # Outputs are identified by the key of the step, so the following steps do not need to hash them
+            for attribute in outputs: self.checkpoint_hashes[attribute] = (getattr(self, attribute), hashlib.sha256(f'{key}_{attribute}'.encode()).hexdigest())
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+import json
+from AllenDataClasses import AllenConnectivity
+
+class ConnectivitySweep:
+    """
+    A class to run the connectivity pipeline for a grid of configurations, sharing the work between them.
+    Configurations with the same target structure (and other fields which are not used by the filtering steps) share the prefix of the pipeline: metadata, overlap removal, download and loading of unionized data.
+    After that the pipeline branches (see AllenConnectivity.branch) only at the steps where the parameters of configurations diverge, so every step is done once per distinct combination of the parameters it depends on.
+    Results (centroids, experiment list logs and config.json) of every configuration are saved in the same folders as when configurations are run one by one.
+
+    Attributes
+    ----------
+    configs : list
+        List of configuration dictionaries.
+    data_path : pathlib.Path
+        Path to the directory where experiment metadata is stored.
+    save_path : pathlib.Path
+        Path to the directory where downloaded data and results are saved.
+    results : list
+        AllenConnectivity objects with computed centroids, in the order of 'configs'.
+
+    Methods
+    -------
+    run():
+        Runs the pipeline for all configurations.
+    """
+    # Filtering steps done after the shared prefix and configuration fields each of them depends on (in addition to the fields of the previous steps)
+    steps = [
+        (['hemisphere_id_to_select'], ['select_by_hemisphere']),
+        (['projection_metric'], ['zero_projection_QC']),
+        (['injection_volume_threshold'], ['injection_volume_thresholding']),
+        (['metric_for_projection_thresholding'], ['separate_by_projection_hemisphere']),
+        (['projection_volume_threshold'], ['projection_volume_thresholding', 'compute_weighted_centroids', 'save_centroids']),
+    ]
+
+    def __init__(self, configs, data_path, save_path):
+        self.configs = configs
+        self.data_path = data_path
+        self.save_path = save_path
+        self.results = [None] * len(configs)
+
+    def group_by(self, indexes, fields):
+        # Groups configuration indexes by values of the fields, preserving the order of configurations
+        groups = {}
+        for i in indexes:
+            key = json.dumps({k: v for k, v in self.configs[i].items() if k in fields}, sort_keys=True)
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+
+    def run(self):
+        step_fields = [field for fields, _ in self.steps for field in fields]
+        shared_fields = {field for config in self.configs for field in config if field not in step_fields}
+
+        for group in self.group_by(range(len(self.configs)), shared_fields):
+            print('==========================================')
+            print(f'Shared steps for {len(group)} configurations of target {self.configs[group[0]]["target_structure"]}')
+            print('==========================================')
+            connectivity = AllenConnectivity(self.configs[group[0]], self.data_path, self.save_path)
+            connectivity.areas_experiments_cross_check()
+            connectivity.remove_injection_target_overlap_areas()
+            connectivity.download_unionized_data()
+            connectivity.preload_unionized_data()
+            self.run_steps(connectivity, group, 0)
+
+        return self.results
+
+    def run_steps(self, connectivity, indexes, level):
+        fields, methods = self.steps[level]
+        groups = self.group_by(indexes, fields)
+        for group in groups:
+            # Object can be reused when there is nothing to branch, as it was created from the first configuration of the group
+            if len(groups) > 1: branch = connectivity.branch(self.configs[group[0]])
+            else: branch = connectivity
+            print('------------------------------------------')
+            print(', '.join(f'{field} = {self.configs[group[0]][field]}' for field in fields))
+            print('------------------------------------------')
+            for method in methods: getattr(branch, method)()
+
+            if level+1 < len(self.steps): self.run_steps(branch, group, level+1)
+            else:
+                # Configurations which are identical in all step fields have the same results
+                for i in group: self.results[i] = branch
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from RMALoaders import RMABatchedUnionizedData, retry_with_backoff
+
+class UnionizedDataDownloadManager:
+    """
+    A class to download unionized data of many experiments concurrently into per-experiment CSV files ('area_{area}_experiment_{e}.csv').
+    Every file is written into a temporary file first and renamed once complete. The status, row count and checksum of every downloaded experiment is recorded in a manifest file,
+    so the download can be interrupted at any point and restarted: only experiments which are not recorded as complete in the manifest are downloaded again.
+    Files without a manifest entry (downloaded by older versions of the pipeline) are adopted into the manifest if they are complete CSV files.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        Directory where the CSV files and the manifest are saved.
+    manifest : dict
+        Dictionary of the form {experiment_id: {'area': ..., 'filename': ..., 'status': ..., 'rows': ..., 'size': ..., 'sha256': ...}}.
+
+    Methods
+    -------
+    download(experiment_list):
+        Downloads all experiments from the {area_id: [experiment_id, ...]} dictionary which are not complete yet.
+    is_complete(area, experiment_id):
+        Checks if an experiment was fully downloaded.
+    """
+    manifest_filename = 'manifest.json'
+
+    def __init__(self, path, num_workers=8, experiments_per_query=10, max_retries=5, base_delay=1.0, verify_checksums=False):
+        """
+        Parameters
+        ----------
+        path : pathlib.Path
+            Directory where the CSV files are to be saved.
+        num_workers : int
+            Number of concurrent queries. Default = 8.
+        experiments_per_query : int
+            Number of experiments downloaded by one worker in one batched query. Default = 10.
+        max_retries : int
+            Number of retries of a failed query (with exponential backoff). Default = 5.
+        base_delay : float
+            Delay (in seconds) before the first retry. Default = 1.
+        verify_checksums : bool
+            Specify 'True' to recompute checksums of existing files instead of only comparing their size with the manifest. Default = False.
+        """
+        self.path = path
+        self.num_workers = num_workers
+        self.experiments_per_query = experiments_per_query
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.verify_checksums = verify_checksums
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.path): os.makedirs(self.path)
+        self.remove_partial_files()
+        self.manifest = self.load_manifest()
+
+    def remove_partial_files(self):
+        # Leftovers of an interrupted run are never complete
+        for filename in os.listdir(self.path):
+            if filename.endswith('.part'): os.remove(self.path / filename)
+
+    def load_manifest(self):
+        if os.path.isfile(self.path / self.manifest_filename):
+            with open(self.path / self.manifest_filename, 'r') as f: return json.load(f)
+        return {}
+
+    def save_manifest(self):
+        tmp_path = self.path / (self.manifest_filename + '.part')
+        with open(tmp_path, 'w') as f: json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.path / self.manifest_filename)
+
+    def file_checksum(self, file_path):
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024**2), b''): sha256.update(block)
+        return sha256.hexdigest()
+
+    def adopt_legacy_file(self, area, experiment_id):
+        """
+        Records a file downloaded without a manifest as complete if it ends with a newline (files of older versions were written in place,
+        so an interrupted write leaves a partial last line) and can be parsed. Returns the manifest entry, or None if the file is not complete.
+        """
+        filename = f'area_{area}_experiment_{experiment_id}.csv'
+        file_path = self.path / filename
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0: return None
+        with open(file_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': return None
+        try: rows = len(pd.read_csv(file_path))
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError): return None
+        entry = {'area': int(area), 'filename': filename, 'status': 'done', 'rows': rows, 'size': os.path.getsize(file_path), 'sha256': self.file_checksum(file_path), 'timestamp': time.time()}
+        with self._lock: self.manifest[str(experiment_id)] = entry
+        return entry
+
+    def is_complete(self, area, experiment_id):
+        entry = self.manifest.get(str(experiment_id))
+        if entry is None: entry = self.adopt_legacy_file(area, experiment_id)
+        if entry is None or entry['status'] != 'done' or entry['area'] != int(area): return False
+        file_path = self.path / entry['filename']
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != entry['size']: return False
+        if self.verify_checksums: return self.file_checksum(file_path) == entry['sha256']
+        return True
+
+    def write_experiment(self, area, experiment_id, data):
+        filename = f'area_{area}_experiment_{experiment_id}.csv'
+        tmp_path = self.path / (filename + '.part')
+        data.to_csv(tmp_path)
+        entry = {'area': int(area), 'filename': filename, 'status': 'done', 'rows': len(data), 'size': os.path.getsize(tmp_path), 'sha256': self.file_checksum(tmp_path), 'timestamp': time.time()}
+        os.replace(tmp_path, self.path / filename)
+        return entry
+
+    def download_batch(self, batch):
+        data = retry_with_backoff(lambda: RMABatchedUnionizedData(experiment_ids=[e for _, e in batch], experiments_per_query=len(batch), cached=False).data, max_retries=self.max_retries, base_delay=self.base_delay)
+        return {str(e): self.write_experiment(area, e, data[e]) for area, e in batch}
+
+    def download(self, experiment_list):
+        """
+        Downloads unionized data for all experiments which are not complete yet.
+
+            Parameters:
+                experiment_list (dict): experiments in the form {area_id_1: [experiment_id_1, experiment_id_2, ...], ...}.
+
+            Returns:
+                failed (list): IDs of experiments which could not be downloaded.
+        """
+        num_entries = len(self.manifest)
+        pending = [(area, e) for area, experiments in experiment_list.items() for e in experiments if not self.is_complete(area, e)]
+        if len(self.manifest) > num_entries:
+            print(f'{len(self.manifest)-num_entries} previously downloaded files added to the manifest.')
+            self.save_manifest()
+        total = sum(len(experiments) for experiments in experiment_list.values())
+        print(f'{total-len(pending)} experiments already downloaded, {len(pending)} experiments to download.')
+        if len(pending) == 0: return []
+
+        batches = [pending[i:i+self.experiments_per_query] for i in range(0, len(pending), self.experiments_per_query)]
+        failed = []
+        num_rows = 0
+        num_bytes = 0
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool, tqdm(total=len(pending), desc='Downloading', unit='exp') as progress:
+            futures = {pool.submit(self.download_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    entries = future.result()
+                except Exception as e:
+                    entries = {str(exp): {'area': int(area), 'filename': None, 'status': 'failed', 'error': f'{type(e).__name__}: {e}', 'timestamp': time.time()} for area, exp in batch}
+                    failed += [exp for _, exp in batch]
+
+                with self._lock:
+                    self.manifest.update(entries)
+                    self.save_manifest()
+
+                num_rows += sum(entry.get('rows', 0) for entry in entries.values())
+                num_bytes += sum(entry.get('size', 0) for entry in entries.values())
+                elapsed = time.time() - start_time
+                progress.update(len(batch))
+                progress.set_postfix(rows_per_s=f'{num_rows/elapsed:.0f}', MB_per_s=f'{num_bytes/elapsed/1024**2:.2f}', failed=len(failed))
+
+        elapsed = time.time() - start_time
+        print(f'{len(pending)-len(failed)} experiments ({num_rows} rows, {num_bytes/1024**2:.1f} MB) downloaded in {elapsed:.1f} s ({(len(pending)-len(failed))/elapsed:.2f} experiments/s).')
+        if failed: print(f'{len(failed)} experiments failed and will be retried on the next run: {failed}')
+        return failed
@@ -0,0 +1,70 @@
+import re
+import numpy as np
+
+class InjectionStructureIndex:
+    """
+    A compact index of injection structures of experiments, parsed once from the 'injection-structures' column of experiment metadata
+    (strings of the form '[{"abbreviation"=>"VISp", "id"=>385, ...}, ...]').
+    Structure IDs of all experiments are stored in one flat array with experiment offsets (experiment i has structures structure_ids[ptr[i]:ptr[i+1]]),
+    and an inverted index (structure IDs sorted with the positions of their experiments) allows to find experiments injected into given structures.
+
+    Attributes
+    ----------
+    experiment_ids : numpy.ndarray
+        IDs of experiments in the order of metadata rows.
+    ptr : numpy.ndarray
+        Offsets of the structures of every experiment in 'structure_ids'.
+    structure_ids : numpy.ndarray
+        Injection structure IDs of all experiments.
+
+    Methods
+    -------
+    structures_of(experiment_id):
+        Returns injection structure IDs of an experiment.
+    experiments_injected_into(structure_ids, ontology=None):
+        Returns IDs of experiments with any of the structures (or, if an ontology index is passed, any of their descendants) among injection structures.
+    """
+    id_pattern = re.compile(r'"id"\s*=>\s*(\d+)')
+
+    def __init__(self, experiment_metadata):
+        """
+        Parameters
+        ----------
+        experiment_metadata : pandas.DataFrame
+            Experiment metadata with 'id' and 'injection-structures' columns.
+        """
+        parsed = [[int(x) for x in self.id_pattern.findall(s)] if isinstance(s, str) else [] for s in experiment_metadata['injection-structures']]
+        self.experiment_ids = experiment_metadata['id'].to_numpy(dtype=np.int64)
+        self.ptr = np.concatenate([[0], np.cumsum([len(structures) for structures in parsed])]).astype(np.int64)
+        self.structure_ids = np.array([x for structures in parsed for x in structures], dtype=np.int64)
+        self.experiment_positions = {e: i for i, e in enumerate(self.experiment_ids.tolist())}
+
+        # Inverted index: positions (in metadata) of experiments for every entry of structure_ids, sorted by structure ID
+        row_experiments = np.repeat(np.arange(len(self.experiment_ids)), np.diff(self.ptr))
+        order = np.argsort(self.structure_ids, kind='stable')
+        self.sorted_structure_ids = self.structure_ids[order]
+        self.sorted_experiment_positions = row_experiments[order]
+
+    def structures_of(self, experiment_id):
+        i = self.experiment_positions[int(experiment_id)]
+        return self.structure_ids[self.ptr[i]:self.ptr[i+1]]
+
+    def experiments_injected_into(self, structure_ids, ontology=None):
+        """
+        Returns IDs of experiments which have any of the structures among their injection structures.
+
+            Parameters:
+                structure_ids (int or list): structure ID(s).
+                ontology (OntologyIndex): if passed, injections into descendants of the structures are matched as well.
+
+            Returns:
+                experiment_ids (numpy.ndarray): IDs of matching experiments (in the order of metadata rows).
+        """
+        structure_ids = np.atleast_1d(np.asarray(structure_ids, dtype=np.int64))
+        if ontology is None:
+            starts = np.searchsorted(self.sorted_structure_ids, structure_ids, side='left')
+            ends = np.searchsorted(self.sorted_structure_ids, structure_ids, side='right')
+            positions = np.concatenate([self.sorted_experiment_positions[s:e] for s, e in zip(starts, ends)] + [np.array([], dtype=np.int64)])
+        else:
+            positions = self.sorted_experiment_positions[ontology.is_descendant(self.sorted_structure_ids, structure_ids)]
+        return self.experiment_ids[np.unique(positions)]
@@ -0,0 +1,197 @@
+"""
+Ontology index of the Allen Mouse Brain Atlas (structure graph) for fast structure lookups.
+This module does not import allensdk: the index is built in RMALoaders.py ('get_ontology') and stored in the RMA cache,
+from which it can also be read without allensdk ('cached_ontology'), e.g. in the brainrender environment of the visualisers.
+"""
+
+import numpy as np
+from RMACache import RMACache
+
+def ontology_cache_key(graph_id):
+    # Key of the built index in the RMA cache
+    return ('OntologyIndex', graph_id)
+
+def build_ontology_index(structures):
+    """
+    Builds the arrays of an ontology index (see OntologyIndex) from records of all structures of a structure graph (with their 'structure_sets').
+    """
+    structures = sorted(structures, key=lambda x: (x.get('graph_order') is None, x.get('graph_order'), x['id']))
+    by_id = {x['id']: x for x in structures}
+    children = {x['id']: [] for x in structures}
+    roots = []
+    for x in structures:
+        if x['parent_structure_id'] in children: children[x['parent_structure_id']].append(x['id'])
+        else: roots.append(x['id'])
+
+    # Iterative depth-first traversal (children in graph order) gives the pre-order and the end of every subtree
+    order = []
+    subtree_end = {}
+    stack = [(root, False) for root in reversed(roots)]
+    while stack:
+        structure_id, visited = stack.pop()
+        if visited:
+            subtree_end[structure_id] = len(order)
+            continue
+        order.append(structure_id)
+        stack.append((structure_id, True))
+        stack += [(child, False) for child in reversed(children[structure_id])]
+
+    positions = {structure_id: i for i, structure_id in enumerate(order)}
+    parents = np.array([positions.get(by_id[i]['parent_structure_id'], -1) for i in order], dtype=np.int64)
+    depths = np.zeros(len(order), dtype=np.int64)
+    for i in range(len(order)):
+        if parents[i] >= 0: depths[i] = depths[parents[i]] + 1
+    children_counts = np.array([len(children[i]) for i in order], dtype=np.int64)
+
+    structure_sets = {}
+    for structure_id in order:
+        for structure_set in by_id[structure_id].get('structure_sets', []): structure_sets.setdefault(structure_set['id'], []).append(structure_id)
+
+    return {
+        'ids': np.array(order, dtype=np.int64),
+        'acronyms': np.array([by_id[i]['acronym'] for i in order], dtype=object),
+        'names': np.array([by_id[i]['name'] for i in order], dtype=object),
+        'parents': parents,
+        'depths': depths,
+        'subtree_end': np.array([subtree_end[i] for i in order], dtype=np.int64),
+        'children_ptr': np.concatenate([[0], np.cumsum(children_counts)]).astype(np.int64),
+        'children': np.array([positions[c] for i in order for c in children[i]], dtype=np.int64),
+        'structure_sets': {k: np.array(v, dtype=np.int64) for k, v in structure_sets.items()},
+        'records': {i: {k: v for k, v in by_id[i].items() if k != 'structure_sets'} for i in order},
+    }
+
+class OntologyIndex:
+    """
+    An in-memory index of the Allen Mouse Brain Atlas ontology (structure graph), built by 'build_ontology_index' from the structures of a single bulk RMA query.
+    Structures are stored in arrays in pre-order (depth-first) of the structure tree, so that descendants of a structure occupy a contiguous range of positions [i, subtree_end[i]).
+
+    Attributes
+    ----------
+    graph_id : int
+        ID of the structure graph (1 = Adult Mouse Brain).
+    ids : numpy.ndarray
+        IDs of structures in pre-order.
+    acronyms : numpy.ndarray
+        Acronyms of structures.
+    names : numpy.ndarray
+        Full names of structures.
+    parents : numpy.ndarray
+        Position of the parent of every structure (-1 for the root).
+    depths : numpy.ndarray
+        Depth of every structure in the tree (0 for the root).
+    subtree_end : numpy.ndarray
+        Position after the last descendant of every structure.
+    children_ptr, children : numpy.ndarray
+        Positions of children of structure at position i are children[children_ptr[i]:children_ptr[i+1]].
+    structure_sets : dict
+        Dictionary of the form {structure_set_id: numpy.ndarray of structure IDs}.
+
+    Methods
+    -------
+    position(ids):
+        Returns positions of structure IDs in the arrays (vectorized).
+    acronym(id), name(id), id_from_acronym(acronym), id_from_name(name):
+        Single structure lookups.
+    parent(id), children_of(id), depth(id), ancestors(id), structure_path(id):
+        Tree lookups.
+    descendants(id, include_self=True):
+        Returns IDs of all descendants of a structure.
+    is_descendant(ids, ancestor_ids, include_self=True):
+        Returns a boolean array marking the IDs which are descendants of any of the ancestor IDs (vectorized).
+    acronym_map(ids=None):
+        Returns {id: acronym} dictionary.
+    """
+    def __init__(self, index, graph_id=1):
+        self.graph_id = graph_id
+        for attribute, value in index.items(): setattr(self, attribute, value)
+        self.id_positions = dict(zip(self.ids.tolist(), range(len(self.ids))))
+        self.acronym_positions = dict(zip(self.acronyms.tolist(), range(len(self.ids))))
+        self.name_positions = dict(zip(self.names.tolist(), range(len(self.ids))))
+        self.sorted_order = np.argsort(self.ids)
+
+    def position(self, ids):
+        """
+        Returns positions of structures in the index arrays. Accepts a single ID or an array of IDs.
+        """
+        if np.isscalar(ids): return self.id_positions[int(ids)]
+        ids = np.asarray(ids, dtype=np.int64)
+        sorted_positions = np.searchsorted(self.ids, ids, sorter=self.sorted_order)
+        sorted_positions[sorted_positions == len(self.ids)] = 0
+        positions = self.sorted_order[sorted_positions]
+        if len(positions) and (self.ids[positions] != ids).any(): raise KeyError(f'Structures not in the ontology: {ids[self.ids[positions] != ids].tolist()}')
+        return positions
+
+    def __contains__(self, structure_id):
+        return int(structure_id) in self.id_positions
+
+    def record(self, structure_id):
+        return self.records[int(structure_id)]
+
+    def acronym(self, structure_id):
+        return self.acronyms[self.id_positions[int(structure_id)]]
+
+    def name(self, structure_id):
+        return self.names[self.id_positions[int(structure_id)]]
+
+    def id_from_acronym(self, acronym):
+        return int(self.ids[self.acronym_positions[acronym]])
+
+    def id_from_name(self, name):
+        return int(self.ids[self.name_positions[name]])
+
+    def parent(self, structure_id):
+        parent = self.parents[self.id_positions[int(structure_id)]]
+        return None if parent < 0 else int(self.ids[parent])
+
+    def children_of(self, structure_id):
+        i = self.id_positions[int(structure_id)]
+        return self.ids[self.children[self.children_ptr[i]:self.children_ptr[i+1]]]
+
+    def depth(self, structure_id):
+        return int(self.depths[self.id_positions[int(structure_id)]])
+
+    def ancestors(self, structure_id):
+        """
+        Returns IDs of all structures on the path from the root to the structure (inclusive), as in 'structure_id_path'.
+        """
+        path = []
+        i = self.id_positions[int(structure_id)]
+        while i >= 0:
+            path.append(int(self.ids[i]))
+            i = self.parents[i]
+        return path[::-1]
+
+    def structure_path(self, structure_id):
+        return '/'.join(self.acronym(i) for i in self.ancestors(structure_id))
+
+    def descendants(self, structure_id, include_self=True):
+        i = self.id_positions[int(structure_id)]
+        return self.ids[i if include_self else i+1:self.subtree_end[i]]
+
+    def is_descendant(self, ids, ancestor_ids, include_self=True):
+        """
+        Returns a boolean array which is True for structures in 'ids' that are descendants of any of the structures in 'ancestor_ids'. Structures which are not in the ontology are never descendants.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        known = np.isin(ids, self.ids)
+        positions = np.full(len(ids), -1, dtype=np.int64)
+        positions[known] = self.position(ids[known])
+        mask = np.zeros(len(ids), dtype=bool)
+        for ancestor in self.position(np.atleast_1d(ancestor_ids)):
+            start = ancestor if include_self else ancestor+1
+            mask |= (positions >= start) & (positions < self.subtree_end[ancestor])
+        return mask
+
+    def structure_set(self, structure_set_id):
+        return self.structure_sets.get(structure_set_id, np.array([], dtype=np.int64))
+
+    def acronym_map(self, ids=None):
+        if ids is None: return dict(zip(self.ids.tolist(), self.acronyms.tolist()))
+        return {int(i): self.acronym(i) for i in ids}
+
+def cached_ontology(graph_id=1, cache=None):
+    """
+    Returns the ontology index of a structure graph stored in the RMA cache, or None if it has not been built yet (see get_ontology in RMALoaders.py).
+    """
+    found, index = (cache or RMACache()).get(ontology_cache_key(graph_id))
+    return OntologyIndex(index, graph_id) if found else None
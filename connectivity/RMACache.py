@@ -0,0 +1,185 @@
+import os
+import re
+import time
+import zlib
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('ALLEN_RMA_CACHE_DIR', Path.home() / '.allen_data_mining' / 'rma_cache'))
+
+class RMACache:
+    """
+    A persistent on-disk cache for RMA query responses.
+    Every entry is stored as a separate zlib-compressed pickle file named after the queried model and a hash of the query key.
+    The modification time of an entry file is used as its last access time, which allows LRU eviction without a separate index file.
+
+    Attributes
+    ----------
+    cache_dir : pathlib.Path
+        Directory where cached responses are stored.
+    max_size_bytes : int
+        Total size of the cache on disk after which the least recently used entries are evicted.
+    ttl : float or None
+        Time (in seconds) after which an entry is considered stale and queried again. No expiry if None.
+    hits : int
+        Number of queries served from the cache.
+    misses : int
+        Number of queries which had to be sent to the Allen API.
+    evictions : int
+        Number of entries removed to keep the cache within 'max_size_bytes'.
+
+    Methods
+    -------
+    get(key):
+        Returns a tuple (found, value) for a given query key.
+    put(key, value):
+        Stores the value for a given query key.
+    fetch(key, query_function):
+        Returns the cached value or calls 'query_function' and caches its output.
+    invalidate(key=None, model=None):
+        Removes a single entry, all entries of a model or the whole cache.
+    stats():
+        Returns hit/miss counters and the current size of the cache.
+    """
+    suffix = '.pkl.z'
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size_bytes=2*1024**3, ttl=None):
+        """
+        Parameters
+        ----------
+        cache_dir : str or pathlib.Path
+            Directory where cached responses are stored. Default is '~/.allen_data_mining/rma_cache' (can be overridden with 'ALLEN_RMA_CACHE_DIR' environment variable).
+        max_size_bytes : int
+            Size limit of the cache on disk. Default = 2 GB.
+        ttl : float
+            Time to live of the entries in seconds. Default = None (entries never expire).
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = max_size_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    @staticmethod
+    def make_key(model, criteria=None, include=None, start_row=None, num_rows=None, **kwargs):
+        """
+        Builds a hashable key from the parameters of an RMA model query.
+        """
+        return (model, criteria, include, start_row, num_rows) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+    def _entry_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.cache_dir / f'{self._model_prefix(key[0])}_{digest}{self.suffix}'
+
+    def _model_prefix(self, model):
+        return re.sub(r'[^A-Za-z0-9.-]', '-', str(model))
+
+    def _entries(self, model=None):
+        prefix = self._model_prefix(model)+'_' if model else ''
+        return [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name.startswith(prefix) and entry.name.endswith(self.suffix)]
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock: self._size -= size
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f: payload = pickle.loads(zlib.decompress(f.read()))
+        except (FileNotFoundError, zlib.error, pickle.UnpicklingError, EOFError):
+            with self._lock: self.misses += 1
+            return False, None
+
+        # Guarding against hash collisions and expired entries
+        if payload['key'] != key or (self.ttl is not None and time.time() - payload['created'] > self.ttl):
+            if payload['key'] == key: self._remove(path)
+            with self._lock: self.misses += 1
+            return False, None
+
+        # Touching the file marks it as recently used for LRU eviction
+        try: os.utime(path)
+        except FileNotFoundError: pass
+        with self._lock: self.hits += 1
+        return True, payload['value']
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        data = zlib.compress(pickle.dumps({'key': key, 'created': time.time(), 'value': value}, protocol=pickle.HIGHEST_PROTOCOL))
+
+        # Writing into a temporary file first, so that an interrupted write never leaves a corrupted entry
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}_{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f: f.write(data)
+        old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock: self._size += len(data) - old_size
+        if self._size > self.max_size_bytes: self.evict()
+
+    def fetch(self, key, query_function):
+        found, value = self.get(key)
+        if not found:
+            value = query_function()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits into 'max_size_bytes'.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self._size <= self.max_size_bytes: break
+            self._remove(entry.path)
+            with self._lock: self.evictions += 1
+
+    def invalidate(self, key=None, model=None):
+        """
+        Removes the entry for a given key, all entries of a given model or, if neither is specified, the whole cache.
+        """
+        if key is not None:
+            self._remove(self._entry_path(key))
+        else:
+            for entry in self._entries(model): self._remove(entry.path)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries()), 'size_bytes': self._size}
+
+class CachedRmaApi:
+    """
+    A wrapper around RmaApi which serves model queries from RMACache and only sends queries to the Allen API on cache misses.
+
+    Attributes
+    ----------
+    api : allensdk.api.queries.rma_api.RmaApi
+        API object used for queries which are not cached yet.
+    cache : RMACache
+        Cache storing query responses.
+    """
+    def __init__(self, api, cache=None):
+        self.api = api
+        self.cache = cache if cache is not None else RMACache()
+
+    def model_query(self, model, **kwargs):
+        key = RMACache.make_key(model, **kwargs)
+        return self.cache.fetch(key, lambda: self.api.model_query(model, **kwargs))
+
+    def invalidate(self, model=None, **kwargs):
+        """
+        Removes a cached response of a particular query if query parameters are specified, otherwise all responses of a model (or the whole cache if model is None).
+        """
+        if model and kwargs: self.cache.invalidate(key=RMACache.make_key(model, **kwargs))
+        else: self.cache.invalidate(model=model)
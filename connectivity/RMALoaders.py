@@ -1,12 +1,69 @@
 from allensdk.api.queries.rma_api import RmaApi
 from allensdk.api.queries.ontologies_api import OntologiesApi
+import time
+import random
+import threading
+import numpy as np
 import pandas as pd
+from RMACache import RMACache, CachedRmaApi
+from Ontology import OntologyIndex, build_ontology_index, ontology_cache_key
 
-rma = RmaApi()
+# All model queries are served from the on-disk cache (hit/miss counters are available through rma.cache.stats())
+rma = CachedRmaApi(RmaApi(), RMACache())
+
+def retry_with_backoff(query_function, max_retries=5, base_delay=1.0, max_delay=60.0):
+    """
+    Calls 'query_function' and retries it after an exponentially growing (randomised) delay if it raises an exception.
+    The exception is re-raised once 'max_retries' retries have failed.
+    """
+    for attempt in range(max_retries+1):
+        try:
+            return query_function()
+        except Exception as e:
+            if attempt == max_retries: raise
+            delay = min(max_delay, base_delay * 2**attempt) * random.uniform(0.5, 1)
+            print(f'Query failed ({type(e).__name__}: {e}), retrying in {delay:.1f} s.')
+            time.sleep(delay)
+
+class RateLimiter:
+    """
+    A thread-safe client-side limiter of the query rate (token bucket). 'wait()' blocks until a query can be sent without exceeding 'rate' queries per second on average,
+    allowing bursts of up to 'burst' queries.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+_ontologies = {}
+
+def get_ontology(graph_id=1):
+    """
+    Returns the ontology index of a structure graph, which is loaded once per process.
+    """
+    if graph_id not in _ontologies:
+        # The index is built from one bulk query of all structures and stored in the RMA cache, so it is only queried and built once
+        query = lambda: build_ontology_index(rma.api.model_query('Structure', criteria=f'[graph_id$eq{graph_id}]', include='structure_sets', num_rows='all'))
+        _ontologies[graph_id] = OntologyIndex(rma.cache.fetch(ontology_cache_key(graph_id), query), graph_id)
+    return _ontologies[graph_id]
 
 class RMAStructure:
     """
-    A class to represent Allen Atlas structures accessed with RMA queries.
+    A class to represent Allen Atlas structures. Structures are looked up in the ontology index (see OntologyIndex), which is built from one bulk RMA query.
     More info: http://help.brain-map.org/display/api/RESTful+Model+Access+(RMA)
 
     Attributes
@@ -18,7 +75,7 @@ class RMAStructure:
     full_name : str
         Complete name of the structure.
     full_query : dict
-        Full length query RMA output.
+        Full length query RMA output (in the format of 'StructureLookup' model).
     structure_path : str
         Specifies hierarchical organisation of parent structures. Available after 'get_structure_path()' method is called.
         
@@ -29,7 +86,7 @@ class RMAStructure:
     """
     def __init__(self, id=None, acronym=None):
         """
-        Queries structure ID or acronym based on the parameter provided.
+        Looks up structure ID or acronym based on the parameter provided.
 
         Parameters
         ----------
@@ -42,11 +99,12 @@ class RMAStructure:
         self.acronym = acronym
         self.structure_path = None
 
+        ontology = get_ontology()
         if self.id:
-            self.full_query = rma.model_query('StructureLookup', criteria="structure[id$eq"+str(self.id)+"]",include="structure")[0]
+            self.full_query = {'structure': ontology.record(self.id)}
             self.acronym = self.full_query['structure']['acronym']
         elif self.acronym:
-            self.full_query = rma.model_query('StructureLookup', criteria="structure[acronym$eq"+self.acronym+"]",include="structure")[0]
+            self.full_query = {'structure': ontology.record(ontology.id_from_acronym(self.acronym))}
             self.id = self.full_query['structure']['id']
         else:
             print('ID or acronym of structure not provided.')
@@ -54,9 +112,7 @@ class RMAStructure:
         self.full_name = self.full_query['structure']['name']
         
     def get_structure_path(self):
-        id_path = self.full_query['structure']['structure_id_path']
-        path_acronyms = [RMAStructure(id=area_id).acronym for area_id in id_path.split('/')[1:-1]]
-        self.structure_path = '/'.join(path_acronyms)
+        self.structure_path = get_ontology().structure_path(self.id)
         return self.structure_path
     
 class RMAStructureSet:
@@ -67,7 +123,7 @@ class RMAStructureSet:
     Attributes
     ----------
     structure_sets : pandas.DataFrame
-        Table with all available structure sets.
+        Table with all available structure sets (queried when first accessed).
     structure_set : pandas.DataFrame
         Table with all structures in a given structre set. Available after 'get_structure_set()' method is called.
     
@@ -80,10 +136,16 @@ class RMAStructureSet:
     
     """
     def __init__(self):
-        oapi = OntologiesApi()
-        self.structure_sets = pd.DataFrame(oapi.get_structure_sets())
+        self._structure_sets = None
         self.structure_set = None
 
+    @property
+    def structure_sets(self):
+        if self._structure_sets is None:
+            oapi = OntologiesApi()
+            self._structure_sets = pd.DataFrame(rma.cache.fetch(('OntologiesApi.get_structure_sets',), oapi.get_structure_sets))
+        return self._structure_sets
+
     def get_all_structure_sets(self):
         return self.structure_sets
     
@@ -140,6 +202,78 @@ class RMAUnionizedData:
             else:
                 self.data = pd.DataFrame(rma.model_query("ProjectionStructureUnionize", criteria=criteria_query, start_row=start_row,num_rows=num_rows))
         
+class RMABatchedUnionizedData:
+    """
+    A class for querying unionized data of many experiments with a small number of RMA queries.
+    Experiments are grouped into 'section_data_set_id$in' queries, each query is paginated and the result is split back per experiment.
+
+    Attributes
+    ----------
+    data : dict
+        Dictionary of the form {experiment_id: pandas.DataFrame} with unionized data of each experiment.
+    num_queries : int
+        Number of RMA queries (pages) issued.
+    """
+    def __init__(self, experiment_ids=None, is_injection=False, structure_ids=None, experiments_per_query=100, page_size=5000, cached=True):
+        """
+        Constructs batched RMA queries and retrieves unionized data.
+
+        Parameters
+        ----------
+        experiment_ids : list of int
+            IDs of experiments to query.
+        is_injection : bool
+            Specify 'True' for unionized data uniquely from the injection structures to be returned.
+        structure_ids : list of int
+            Specify IDs of structures which the unionized data is to be returned for. Default = None (all structures).
+        experiments_per_query : int
+            Number of experiments combined in one query. Default = 100.
+        page_size : int
+            Number of rows returned by a single page of the query. Default = 5000.
+        cached : bool
+            Specify 'False' to bypass the RMA response cache (e.g., for bulk downloads which are saved to disk anyway). Default = True.
+        """
+        self.data = {}
+        self.num_queries = 0
+        self.query_function = rma.model_query if cached else rma.api.model_query
+
+        if not experiment_ids:
+            print('Experiment IDs were not provided.')
+        else:
+            experiment_ids = [int(e) for e in experiment_ids]
+            if is_injection: is_injection='true'
+            else: is_injection='false'
+
+            structure_query = ''
+            if structure_ids: structure_query = f'[structure_id$in{",".join(str(int(s)) for s in sorted(set(structure_ids)))}]'
+
+            frames = []
+            for i in range(0, len(experiment_ids), experiments_per_query):
+                batch = experiment_ids[i:i+experiments_per_query]
+                criteria_query = f'[is_injection$eq{is_injection}][section_data_set_id$in{",".join(str(e) for e in batch)}]' + structure_query
+                frames += self.query_pages(criteria_query, page_size)
+
+            all_data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            if len(all_data) == 0:
+                self.data = {e: pd.DataFrame() for e in experiment_ids}
+            else:
+                grouped = {e: df.reset_index(drop=True) for e, df in all_data.groupby('section_data_set_id', sort=False)}
+                self.data = {e: grouped.get(e, all_data.iloc[:0].reset_index(drop=True)) for e in experiment_ids}
+
+    def query_pages(self, criteria_query, page_size):
+        """
+        Returns a list of DataFrames, one per page of the query. Pages are ordered by the unionize ID, so that the pagination is stable.
+        """
+        pages = []
+        start_row = 0
+        while True:
+            page = self.query_function("ProjectionStructureUnionize", criteria=criteria_query, start_row=start_row, num_rows=page_size, order=["'id'"])
+            self.num_queries += 1
+            if len(page) > 0: pages.append(pd.DataFrame(page))
+            if len(page) < page_size: break
+            start_row += page_size
+        return pages
+
 class RMAExpressionData:
     """
     A class for querying expression (ISH) data from Allen database.
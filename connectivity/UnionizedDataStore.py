@@ -0,0 +1,224 @@
+import os
+import re
+import sys
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+class UnionizedDataStore:
+    """
+    A consolidated on-disk store (HDF5 table) for unionized data of many experiments.
+    Rows of every experiment are appended contiguously, together with 'experiment_id' and 'area' (source structure of the experiment) columns.
+    The experiments table records the first row and the number of rows of every experiment, so rows of an interrupted append (which have no experiments entry) are never read.
+    Experiment, area, structure and hemisphere columns are indexed, so only the rows matching a query are read from disk.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        Path to the HDF5 file.
+
+    Methods
+    -------
+    experiments():
+        Returns a table of experiments contained in the store with their areas, first rows and number of rows.
+    append(area, experiment_id, data):
+        Appends unionized data of one experiment.
+    load(experiment_ids=None, areas=None, structure_ids=None, hemisphere_ids=None, is_injection=None, columns=None):
+        Reads the rows matching the specified filters into a long-format DataFrame.
+    import_csv_directory(csv_path):
+        Imports 'area_{area}_experiment_{e}.csv' files which are not in the store yet.
+    repair(store):
+        Removes rows which belong to no experiment entry (left by an interrupted append) and records first rows of stores written without them.
+    """
+    data_key = 'unionized_data'
+    experiments_key = 'experiments'
+    data_columns = ['experiment_id', 'area', 'structure_id', 'hemisphere_id', 'is_injection']
+    int_columns = ['experiment_id', 'area', 'id', 'section_data_set_id', 'structure_id', 'hemisphere_id']
+    csv_filename_pattern = re.compile(r'area_(\d+)_experiment_(\d+)\.csv$')
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def open(self, mode='r'):
+        return pd.HDFStore(self.path, mode=mode, complevel=5, complib='blosc')
+
+    def experiments(self):
+        if not self.exists(): return self.empty_experiments()
+        with self.open() as store: return self.read_experiments(store)
+
+    def empty_experiments(self):
+        return pd.DataFrame({'experiment_id': [], 'area': [], 'start': [], 'rows': []}, dtype=np.int64)
+
+    def read_experiments(self, store):
+        if '/'+self.experiments_key not in store.keys(): return self.empty_experiments()
+        experiments = store.select(self.experiments_key).reset_index(drop=True)
+        # Stores written before first rows were recorded: experiments follow each other without gaps
+        if 'start' not in experiments.columns: experiments.insert(2, 'start', np.concatenate([[0], np.cumsum(experiments['rows'].values)[:-1]]).astype(np.int64))
+        return experiments
+
+    def num_rows(self, store):
+        return store.get_storer(self.data_key).nrows if '/'+self.data_key in store.keys() else 0
+
+    def is_consistent(self, store):
+        # Every row of the data table belongs to exactly one experiment entry, and first rows are recorded
+        if '/'+self.experiments_key in store.keys() and 'start' not in store.select(self.experiments_key, start=0, stop=0).columns: return False
+        experiments = self.read_experiments(store)
+        return int(experiments['rows'].sum()) == self.num_rows(store) and np.array_equal(experiments['start'].values, np.concatenate([[0], np.cumsum(experiments['rows'].values)[:-1]]))
+
+    def recorded_starts(self, store, experiments):
+        # First rows of experiments; stores written before they were recorded are matched against the experiment_id column,
+        # an experiment takes the last 'rows' rows of its run of ids (rows of an interrupted append of the same experiment come first)
+        if 'start' in store.select(self.experiments_key, start=0, stop=0).columns: return experiments['start'].values
+        ids = store.select_column(self.data_key, 'experiment_id').values
+        starts = np.zeros(len(experiments), dtype=np.int64)
+        position = 0
+        for i, (experiment_id, rows) in enumerate(zip(experiments['experiment_id'].values, experiments['rows'].values)):
+            found = np.flatnonzero(ids[position:] == experiment_id)
+            if rows == 0 or len(found) == 0:
+                starts[i] = position
+                continue
+            run_start = position + found[0]
+            different = np.flatnonzero(ids[run_start:] != experiment_id)
+            run_end = run_start + (different[0] if len(different) else len(ids) - run_start)
+            starts[i], position = run_end - rows, run_end
+        return starts
+
+    def repair(self, store):
+        """
+        Removes rows of the data table which belong to no experiment entry (rows of an append interrupted before its experiment entry was written)
+        and rewrites the experiments table with first rows of experiments.
+        """
+        experiments = self.read_experiments(store)
+        num_rows = self.num_rows(store)
+        if len(experiments) > 0: experiments['start'] = self.recorded_starts(store, experiments)
+        covered = np.zeros(num_rows, dtype=bool)
+        for start, rows in zip(experiments['start'].values, experiments['rows'].values): covered[start:start+rows] = True
+        orphans = np.flatnonzero(~covered)
+        if len(orphans) > 0:
+            print(f'Removing {len(orphans)} rows of interrupted appends from {self.path}.')
+            # Contiguous ranges of orphan rows, removed from the end so that positions of the remaining ranges do not change
+            breaks = np.flatnonzero(np.diff(orphans) > 1)
+            table = store.get_storer(self.data_key).table
+            for first, last in reversed(list(zip(orphans[np.concatenate([[0], breaks+1])], orphans[np.concatenate([breaks, [len(orphans)-1]])]))):
+                table.remove_rows(int(first), int(last)+1)
+            experiments['start'] -= np.searchsorted(orphans, experiments['start'].values)
+        experiments = experiments.sort_values('start', kind='stable').reset_index(drop=True)
+        if '/'+self.experiments_key in store.keys(): store.remove(self.experiments_key)
+        if len(experiments) > 0: store.append(self.experiments_key, experiments.astype(np.int64), format='table', data_columns=['experiment_id'], index=False)
+        self.create_index(store)
+
+    def format_data(self, area, experiment_id, data, columns=None):
+        """
+        Adds experiment and area columns and casts all columns to fixed types, so that every experiment can be appended to the same table.
+        """
+        data = data.drop(columns=[c for c in data.columns if c.startswith('Unnamed:')])
+        data = data.assign(experiment_id=int(experiment_id), area=int(area))
+        for column in data.columns:
+            if column in self.int_columns: data[column] = data[column].astype(np.int64)
+            elif data[column].dtype == bool: continue
+            elif data[column].dtype == object and column != 'is_injection': data = data.drop(columns=column)
+            elif column == 'is_injection': data[column] = data[column].astype(str).str.lower() == 'true'
+            else: data[column] = data[column].astype(np.float64)
+        if columns is not None: data = data.reindex(columns=columns)
+        return data.reset_index(drop=True)
+
+    def append(self, area, experiment_id, data, store=None):
+        """
+        Appends unionized data of a single experiment (as returned by RMAUnionizedData) to the store.
+        """
+        if store is None:
+            with self.open('a') as store:
+                self.append(area, experiment_id, data, store)
+                self.create_index(store)
+            return
+
+        if not self.is_consistent(store): self.repair(store)
+        if '/'+self.data_key in store.keys(): columns = list(store.select(self.data_key, start=0, stop=0).columns)
+        else: columns = None
+        data = self.format_data(area, experiment_id, data, columns)
+        # The experiment entry is written after its rows, with the first row recorded before them: rows of an interrupted append are never assigned to an experiment
+        start = self.num_rows(store)
+        store.append(self.data_key, data, format='table', data_columns=self.data_columns, index=False)
+        store.append(self.experiments_key, pd.DataFrame({'experiment_id': [int(experiment_id)], 'area': [int(area)], 'start': [start], 'rows': [len(data)]}), format='table', data_columns=['experiment_id'], index=False)
+
+    def create_index(self, store):
+        if '/'+self.data_key in store.keys(): store.create_table_index(self.data_key, columns=self.data_columns, optlevel=9, kind='full')
+
+    def load(self, experiment_ids=None, areas=None, structure_ids=None, hemisphere_ids=None, is_injection=None, columns=None):
+        """
+        Reads unionized data matching all of the specified filters. Filters which are None are not applied.
+        Experiment and area filters select the recorded row ranges of experiments, structure and hemisphere filters only read the filtered columns, so that only the matching rows are read in full.
+        A store left inconsistent by an interrupted append is repaired first.
+
+            Parameters:
+                experiment_ids (list): IDs of experiments to read.
+                areas (list): IDs of source areas of experiments to read.
+                structure_ids (list): IDs of structures to read the rows for.
+                hemisphere_ids (list): hemisphere IDs to read the rows for.
+                is_injection (bool): only read injection (True) or projection (False) rows.
+                columns (list): columns to read ('experiment_id' and 'area' are always included).
+
+            Returns:
+                data (pandas.DataFrame): unionized data in long format.
+        """
+        if columns is not None: columns = ['experiment_id', 'area'] + [c for c in columns if c not in ['experiment_id', 'area']]
+
+        with self.open() as store: consistent = self.is_consistent(store)
+        if not consistent:
+            with self.open('a') as store: self.repair(store)
+
+        with self.open() as store:
+            experiments = self.read_experiments(store)
+            starts = experiments['start'].values
+            experiment_mask = np.ones(len(experiments), dtype=bool)
+            if experiment_ids is not None: experiment_mask &= np.isin(experiments['experiment_id'].values, [int(e) for e in experiment_ids])
+            if areas is not None: experiment_mask &= np.isin(experiments['area'].values, [int(a) for a in areas])
+            coordinates = [np.arange(start, start+rows) for start, rows in zip(starts[experiment_mask], experiments['rows'].values[experiment_mask])]
+            coordinates = np.concatenate(coordinates) if coordinates else np.array([], dtype=np.int64)
+
+            for column, values in [('structure_id', structure_ids), ('hemisphere_id', hemisphere_ids), ('is_injection', None if is_injection is None else [bool(is_injection)])]:
+                if values is None or len(coordinates) == 0: continue
+                column_values = store.select_column(self.data_key, column).values[coordinates]
+                coordinates = coordinates[np.isin(column_values, list(values))]
+
+            if len(coordinates) == 0: return store.select(self.data_key, start=0, stop=0, columns=columns)
+            return store.select(self.data_key, where=coordinates, columns=columns).reset_index(drop=True)
+
+    def import_csv_directory(self, csv_path):
+        """
+        Imports all 'area_{area}_experiment_{e}.csv' files from a directory which are not in the store yet.
+        If the directory contains a download manifest, only experiments recorded as complete are imported.
+        """
+        csv_path = Path(csv_path)
+        complete = None
+        if os.path.isfile(csv_path / 'manifest.json'):
+            with open(csv_path / 'manifest.json', 'r') as f: complete = {entry['filename'] for entry in json.load(f).values() if entry['status'] == 'done'}
+
+        imported = set(self.experiments()['experiment_id'])
+        files = []
+        for filename in sorted(os.listdir(csv_path)):
+            match = self.csv_filename_pattern.match(filename)
+            if match is None or (complete is not None and filename not in complete): continue
+            area, experiment_id = int(match.group(1)), int(match.group(2))
+            if experiment_id not in imported: files.append((area, experiment_id, filename))
+
+        if len(files) == 0: return 0
+        with self.open('a') as store:
+            if not self.is_consistent(store): self.repair(store)
+            for area, experiment_id, filename in tqdm(files, 'Importing unionized data into the store'):
+                self.append(area, experiment_id, pd.read_csv(csv_path / filename), store)
+            self.create_index(store)
+        return len(files)
+
+if __name__ == '__main__':
+    # Migrating a directory of per-experiment CSV files:
+    # python UnionizedDataStore.py /path/to/VISp_unionized_data [/path/to/VISp_unionized_data.h5]
+    csv_path = Path(sys.argv[1].rstrip('/'))
+    store_path = Path(sys.argv[2]) if len(sys.argv) > 2 else csv_path.with_suffix('.h5')
+    num_imported = UnionizedDataStore(store_path).import_csv_directory(csv_path)
+    print(f'{num_imported} experiments imported into {store_path}.')
@@ -0,0 +1,90 @@
+"""
+Resampling inference for the breakpoint of a two-segment linear regression (see segmented_regression.py):
+    - bootstrap confidence interval of the breakpoint with the largest Chow F-statistic (pairs of x and y are resampled with replacement),
+    - permutation p-value of the largest F-statistic (sup-F): under the null hypothesis of a single line, residuals of the pooled fit are permuted.
+Resamples are drawn and scanned in batches (one array of shape (batch_size, N) per batch), batches are run in a process pool.
+Every batch has its own random stream spawned from one SeedSequence, so results only depend on the seed and not on the number of workers.
+"""
+
+import os
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from segmented_regression import chow_scan, chow_statistics, line_fit, k
+
+BreakpointInference = namedtuple('BreakpointInference', ['breakpoint', 'f_stat', 'confidence_interval', 'bootstrap_breakpoints', 'sup_f_p_value', 'permutation_sup_f'])
+
+def sup_f_scan(xs, ys, min_segment_size):
+    # Largest F-statistic and its breakpoint of every row of a batch of data sorted by x (NaN if a row has no valid split)
+    N = xs.shape[-1]
+    n_below = np.arange(1, N)
+    f_stats, _ = chow_statistics(xs, ys, n_below, min_segment_size)
+    has_split = ~np.all(np.isnan(f_stats), axis=-1)
+    best = np.argmax(np.where(np.isnan(f_stats), -np.inf, f_stats), axis=-1)
+    sup_f = np.where(has_split, f_stats[np.arange(len(best)), best], np.nan)
+    breakpoints = np.where(has_split, xs[np.arange(len(best)), best+1], np.nan)
+    return sup_f, breakpoints
+
+def bootstrap_batch(batch_size, seed_sequence, x, y, min_segment_size):
+    # Breakpoints of a batch of bootstrap resamples
+    rng = np.random.default_rng(seed_sequence)
+    indexes = rng.integers(0, len(x), size=(batch_size, len(x)))
+    xb, yb = x[indexes], y[indexes]
+    order = np.argsort(xb, axis=-1, kind='stable')
+    _, breakpoints = sup_f_scan(np.take_along_axis(xb, order, axis=-1), np.take_along_axis(yb, order, axis=-1), min_segment_size)
+    return breakpoints
+
+def permutation_batch(batch_size, seed_sequence, xs, fitted, residuals, min_segment_size):
+    # sup-F statistics of a batch of data with permuted residuals of the pooled fit (x is sorted and stays in place)
+    rng = np.random.default_rng(seed_sequence)
+    permuted = rng.permuted(np.broadcast_to(residuals, (batch_size, len(residuals))), axis=-1)
+    sup_f, _ = sup_f_scan(np.broadcast_to(xs, permuted.shape), fitted + permuted, min_segment_size)
+    return sup_f
+
+def run_batches(function, args, n_resamples, batch_size, seed_sequence, num_workers):
+    # Splits resamples into batches with spawned seeds and runs them in a process pool (or in this process if num_workers is 1), results are in the order of batches
+    sizes = [min(batch_size, n_resamples - start) for start in range(0, n_resamples, batch_size)]
+    seeds = seed_sequence.spawn(len(sizes))
+    if num_workers == 1: return np.concatenate([function(size, seed, *args) for size, seed in zip(sizes, seeds)] + [np.array([])])
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(function, size, seed, *args) for size, seed in zip(sizes, seeds)]
+        return np.concatenate([future.result() for future in futures] + [np.array([])])
+
+def breakpoint_inference(x, y, n_resamples=1000, confidence=0.95, seed=0, batch_size=100, num_workers=None, min_segment_size=k+1):
+    """
+    Estimates the breakpoint of x with the largest Chow F-statistic, its bootstrap confidence interval and the permutation p-value of the sup-F statistic.
+
+        Parameters:
+            x (numpy.ndarray): values of the variable split at the breakpoint (e.g. expression density).
+            y (numpy.ndarray): values of the dependent variable (e.g. expression intensity).
+            n_resamples (int): number of bootstrap resamples and of permutations.
+            confidence (float): level of the percentile confidence interval.
+            seed (int): seed of the random streams.
+            batch_size (int): number of resamples scanned at once by a worker (memory use is proportional to batch_size * len(x)).
+            num_workers (int): number of worker processes (number of CPUs if None, 1 runs resamples in this process).
+            min_segment_size (int): minimum number of points in a segment.
+
+        Returns:
+            inference (BreakpointInference): breakpoint, its F-statistic, confidence interval (lower, upper), bootstrap breakpoints,
+            sup-F p-value and sup-F statistics of permutations.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    num_workers = num_workers or os.cpu_count()
+    bootstrap_seed, permutation_seed = np.random.SeedSequence(seed).spawn(2)
+
+    scan = chow_scan(x, y, min_segment_size)
+
+    # Bootstrap resamples in which no split is valid (e.g. too few distinct x values) have no breakpoint and are left out of the interval
+    bootstrap_breakpoints = run_batches(bootstrap_batch, (x, y, min_segment_size), n_resamples, batch_size, bootstrap_seed, num_workers)
+    alpha = (1 - confidence)/2
+    confidence_interval = tuple(np.nanquantile(bootstrap_breakpoints, [alpha, 1 - alpha])) if np.any(~np.isnan(bootstrap_breakpoints)) else (np.nan, np.nan)
+
+    order = np.argsort(x, kind='stable')
+    xs, ys = x[order], y[order]
+    intercept, slope = line_fit(xs, ys)
+    fitted = intercept + slope*xs
+    permutation_sup_f = run_batches(permutation_batch, (xs, fitted, ys - fitted, min_segment_size), n_resamples, batch_size, permutation_seed, num_workers)
+    sup_f_p_value = (1 + np.sum(permutation_sup_f >= scan.best_f_stat))/(1 + n_resamples)
+
+    return BreakpointInference(scan.best_breakpoint, scan.best_f_stat, confidence_interval, bootstrap_breakpoints, sup_f_p_value, permutation_sup_f)
@@ -1,30 +1,32 @@
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import os
+import sys
+from expression_summary import summarize_families, save_summary, plot_family_histograms
 
-d = {"Drd":["Drd1","Drd2","Drd3","Drd4","Drd5"],"Htr":["Htr1a","Htr1b","Htr1d","Htr1e","Htr1f","Htr2a","Htr2b","Htr2c","Htr4","Htr5a","Htr5bp","Htr6","Htr7","Htr3a","Htr3b","Htr3c","Htr3d","Htr3e"],"Chrn":["Chrna1","Chrna2","Chrna3","Chrna4","Chrna5","Chrna6","Chrna7","Chrna8","Chrna9","Chrna10","Chrnb1","Chrnb2","Chrnb3","Chrnb4","Chrnd","Chrne","Chrng","Chrm1","Chrm2","Chrm3","Chrm4","Ch4m5"],"Cnr":["Cnr1","Cnr2"],"Opr":["Oprd1","Oprk1","Oprl1","Oprm1"],"Hrh":["Hrh1","Hrh2","Hrh3","Hrh4"],"P2r":["P2ry1","P2ry2","P2ry4","P2ry6","P2ry11","P2ry12","P2ry13","P2ry14","P2rx1","P2rx2","P2rx3","P2rx4","P2rx5","P2rx6","P2rx7"],"Grm":["Grm1","Grm2","Grm3","Grm4","Grm5","Grm6","Grm7","Grm8"],"Gabbr":["Gabbr1","Gabbr2"],"Endocannabinoid":["Faah","Mgll","Nat2","Napepld","Amt"],"Adr":["Adra1a","Adra2a","Adrb1","Adrb3","Adra1b","Adrad","Adra2b","Adra2c","Adrab2"]}
+# Expression data is read from the expression table written by the ISH pipeline (gene_expression/ish_pipeline.py)
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..'))
+from expression_table import expression_table_path, read_expression_table
+# Figures are rendered by the batch renderer of visualisers
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', '..', 'visualisers'))
+from BatchRenderer import BatchRenderer
 
-variable = 'intensity'
-path = '/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/'
-df = pd.read_excel(path+'expression_'+variable+'_data.xlsx')
-values = {}
-save_path = '/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list_histograms/'
+d = {"Drd":["Drd1","Drd2","Drd3","Drd4","Drd5"],"Htr":["Htr1a","Htr1b","Htr1d","Htr1e","Htr1f","Htr2a","Htr2b","Htr2c","Htr4","Htr5a","Htr5bp","Htr6","Htr7","Htr3a","Htr3b","Htr3c","Htr3d","Htr3e"],"Chrn":["Chrna1","Chrna2","Chrna3","Chrna4","Chrna5","Chrna6","Chrna7","Chrna8","Chrna9","Chrna10","Chrnb1","Chrnb2","Chrnb3","Chrnb4","Chrnd","Chrne","Chrng","Chrm1","Chrm2","Chrm3","Chrm4","Ch4m5"],"Cnr":["Cnr1","Cnr2"],"Opr":["Oprd1","Oprk1","Oprl1","Oprm1"],"Hrh":["Hrh1","Hrh2","Hrh3","Hrh4"],"P2r":["P2ry1","P2ry2","P2ry4","P2ry6","P2ry11","P2ry12","P2ry13","P2ry14","P2rx1","P2rx2","P2rx3","P2rx4","P2rx5","P2rx6","P2rx7"],"Grm":["Grm1","Grm2","Grm3","Grm4","Grm5","Grm6","Grm7","Grm8"],"Gabbr":["Gabbr1","Gabbr2"],"Endocannabinoid":["Faah","Mgll","Nat2","Napepld","Amt"],"Adr":["Adra1a","Adra2a","Adrb1","Adrb3","Adra1b","Adrad","Adra2b","Adra2c","Adrab2"]}
 
-for family,receptors in d.items():
-    values[family] = np.array(df[df['receptor'].isin(receptors)]['expression_'+variable])
+# Figures are rendered in worker processes, which import this script, so the analysis is only run when it is executed directly
+if __name__ == '__main__':
+    variables = ['density','intensity','energy']
+    path = '/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/'
+    save_path = '/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list_histograms/'
 
-i = 1
+    # Histograms (on bin edges shared by all families), quantiles and min/max of every family and variable are saved into one file
+    df = read_expression_table(expression_table_path(path), receptors=[r for receptors in d.values() for r in receptors], columns=['expression_'+v for v in variables])
+    summary = summarize_families(df, d, ['expression_'+v for v in variables], bins=50)
+    save_summary(save_path+'summary.npz', summary)
 
-plt.figure(figsize=(20,12))
-for family,array in values.items():
-    np.save(save_path+variable+'/'+family+'.npy',array)
-    plt.subplot(3,4,i)
-    plt.hist(array,bins=50)
-    plt.xlabel(variable)
-    plt.ylabel('frequency')
-    plt.xlim([70,200])
-    # plt.ylim([0,70])
-    plt.gca().set_title(family,fontsize=10)
-    i += 1
-plt.tight_layout()
-plt.savefig(save_path+variable+'.png')
\ No newline at end of file
+    # Histograms of every variable are rendered in worker processes (headless), only figures whose summary changed are rendered again
+    renderer = BatchRenderer(save_path)
+    xlims = {'intensity': [70,200]}
+    for j,variable in enumerate(variables):
+        # Only the part of the summary shown in the figure is passed, so that a figure is rendered again only when its own data changes
+        figure_summary = {'families': summary['families'], 'variables': summary['variables'][j:j+1], 'counts': summary['counts'][:,j:j+1], 'bin_edges': summary['bin_edges'][j:j+1]}
+        renderer.add(variable, plot_family_histograms, figure_summary, variable='expression_'+variable, xlim=xlims.get(variable))
+    print(renderer.render())
@@ -1,49 +1,29 @@
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import os
+from expression_summary import load_summary
 
-def NormalizeData(data):
-    return (data - np.min(data)) / (np.max(data) - np.min(data))
-
-def get_arr(path):
-    families = os.listdir(path)
-
-    grouped_arr = np.load(path+families[0])
-    for f in families[1:]: grouped_arr = np.concatenate((grouped_arr, np.load(path+f)), axis=0)
-
-    print(grouped_arr.shape)
-
-    grouped_arr = grouped_arr[~np.isnan(grouped_arr)]
-    grouped_arr = NormalizeData(grouped_arr)
-    return grouped_arr
+def normalized_histogram(summary, variable):
+    # Histogram of a variable over all families, with bin edges scaled to [0, 1] (min-max normalization of the values)
+    j = list(summary['variables']).index('expression_'+variable)
+    counts = summary['counts'][:,j].sum(axis=0)
+    edges = summary['bin_edges'][j]
+    print(variable, counts.sum())
+    return counts, (edges - edges[0]) / (edges[-1] - edges[0])
 
 path = "/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list_histograms/"
 
-density = get_arr(path+"density/")
-intensity = get_arr(path+"intensity/")
-energy = get_arr(path+"energy/")
+# Summary saved by create_histograms.py
+summary = load_summary(path+"summary.npz")
 
 plt.figure(figsize=(12,4))
-bins = 30
-
-plt.subplot(1,3,1)
-plt.gca().set_title('density',fontsize=10)
-plt.hist(density,bins=bins)
-plt.xlabel('density')
-plt.ylabel('frequency')
-
-plt.subplot(1,3,2)
-plt.gca().set_title('intensity',fontsize=10)
-plt.hist(intensity,bins=bins)
-plt.xlabel('intensity')
-plt.ylabel('frequency')
 
-plt.subplot(1,3,3)
-plt.gca().set_title('energy',fontsize=10)
-plt.hist(energy,bins=bins)
-plt.xlabel('energy')
-plt.ylabel('frequency')
+for i,variable in enumerate(['density','intensity','energy']):
+    counts, edges = normalized_histogram(summary, variable)
+    plt.subplot(1,3,i+1)
+    plt.gca().set_title(variable,fontsize=10)
+    plt.stairs(counts, edges, fill=True)
+    plt.xlabel(variable)
+    plt.ylabel('frequency')
 
 plt.tight_layout()
-plt.show()
\ No newline at end of file
+plt.show()
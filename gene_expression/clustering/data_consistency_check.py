@@ -1,40 +1,56 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-
-path = "/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/expression_density_data.xlsx"
-
-df = pd.read_excel(path)
-
-T = 0.006
-
-# plot receptor vs expression density
-# plot horizontal T value
-# for each receptor
-# for every experiment in it plot the its density
-# two ways of plotting:
-# 1) select specific area for all data and only plot density values for it
-# 2) for each receptor and each experiment plot densities in all areas, color each area distinctively
-# mark the "weakly expression" receptors, according to chow test / k-means plot
-
-
-plt.figure(figsize=(30,5))
-
-plt.title('data consistency - all areas')
-
-plt.hlines(T,-100,100,linestyles='dashed',colors='red')
-select_df = df[df['structure']=='VISam5']
-plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='green')
-select_df = df[df['structure']=='VISpm5']
-plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='blue')
-select_df = df[df['structure']=='RSPagl5']
-plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='orange')
-select_df = df[df['structure']=='VISp5']
-plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='purple')
-
-plt.legend(['Chow test threshold','VISam5','VISpm5','RSPagl5','VISp5'])
-
-plt.xticks(fontsize=5)
-
-plt.tight_layout()
-plt.show()
\ No newline at end of file
+import os
+import sys
+
+# Expression data is read from the expression table written by the ISH pipeline (gene_expression/ish_pipeline.py)
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..'))
+from expression_table import expression_table_path, read_expression_table
+from breakpoint_inference import breakpoint_inference
+
+# Resampling runs in worker processes, which import this script, so the analysis is only run when it is executed directly
+if __name__ == '__main__':
+    path = "/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/"
+
+    df = read_expression_table(expression_table_path(path), structures=['VISam5','VISpm5','RSPagl5','VISp5'], columns=['expression_density'])
+
+    # Density threshold T is the Chow test breakpoint of the density-intensity relation (see chow_test.py), estimated with a bootstrap confidence interval
+    # and a permutation p-value ('n_resamples' resamples run in a process pool)
+    n_resamples = 2000
+    table = read_expression_table(expression_table_path(path), columns=['expression_density','expression_intensity']).dropna(subset=['expression_density','expression_intensity'])
+    inference = breakpoint_inference(table['expression_density'].to_numpy(), table['expression_intensity'].to_numpy(), n_resamples=n_resamples)
+    T = inference.breakpoint
+    print('T =', T, ', confidence interval:', inference.confidence_interval, ', sup-F p-value:', inference.sup_f_p_value)
+
+    # plot receptor vs expression density
+    # plot horizontal T value
+    # for each receptor
+    # for every experiment in it plot the its density
+    # two ways of plotting:
+    # 1) select specific area for all data and only plot density values for it
+    # 2) for each receptor and each experiment plot densities in all areas, color each area distinctively
+    # mark the "weakly expression" receptors, according to chow test / k-means plot
+
+
+    plt.figure(figsize=(30,5))
+
+    plt.title('data consistency - all areas')
+
+    plt.hlines(T,-100,100,linestyles='dashed',colors='red')
+    plt.axhspan(inference.confidence_interval[0],inference.confidence_interval[1],color='red',alpha=0.1)
+    select_df = df[df['structure']=='VISam5']
+    plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='green')
+    select_df = df[df['structure']=='VISpm5']
+    plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='blue')
+    select_df = df[df['structure']=='RSPagl5']
+    plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='orange')
+    select_df = df[df['structure']=='VISp5']
+    plt.scatter(select_df['receptor'],select_df['expression_density'],s=10,c='purple')
+
+    plt.legend(['Chow test threshold','95% confidence interval','VISam5','VISpm5','RSPagl5','VISp5'])
+
+    plt.xticks(fontsize=5)
+
+    plt.tight_layout()
+    plt.show()
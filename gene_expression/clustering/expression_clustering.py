@@ -0,0 +1,121 @@
+"""
+K-means clustering of ISH expression data (expression table written by gene_expression/ish_pipeline.py) with model selection over a range of numbers of clusters.
+Features are either expression metrics of every experiment and structure (e.g. density, intensity, energy), or per-structure vectors of receptors
+(metrics of every structure averaged over experiments of a receptor). Candidate numbers of clusters are fitted in a process pool (MiniBatchKMeans for large data)
+and scored with the silhouette coefficient and BIC. Results are saved in a cache directory under a hash of the feature matrix and parameters, so reruns are loaded from disk.
+"""
+
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+
+def feature_matrix(table, variables, per_structure=False, standardize=True):
+    """
+    Builds a feature matrix from rows of the expression table. Rows with missing values are left out.
+
+        Parameters:
+            table (pandas.DataFrame): rows of the expression table (see read_expression_table).
+            variables (list): expression metrics used as features, e.g. ['expression_density', 'expression_intensity'].
+            per_structure (bool): if True, samples are receptors with a feature for every metric and structure (averaged over experiments),
+                                  otherwise samples are rows of the table (experiment and structure).
+            standardize (bool): scale every feature to zero mean and unit variance.
+
+        Returns:
+            X (numpy.ndarray): feature matrix.
+            samples (pandas.DataFrame): receptor (and experiment_id, structure) of every row of X.
+    """
+    if per_structure:
+        features = table.pivot_table(index='receptor', columns='structure', values=variables, aggfunc='mean', sort=True).dropna()
+        samples = pd.DataFrame({'receptor': features.index.to_numpy()})
+    else:
+        features = table[['receptor', 'experiment_id', 'structure'] + list(variables)].dropna(subset=variables)
+        samples = features[['receptor', 'experiment_id', 'structure']].reset_index(drop=True)
+        features = features[variables]
+    X = features.to_numpy(dtype=np.float64)
+    if standardize and len(X) > 0:
+        std = X.std(axis=0)
+        X = (X - X.mean(axis=0))/np.where(std > 0, std, 1)
+    return X, samples
+
+def kmeans_bic(X, labels, centroids):
+    # BIC of k-means as a mixture of spherical Gaussians with a shared variance (lower is better)
+    n, d = X.shape
+    k = len(centroids)
+    inertia = np.sum(np.square(X - centroids[labels]))
+    if n <= k or inertia <= 0: return np.nan
+    variance = inertia/(d*(n - k))
+    counts = np.bincount(labels, minlength=k)
+    counts = counts[counts > 0]
+    log_likelihood = np.sum(counts*np.log(counts/n)) - n*d/2*np.log(2*np.pi*variance) - d*(n - k)/2
+    n_parameters = k*d + 1 + (k - 1)
+    return -2*log_likelihood + n_parameters*np.log(n)
+
+def fit_kmeans(X, n_clusters, random_state=0, minibatch=False, silhouette_sample_size=10000):
+    """
+    Fits k-means with 'n_clusters' clusters and returns a dictionary with labels, centroids, inertia, silhouette coefficient and BIC of the fit.
+    The silhouette coefficient is computed on a random sample of 'silhouette_sample_size' points for large data.
+    """
+    if minibatch: model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=3)
+    else: model = KMeans(n_clusters=n_clusters, random_state=random_state, n_init=10)
+    labels = model.fit_predict(X)
+    n_labels = len(np.unique(labels))
+    silhouette = silhouette_score(X, labels, sample_size=min(silhouette_sample_size, len(X)), random_state=random_state) if 1 < n_labels < len(X) else np.nan
+    return {'n_clusters': n_clusters, 'labels': labels, 'centroids': model.cluster_centers_, 'inertia': model.inertia_, 'silhouette': silhouette, 'bic': kmeans_bic(X, labels, model.cluster_centers_)}
+
+def clustering_key(X, parameters):
+    # Hash of the feature matrix and clustering parameters
+    sha256 = hashlib.sha256()
+    sha256.update(repr((X.shape, sorted(parameters.items()))).encode())
+    sha256.update(np.ascontiguousarray(X).tobytes())
+    return sha256.hexdigest()[:32]
+
+def cluster_features(X, k_values=range(2, 9), criterion='silhouette', random_state=0, minibatch_threshold=10000, num_workers=None, cache_dir=None, name='features'):
+    """
+    Fits k-means for every number of clusters in 'k_values' in parallel and selects the best one.
+
+        Parameters:
+            X (numpy.ndarray): feature matrix (see feature_matrix).
+            k_values (list): candidate numbers of clusters.
+            criterion (str): 'silhouette' (largest silhouette coefficient) or 'bic' (smallest BIC).
+            random_state (int): seed of the fits.
+            minibatch_threshold (int): MiniBatchKMeans is used if X has more rows.
+            num_workers (int): number of worker processes (number of CPUs if None, 1 fits in this process).
+            cache_dir (str): directory where results are saved as '{name}_{key}.pkl' and loaded from on a rerun with the same X and parameters (no caching if None).
+            name (str): name of the feature set, used in the cache file name.
+
+        Returns:
+            result (dict): 'fits' (list of dictionaries returned by fit_kmeans, in the order of k_values), 'scores' (pandas.DataFrame of inertia, silhouette and BIC of every k),
+            'best_k', 'labels' and 'centroids' of the selected fit.
+    """
+    k_values = [k for k in k_values if k <= len(X)]
+    minibatch = len(X) > minibatch_threshold
+    parameters = {'k_values': tuple(k_values), 'criterion': criterion, 'random_state': random_state, 'minibatch': minibatch}
+
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'{name}_{clustering_key(X, parameters)}.pkl')
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f: return pickle.load(f)
+
+    if (num_workers or os.cpu_count()) == 1 or len(k_values) < 2:
+        fits = [fit_kmeans(X, k, random_state, minibatch) for k in k_values]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            fits = list(executor.map(fit_kmeans, [X]*len(k_values), k_values, [random_state]*len(k_values), [minibatch]*len(k_values)))
+
+    scores = pd.DataFrame([{k: fit[k] for k in ['n_clusters', 'inertia', 'silhouette', 'bic']} for fit in fits])
+    if len(fits) == 0 or scores[criterion].isna().all(): best = None
+    elif criterion == 'bic': best = fits[int(scores['bic'].idxmin())]
+    else: best = fits[int(scores['silhouette'].idxmax())]
+    result = {'fits': fits, 'scores': scores, 'best_k': best['n_clusters'] if best else None, 'labels': best['labels'] if best else None, 'centroids': best['centroids'] if best else None}
+
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    return result
@@ -0,0 +1,96 @@
+"""
+Summary statistics of expression metrics of receptor families: histograms on bin edges shared by all families, quantiles, min/max, mean and count
+of every family and metric, computed in one pass over the expression table (rows of every metric are grouped by family with one sort) into preallocated arrays.
+The summary is saved into a single .npz file, from which histograms are plotted (create_histograms.py, create_single_histogram.py).
+"""
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+def summarize_families(table, families, variables, bins=50, quantile_levels=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """
+    Computes summary statistics of expression metrics for every receptor family.
+
+        Parameters:
+            table (pandas.DataFrame): rows of the expression table (see read_expression_table).
+            families (dict): dictionary of the form {family: [receptors]}.
+            variables (list): expression metrics, e.g. ['expression_density', 'expression_intensity'].
+            bins (int): number of histogram bins, spanning the range of a metric over all families.
+            quantile_levels (list): levels of quantiles (linear interpolation as in numpy.quantile).
+
+        Returns:
+            summary (dict): 'families', 'variables', 'quantile_levels', 'bin_edges' (variables x bins+1), 'counts' (families x variables x bins),
+            'count', 'minimum', 'maximum', 'mean' (families x variables) and 'quantiles' (families x variables x quantile levels).
+            Statistics of families without values are NaN.
+    """
+    family_names = list(families.keys())
+    F, V, B, Q = len(family_names), len(variables), bins, len(quantile_levels)
+    levels = np.asarray(quantile_levels, dtype=np.float64)
+
+    # One row per value and family of its receptor (receptors of several families are counted in each of them)
+    membership = pd.DataFrame([(i, receptor) for i, receptor_list in enumerate(families.values()) for receptor in receptor_list], columns=['family', 'receptor'])
+    rows = table[['receptor'] + list(variables)].merge(membership, on='receptor')
+
+    bin_edges = np.zeros((V, B+1))
+    counts = np.zeros((F, V, B), dtype=np.int64)
+    count = np.zeros((F, V), dtype=np.int64)
+    minimum, maximum, mean = np.full((F, V), np.nan), np.full((F, V), np.nan), np.full((F, V), np.nan)
+    quantiles = np.full((F, V, Q), np.nan)
+
+    for j, variable in enumerate(variables):
+        values = rows[variable].to_numpy(dtype=np.float64)
+        family = rows['family'].to_numpy(dtype=np.int64)
+        valid = ~np.isnan(values)
+        values, family = values[valid], family[valid]
+        if len(values) == 0:
+            bin_edges[j] = np.linspace(0, 1, B+1)
+            continue
+
+        # Shared bin edges, as in numpy.histogram (a constant metric gets a unit range around its value, the last bin includes its right edge)
+        low, high = values.min(), values.max()
+        if low == high: low, high = low - 0.5, high + 0.5
+        bin_edges[j] = np.linspace(low, high, B+1)
+        bin_index = np.clip(np.searchsorted(bin_edges[j], values, side='right') - 1, 0, B-1)
+        counts[:, j, :] = np.bincount(family*B + bin_index, minlength=F*B).reshape(F, B)
+        count[:, j] = np.bincount(family, minlength=F)
+
+        # Values sorted by family and value, every family is a contiguous segment
+        order = np.lexsort((values, family))
+        sorted_values = values[order]
+        starts = np.concatenate([[0], np.cumsum(count[:, j])])
+        has_values = count[:, j] > 0
+        minimum[has_values, j] = sorted_values[starts[:-1][has_values]]
+        maximum[has_values, j] = sorted_values[starts[1:][has_values] - 1]
+        mean[has_values, j] = np.bincount(family, weights=values, minlength=F)[has_values]/count[has_values, j]
+
+        positions = (count[has_values, j, None] - 1)*levels
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.ceil(positions).astype(np.int64)
+        segment_starts = starts[:-1][has_values, None]
+        quantiles[has_values, j, :] = sorted_values[segment_starts + lower] + (sorted_values[segment_starts + upper] - sorted_values[segment_starts + lower])*(positions - lower)
+
+    return {'families': np.array(family_names), 'variables': np.array(list(variables)), 'quantile_levels': levels, 'bin_edges': bin_edges, 'counts': counts,
+            'count': count, 'minimum': minimum, 'maximum': maximum, 'mean': mean, 'quantiles': quantiles}
+
+def save_summary(path, summary):
+    np.savez_compressed(path, **summary)
+
+def load_summary(path):
+    with np.load(path) as f: return {k: f[k] for k in f.files}
+
+def plot_family_histograms(summary, variable, xlim=None):
+    """
+    Returns a figure with histograms of an expression metric (e.g. 'expression_intensity') of every family in the summary.
+    """
+    j = list(summary['variables']).index(variable)
+    fig = plt.figure(figsize=(20,12))
+    for f,family in enumerate(summary['families']):
+        plt.subplot(3,4,f+1)
+        plt.stairs(summary['counts'][f,j], summary['bin_edges'][j], fill=True)
+        plt.xlabel(variable.replace('expression_',''))
+        plt.ylabel('frequency')
+        if xlim is not None: plt.xlim(xlim)
+        plt.gca().set_title(family,fontsize=10)
+    fig.tight_layout()
+    return fig
@@ -1,37 +1,48 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
-
-path = "/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/"
-
-density = np.array(pd.read_excel(path+"expression_density_data.xlsx")['expression_density'])
-intensity = np.array(pd.read_excel(path+"expression_intensity_data.xlsx")['expression_intensity'])
-density = density[~np.isnan(density)]
-intensity = intensity[~np.isnan(intensity)]
-density = density.reshape((-1, 1))
-intensity = intensity.reshape((-1, 1))
-X = np.concatenate((density,intensity),axis=1)
-print(X.shape)
-
-X = np.array(pd.read_excel(path+"expression_energy_data.xlsx")['expression_energy'])
-X = X[~np.isnan(X)]
-X = X.reshape((-1, 1))
-
-kmeans = KMeans(n_clusters=2)
-kmeans.fit(X)
-
-print(kmeans.labels_)
-
-plt.figure(figsize=(10,3))
-
-plt.scatter(X[:,0],kmeans.labels_)
-plt.xlabel('energy')
-plt.ylabel('cluster')
-plt.yticks([0,1])
-plt.tight_layout()
-plt.show()
-# plt.scatter(X[:,0],X[:,1],c=kmeans.labels_)
-# plt.xlabel('density')
-# plt.ylabel('intensity')
-# plt.show()
\ No newline at end of file
+import os
+import sys
+from expression_clustering import feature_matrix, cluster_features
+
+# Expression data is read from the expression table written by the ISH pipeline (gene_expression/ish_pipeline.py)
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..'))
+from expression_table import expression_table_path, read_expression_table
+
+# Candidate fits run in worker processes, which import this script, so the analysis is only run when it is executed directly
+if __name__ == '__main__':
+    path = "/home/ikharitonov/Desktop/data/ish/postsynaptic_receptor_list/antisense/"
+    cache_dir = path+"clustering_cache/"
+
+    table = read_expression_table(expression_table_path(path), columns=['expression_density','expression_intensity','expression_energy'])
+
+    # Feature sets: name -> (expression metrics, per-structure vectors of receptors)
+    feature_sets = {
+        'energy': (['expression_energy'], False),
+        'density_intensity': (['expression_density','expression_intensity'], False),
+        'density_intensity_energy': (['expression_density','expression_intensity','expression_energy'], False),
+        'energy_per_structure': (['expression_energy'], True),
+    }
+    k_values = range(2, 9)
+
+    results = {}
+    for name, (variables, per_structure) in feature_sets.items():
+        X, samples = feature_matrix(table, variables, per_structure)
+        results[name] = cluster_features(X, k_values, criterion='silhouette', cache_dir=cache_dir, name=name)
+        print(name, X.shape, 'best k =', results[name]['best_k'])
+        print(results[name]['scores'])
+
+    # Energy clustered into two groups
+    X, _ = feature_matrix(table, ['expression_energy'], standardize=False)
+    labels = next(fit['labels'] for fit in results['energy']['fits'] if fit['n_clusters'] == 2)
+
+    print(labels)
+
+    plt.figure(figsize=(10,3))
+
+    plt.scatter(X[:,0],labels)
+    plt.xlabel('energy')
+    plt.ylabel('cluster')
+    plt.yticks([0,1])
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,117 @@
+"""
+Two-segment linear regression (y = a + b*x below and above a breakpoint of x) and the Chow test for a structural break at the breakpoint.
+Data is sorted by x once, after which sums of x, y, x^2, xy and y^2 of both segments are differences of prefix sums, so RSS of the segment fits and of the pooled fit
+are computed in closed form for every possible breakpoint at once (O(N) after sorting), instead of fitting three regressions per breakpoint.
+All functions accept arrays with leading batch dimensions (e.g. a batch of resamples of shape (n_resamples, N)), the scan is done along the last axis.
+"""
+
+import numpy as np
+import scipy.stats as stats
+from collections import namedtuple
+
+ChowScan = namedtuple('ChowScan', ['breakpoints', 'f_stats', 'p_values', 'n_below', 'best_breakpoint', 'best_f_stat', 'best_p_value'])
+
+# Number of parameters of a segment fit (intercept and slope)
+k = 2
+
+def segment_rss(n, sx, sy, sxx, sxy, syy):
+    # RSS of the least squares line fitted to a segment, from its sums (a segment with constant x is fitted with a constant)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx_c = sxx - sx*sx/n
+        sxy_c = sxy - sx*sy/n
+        syy_c = syy - sy*sy/n
+        rss = np.where(sxx_c > 1e-12*np.maximum(sxx, 1e-300), syy_c - sxy_c*sxy_c/sxx_c, syy_c)
+    return np.maximum(rss, 0)
+
+def prefix_sums(xs, ys):
+    # Prefix sums of x, y, x^2, xy and y^2 along the last axis, with a leading zero (sums of the first i points are at position i)
+    sums = np.stack([xs, ys, xs*xs, xs*ys, ys*ys])
+    zeros = np.zeros(sums.shape[:-1] + (1,))
+    return np.concatenate([zeros, np.cumsum(sums, axis=-1)], axis=-1)
+
+def chow_statistics(xs, ys, n_below, min_segment_size=k+1):
+    """
+    Chow F-statistics and p-values of splitting sorted data into the first 'n_below' points and the rest.
+
+        Parameters:
+            xs (numpy.ndarray): x values sorted along the last axis.
+            ys (numpy.ndarray): y values in the order of xs.
+            n_below (numpy.ndarray): numbers of points below breakpoints (broadcastable against the batch dimensions of xs, with the breakpoints along the last axis).
+            min_segment_size (int): splits with fewer points in a segment, or splitting equal x values, are not valid (NaN statistics).
+
+        Returns:
+            f_stats (numpy.ndarray): F-statistics of the splits.
+            p_values (numpy.ndarray): p-values of the F-statistics.
+    """
+    N = xs.shape[-1]
+    # Centering improves the precision of the sums of squares computed from prefix sums
+    xs = xs - xs.mean(axis=-1, keepdims=True)
+    ys = ys - ys.mean(axis=-1, keepdims=True)
+    sums = prefix_sums(xs, ys)
+    n_below = np.broadcast_to(n_below, xs.shape[:-1] + np.shape(n_below)[-1:])
+
+    below = np.stack([np.take_along_axis(s, n_below, axis=-1) for s in sums])
+    total = sums[..., -1:]
+    above = total - below
+    rss_below = segment_rss(n_below, *below)
+    rss_above = segment_rss(N - n_below, *above)
+    rss_pooled = segment_rss(N, *total)
+
+    x_before = np.take_along_axis(xs, np.clip(n_below-1, 0, N-1), axis=-1)
+    x_after = np.take_along_axis(xs, np.clip(n_below, 0, N-1), axis=-1)
+    valid = (n_below >= min_segment_size) & (N - n_below >= min_segment_size) & (x_before < x_after)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f_stats = ((rss_pooled - (rss_below + rss_above))/k)/((rss_below + rss_above)/(N - 2*k))
+    f_stats = np.where(valid, f_stats, np.nan)
+    p_values = stats.f.sf(f_stats, k, N - 2*k)
+    return f_stats, p_values
+
+def chow_scan(x, y, min_segment_size=k+1):
+    """
+    Chow test for every possible breakpoint of x: the data is split into points with x < breakpoint and x >= breakpoint at every distinct value of x.
+
+        Parameters:
+            x (numpy.ndarray): values of the variable split at the breakpoint (e.g. expression density).
+            y (numpy.ndarray): values of the dependent variable (e.g. expression intensity).
+            min_segment_size (int): minimum number of points in a segment.
+
+        Returns:
+            scan (ChowScan): breakpoints, F-statistics, p-values and numbers of points below the breakpoints, along with the breakpoint with the largest F-statistic.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    order = np.argsort(x, kind='stable')
+    xs, ys = x[order], y[order]
+
+    n_below = np.arange(1, len(xs))
+    f_stats, p_values = chow_statistics(xs, ys, n_below, min_segment_size)
+    valid = ~np.isnan(f_stats)
+    breakpoints, f_stats, p_values, n_below = xs[1:][valid], f_stats[valid], p_values[valid], n_below[valid]
+    if len(f_stats) == 0: return ChowScan(breakpoints, f_stats, p_values, n_below, np.nan, np.nan, np.nan)
+    best = np.argmax(f_stats)
+    return ChowScan(breakpoints, f_stats, p_values, n_below, breakpoints[best], f_stats[best], p_values[best])
+
+def chow_test_at(x, y, breakpoints, min_segment_size=k+1):
+    """
+    Chow test for given breakpoints (points with x < breakpoint are below it). Returns F-statistics and p-values of the breakpoints.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    order = np.argsort(x, kind='stable')
+    xs, ys = x[order], np.asarray(y, dtype=np.float64)[order]
+    n_below = np.searchsorted(xs, np.atleast_1d(np.asarray(breakpoints, dtype=np.float64)), side='left')
+    return chow_statistics(xs, ys, n_below, min_segment_size)
+
+def line_fit(x, y):
+    # Least squares line (intercept, slope)
+    slope, intercept = np.polyfit(x, y, 1)
+    return intercept, slope
+
+def segment_fits(x, y, breakpoint):
+    """
+    Returns least squares lines (intercept, slope) fitted to the points below the breakpoint, above it and to all points.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    below = x < breakpoint
+    return line_fit(x[below], y[below]), line_fit(x[~below], y[~below]), line_fit(x, y)
@@ -0,0 +1,104 @@
+"""
+Expression table: the primary output of the ISH pipeline, a single HDF5 file with typed tables
+
+    'receptors'   : receptor (str) - queried receptors in the order of the receptor list.
+    'experiments' : receptor (str), experiment_id (int), plane (int, plane_of_section_id), has_data (bool) - one row per queried experiment.
+    'expression'  : receptor (str), experiment_id (int), plane (int), structure_id (int), structure (str, acronym) and float columns of structure unionizes
+                    (expression_density, expression_intensity, expression_energy, sum_expressing_pixels, sum_expressing_pixel_intensity, sum_pixels, ...)
+                    - one row per experiment and target structure.
+
+Excel files and downstream analyses (gene_expression/clustering) are derived from this file.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+expression_table_filename = 'expression_table.h5'
+id_columns = ['receptor', 'experiment_id', 'plane', 'structure_id', 'structure']
+string_columns = {'receptor': 32, 'structure': 32}
+
+def expression_table_path(output_file_path):
+    return os.path.join(output_file_path, expression_table_filename)
+
+def typed_expression_table(df):
+    # ID columns first (integer or string), all other columns as floats
+    df = df[[c for c in id_columns if c in df.columns] + [c for c in df.columns if c not in id_columns]].reset_index(drop=True)
+    for column in df.columns:
+        if column in string_columns: df[column] = df[column].astype(str).astype(object)
+        elif column in id_columns: df[column] = df[column].astype(np.int64)
+        else: df[column] = pd.to_numeric(df[column], errors='coerce').astype(np.float64)
+    return df
+
+def write_expression_table(path, receptors, experiments, expression):
+    """
+    Writes the expression table. The file is written into a temporary file first and then replaces the previous one, so readers never see a partially written table.
+
+        Parameters:
+            path (str): path to the HDF5 file.
+            receptors (list): queried receptors.
+            experiments (pandas.DataFrame): experiments with 'receptor', 'experiment_id', 'plane' and 'has_data' columns.
+            expression (pandas.DataFrame): expression values of target structures with 'receptor', 'experiment_id', 'plane', 'structure_id', 'structure' and unionize columns.
+    """
+    receptors = pd.DataFrame({'receptor': pd.Series(list(receptors), dtype=object)})
+    experiments = typed_expression_table(experiments.drop(columns='has_data')).assign(has_data=experiments['has_data'].astype(bool).to_numpy())
+    expression = typed_expression_table(expression)
+
+    tmp_path = path + '.tmp'
+    if os.path.isfile(tmp_path): os.remove(tmp_path)
+    with pd.HDFStore(tmp_path, 'w', complevel=5, complib='blosc') as store:
+        for key, df in [('receptors', receptors), ('experiments', experiments), ('expression', expression)]:
+            min_itemsize = {c: size for c, size in string_columns.items() if c in df.columns}
+            store.put(key, df, format='table', data_columns=[c for c in id_columns if c in df.columns], min_itemsize=min_itemsize, index=False)
+    os.replace(tmp_path, path)
+
+def selection(receptors=None, experiments=None, structures=None):
+    # Query of an HDF5 table selecting rows of the receptors, experiment IDs and structures (IDs or acronyms)
+    where = []
+    if receptors is not None: where.append('receptor=' + repr([str(r) for r in receptors]))
+    if experiments is not None: where.append('experiment_id=' + repr([int(e) for e in experiments]))
+    if structures is not None:
+        structures = list(structures)
+        structure_ids = [int(s) for s in structures if not isinstance(s, str)]
+        acronyms = [s for s in structures if isinstance(s, str)]
+        if len(structure_ids) > 0 and len(acronyms) > 0: where.append('(structure_id=' + repr(structure_ids) + ' | structure=' + repr(acronyms) + ')')
+        elif len(acronyms) > 0: where.append('structure=' + repr(acronyms))
+        else: where.append('structure_id=' + repr(structure_ids))
+    return where if len(where) > 0 else None
+
+def select(path, key, columns, receptors=None, experiments=None, structures=None):
+    # Empty tables are not written into HDF5 files, so a missing table is read as an empty one
+    with pd.HDFStore(path, 'r') as store:
+        if '/'+key not in store.keys(): return pd.DataFrame(columns=columns)
+        if any(v is not None and len(list(v)) == 0 for v in [receptors, experiments, structures]): return store.select(key, stop=0)
+        return store.select(key, where=selection(receptors, experiments, structures)).reset_index(drop=True)
+
+def read_expression_table(path, receptors=None, experiments=None, structures=None, columns=None):
+    """
+    Reads expression values of target structures from the expression table. Rows are selected in the HDF5 file, so only the requested rows are read.
+
+        Parameters:
+            path (str): path to the HDF5 file.
+            receptors (list): receptors to select (all if None).
+            experiments (list): experiment IDs to select (all if None).
+            structures (list): structure IDs or acronyms to select (all if None).
+            columns (list): value columns to read in addition to ID columns (all if None).
+
+        Returns:
+            expression (pandas.DataFrame): one row per experiment and structure, in the order of the receptor list and experiment IDs.
+    """
+    df = select(path, 'expression', id_columns + list(columns or []), receptors, experiments, structures)
+    if columns is not None: df = df[[c for c in id_columns if c in df.columns] + [c for c in columns if c not in id_columns]]
+    return df
+
+def read_experiments(path, receptors=None):
+    """
+    Reads queried experiments (receptor, experiment_id, plane, has_data) from the expression table, optionally only of the given receptors.
+    """
+    return select(path, 'experiments', ['receptor', 'experiment_id', 'plane', 'has_data'], receptors)
+
+def read_receptors(path):
+    """
+    Reads the list of queried receptors (including receptors without experiments) from the expression table.
+    """
+    return select(path, 'receptors', ['receptor'])['receptor'].tolist()
@@ -1,11 +1,24 @@
 import os
+import sys
 import json
+import hashlib
+import threading
+from datetime import datetime
+import numpy as np
 from allensdk.api.queries.rma_api import RmaApi
 import pandas as pd
 from tqdm import tqdm
-from math import isnan
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Border, Side, Alignment
 pd.options.mode.chained_assignment = None
 
+# Structure lookups are served from the ontology index shared with the connectivity pipeline
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', 'connectivity'))
+from RMALoaders import get_ontology, RateLimiter, retry_with_backoff
+from expression_table import expression_table_path, write_expression_table, read_expression_table, read_experiments, read_receptors
+
 def mkdir(path):
     if not os.path.exists(path): os.makedirs(path)
     return path
@@ -19,138 +32,305 @@ def select_target_structures_from_df(union_df,target_structure_list):
     return df.copy()
 
 def query_structure_name(structure_id):
-    query = rma.model_query('StructureLookup', criteria="structure[id$eq"+str(structure_id)+"]",include="structure")[0]
-    return query['structure']['acronym']
+    return get_ontology().acronym(structure_id)
 
 def save_df_to_csv(df, filename):
     df.to_csv(filename, index=False)
     # print(filename,'saved.')
+
+# PyTables is not thread-safe, all HDF5 files are accessed by one worker at a time
+hdf5_lock = threading.Lock()
+unionize_id_columns = ['id', 'section_data_set_id', 'structure_id']
+
+def query_section_data_set_pages(receptor, cfg, rate_limiter=None):
+    """
+    Generator of pages (lists of records) of the SectionDataSet query of one receptor. Pages of 'page_size' experiments are ordered by experiment ID, so that the pagination is stable.
+    Every page is rate limited and retried with backoff if it fails.
+    """
+    page_size = cfg.get("page_size", 50)
+    start_row = 0
+    while True:
+        def query_function():
+            if rate_limiter is not None: rate_limiter.wait()
+            return rma.model_query('SectionDataSet', criteria=",".join(cfg["rma_query"]["criteria"])+",genes[acronym$eq'"+receptor+"']", include=",".join(cfg["rma_query"]["include"]), start_row=start_row, num_rows=page_size, order=["'id'"])
+        page = retry_with_backoff(query_function, max_retries=cfg.get("max_retries", 5))
+        if len(page) > 0: yield page
+        if len(page) < page_size: break
+        start_row += page_size
+
+def flatten_structure_unionizes(page, columns=None):
+    """
+    Returns structure unionizes of all experiments in a page as one typed table (ID columns as integers, all other columns as floats).
+    """
+    df = pd.DataFrame([dict(unionize, section_data_set_id=record['id']) for record in page for unionize in record.get('structure_unionizes', [])], columns=columns)
+    for column in df.columns:
+        if column in unionize_id_columns: df[column] = df[column].astype(np.int64)
+        else: df[column] = pd.to_numeric(df[column], errors='coerce').astype(np.float64)
+    return df
+
+def full_unionized_data_path(cfg, receptor):
+    return mkdir(mkdir(cfg["output_file_path"])+"full_unionized/")+receptor+".h5"
+
+def read_full_unionized_data(cfg, receptor):
+    """
+    Reads full unionized data of a receptor saved by 'mine_receptor'.
+
+        Returns:
+            section_data_sets (pandas.DataFrame): experiment records (nested fields, e.g. probes, are decoded from JSON).
+            structure_unionizes (pandas.DataFrame): structure unionizes of all experiments.
+    """
+    with hdf5_lock, pd.HDFStore(full_unionized_data_path(cfg, receptor), 'r') as store:
+        section_data_sets = store.select('section_data_sets')
+        json_columns = store.get_storer('section_data_sets').attrs.json_columns
+        structure_unionizes = store.select('structure_unionizes') if '/structure_unionizes' in store.keys() else pd.DataFrame(columns=unionize_id_columns)
+    for column in json_columns: section_data_sets[column] = section_data_sets[column].apply(json.loads)
+    return section_data_sets, structure_unionizes
     
-def run_data_mining(cfg):
-    
-    # Getting structures and receptors from config
-    QUERY_AREA_ID = cfg["structures"]  
-    receptors = get_receptor_list(cfg["receptors_file_path"])
-    
-    # Dataframe which will contain metadata of queried experiments (experiment id, structures, filename, plane, availability of data)
+def area_filtered_filename(receptor, exp_id, QUERY_AREA_ID):
+    return 'gene_'+receptor+'_exp_'+str(exp_id)+'_query_area_id_'+str(QUERY_AREA_ID)+'.csv'
+
+def mine_receptor(receptor, cfg, rate_limiter=None):
+    """
+    Queries expression data of one receptor page by page, saves its unionized data and returns its rows of the metadata table (info.csv) and of the expression table.
+    Structure unionizes of every page are appended to the receptor's HDF5 table before the next page is queried, so memory use is bounded by the page size.
+    """
+    QUERY_AREA_ID = cfg["structures"]
     info_df = []
-    
-    # Main data query loop
-    for receptor in tqdm(receptors,"Querying receptor expression data"):
-        # Main RMA query
-        query = rma.model_query('SectionDataSet', criteria=",".join(cfg["rma_query"]["criteria"])+",genes[acronym$eq'"+receptor+"']", include=",".join(cfg["rma_query"]["include"]))
-        data_df = pd.DataFrame(query)
-        # Save full uniniozed data into CSV file
-        if cfg["save_full_unionized_data"]: save_df_to_csv(data_df, mkdir(mkdir(cfg["output_file_path"])+"full_unionized/")+receptor+".csv")
-        # Add add empty metadata and skip if receptor has no associated experiments
-        if len(data_df)==0:
-            info_df.append({'receptor': receptor,'experiment_id': 'null','plane': 'null','query_area_id': QUERY_AREA_ID,'filename': 'null','has_data': 'false'})
-            continue
-        
+    expression_df = []
+    section_data_sets = []
+    unionize_columns = None
+    if cfg["save_full_unionized_data"] and os.path.isfile(full_unionized_data_path(cfg, receptor)): os.remove(full_unionized_data_path(cfg, receptor))
+
+    for page in query_section_data_set_pages(receptor, cfg, rate_limiter):
+        # Save full uniniozed data of the page into HDF5 table
+        if cfg["save_full_unionized_data"]:
+            unionizes_df = flatten_structure_unionizes(page, unionize_columns)
+            if unionize_columns is None and len(unionizes_df) > 0: unionize_columns = list(unionizes_df.columns)
+            if len(unionizes_df) > 0:
+                with hdf5_lock, pd.HDFStore(full_unionized_data_path(cfg, receptor), 'a', complevel=5, complib='blosc') as store:
+                    store.append('structure_unionizes', unionizes_df, format='table', data_columns=unionize_id_columns, index=False)
+
         # Structure unionizes loop
-        for exp_id in data_df['id']:
-            exp_union_data = pd.DataFrame(data_df[data_df['id']==exp_id]['structure_unionizes'].item())
+        for record in page:
+            exp_id = record['id']
+            section_data_sets.append({k: v for k, v in record.items() if k != 'structure_unionizes'})
             # Add metadata and skip if the experiment has an empty structure unionize
-            if len(data_df[data_df['id']==exp_id]['structure_unionizes'].item()) == 0:
-                info_df.append({'receptor': receptor,'experiment_id': exp_id,'plane': data_df[data_df['id']==exp_id]['plane_of_section_id'].item(),'query_area_id': QUERY_AREA_ID,'filename': 'null','has_data': 'false'})
+            if len(record['structure_unionizes']) == 0:
+                info_df.append({'receptor': receptor,'experiment_id': exp_id,'plane': record['plane_of_section_id'],'query_area_id': QUERY_AREA_ID,'filename': 'null','has_data': 'false'})
                 continue
-            
+
             # Only select the entries corresponding to the structures of interest
-            filtered_df = select_target_structures_from_df(exp_union_data,QUERY_AREA_ID)
-            
+            filtered_df = select_target_structures_from_df(pd.DataFrame(record['structure_unionizes']),QUERY_AREA_ID)
+
             # Calculate expression intensity and add to the experiment's structure unionize dataframe
             filtered_df['expression_intensity'] = filtered_df.sum_expressing_pixel_intensity / filtered_df.sum_expressing_pixels
+            expression_df.append(filtered_df.drop(columns=['id', 'section_data_set_id'], errors='ignore').assign(receptor=receptor, experiment_id=exp_id, plane=record['plane_of_section_id']))
 
             # Saving structure unionize data for each experiment within each receptor to a CSV file and adding metadata
-            filename = 'gene_'+receptor+'_exp_'+str(exp_id)+'_query_area_id_'+str(QUERY_AREA_ID)+'.csv'
+            filename = area_filtered_filename(receptor, exp_id, QUERY_AREA_ID)
             if cfg["save_area_filtered_data"]: save_df_to_csv(filtered_df, mkdir(mkdir(cfg["output_file_path"])+"area_filtered/")+filename)
-            info_df.append({'receptor': receptor,'experiment_id': exp_id,'plane': data_df[data_df['id']==exp_id]['plane_of_section_id'].item(),'query_area_id': QUERY_AREA_ID,'filename': filename,'has_data': 'true'})
+            info_df.append({'receptor': receptor,'experiment_id': exp_id,'plane': record['plane_of_section_id'],'query_area_id': QUERY_AREA_ID,'filename': filename,'has_data': 'true'})
+
+    # Experiment records (without unionizes) are small and saved once all pages are queried, nested fields are encoded as JSON
+    if cfg["save_full_unionized_data"]:
+        section_data_sets = pd.DataFrame(section_data_sets)
+        json_columns = [c for c in section_data_sets.columns if section_data_sets[c].apply(lambda x: isinstance(x, (list, dict))).any()]
+        for column in json_columns: section_data_sets[column] = section_data_sets[column].apply(json.dumps)
+        with hdf5_lock, pd.HDFStore(full_unionized_data_path(cfg, receptor), 'a', complevel=5, complib='blosc') as store:
+            store.put('section_data_sets', section_data_sets, format='fixed')
+            store.get_storer('section_data_sets').attrs.json_columns = json_columns
+
+    # Add add empty metadata if receptor has no associated experiments
+    if len(section_data_sets)==0:
+        info_df.append({'receptor': receptor,'experiment_id': 'null','plane': 'null','query_area_id': QUERY_AREA_ID,'filename': 'null','has_data': 'false'})
+
+    expression_df = pd.concat(expression_df, ignore_index=True) if len(expression_df) > 0 else pd.DataFrame(columns=['receptor', 'experiment_id', 'plane', 'structure_id'])
+    return info_df, expression_df
+
+def query_criteria_hash(cfg):
+    # Hash of the config fields which determine the mined data of a receptor (query, target structures and saved outputs)
+    fields = {k: cfg[k] for k in ["rma_query", "structures", "save_full_unionized_data", "save_area_filtered_data"]}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+def mining_manifest_path(cfg):
+    return mkdir(cfg["output_file_path"])+"mining_manifest.json"
+
+def read_mining_manifest(cfg):
+    """
+    Reads the mining manifest: a dictionary of the form {receptor: {'criteria_hash': str, 'experiments': list, 'timestamp': str}} of receptors saved in the expression table.
+    """
+    if not os.path.isfile(mining_manifest_path(cfg)): return {}
+    with open(mining_manifest_path(cfg), 'r') as file: return json.loads(file.read())
+
+def write_mining_manifest(cfg, manifest):
+    tmp_path = mining_manifest_path(cfg)+".tmp"
+    with open(tmp_path, 'w') as outfile: json.dump(manifest, outfile, indent=1)
+    os.replace(tmp_path, mining_manifest_path(cfg))
+
+def saved_receptor_data(cfg, receptors):
+    """
+    Returns rows of the metadata table (info.csv) and of the expression table of receptors saved in the expression table by a previous run, in the same form as 'mine_receptor'.
+    """
+    table_path = expression_table_path(cfg["output_file_path"])
+    experiments_df = read_experiments(table_path, receptors)
+    expression_df = read_expression_table(table_path, receptors).drop(columns='structure')
+    QUERY_AREA_ID = cfg["structures"]
+    results = {}
+    for receptor in receptors:
+        info_df = [{'receptor': receptor,'experiment_id': int(row.experiment_id),'plane': int(row.plane),'query_area_id': QUERY_AREA_ID,'filename': area_filtered_filename(receptor, int(row.experiment_id), QUERY_AREA_ID) if row.has_data else 'null','has_data': 'true' if row.has_data else 'false'} for row in experiments_df[experiments_df['receptor']==receptor].itertuples()]
+        if len(info_df)==0: info_df.append({'receptor': receptor,'experiment_id': 'null','plane': 'null','query_area_id': QUERY_AREA_ID,'filename': 'null','has_data': 'false'})
+        results[receptor] = (info_df, expression_df[expression_df['receptor']==receptor])
+    return results
+
+def run_data_mining(cfg):
+    
+    # Getting receptors from config
+    receptors = get_receptor_list(cfg["receptors_file_path"])
+
+    # Receptors saved by a previous run with the same query criteria are not queried again ('incremental_mining' in config), their data is taken from the expression table
+    criteria_hash = query_criteria_hash(cfg)
+    table_path = expression_table_path(mkdir(cfg["output_file_path"]))
+    manifest = read_mining_manifest(cfg) if cfg.get("incremental_mining", True) and os.path.isfile(table_path) else {}
+    saved_receptors = set(read_receptors(table_path)) if len(manifest) > 0 else set()
+    up_to_date = [R for R in receptors if R in saved_receptors and manifest.get(R, {}).get('criteria_hash') == criteria_hash]
+    to_query = [R for R in receptors if R not in up_to_date]
+    if len(up_to_date) > 0: print(len(up_to_date), 'receptors are up to date,', len(to_query), 'receptors will be queried.')
+
+    # Output directories are created before the queries start, so that workers do not race to create them
+    if cfg["save_full_unionized_data"]: mkdir(mkdir(cfg["output_file_path"])+"full_unionized/")
+    if cfg["save_area_filtered_data"]: mkdir(mkdir(cfg["output_file_path"])+"area_filtered/")
+
+    # Receptors are queried concurrently ('num_workers' in config), with the query rate limited to 'max_queries_per_second' (no limit if null)
+    rate_limiter = RateLimiter(cfg["max_queries_per_second"]) if cfg.get("max_queries_per_second") else None
+    with ThreadPoolExecutor(max_workers=cfg.get("num_workers", 8)) as executor:
+        # map returns results in the order of receptors, so the order of rows in info.csv does not depend on the order in which queries complete
+        queried = dict(zip(to_query, tqdm(executor.map(lambda receptor: mine_receptor(receptor, cfg, rate_limiter), to_query), "Querying receptor expression data", total=len(to_query))))
+    saved = saved_receptor_data(cfg, up_to_date) if len(up_to_date) > 0 else {}
+    results = [queried[R] if R in queried else saved[R] for R in receptors]
+
+    # Dataframe which will contain metadata of queried experiments (experiment id, structures, filename, plane, availability of data)
+    info_df = pd.DataFrame([row for receptor_info, _ in results for row in receptor_info])
 
     # Saving metatdata to CSV file
-    if cfg["save_area_filtered_data"]: pd.DataFrame(info_df).to_csv(mkdir(cfg["output_file_path"])+"info.csv", index=False)
+    if cfg["save_area_filtered_data"]: info_df.to_csv(mkdir(cfg["output_file_path"])+"info.csv", index=False)
+
+    # Saving expression values of target structures of all receptors into the expression table, from which Excel files and downstream analyses are derived
+    experiments_df = info_df[info_df['experiment_id']!='null'][['receptor', 'experiment_id', 'plane', 'has_data']]
+    experiments_df['has_data'] = experiments_df['has_data']=='true'
+    expression_df = [receptor_expression for _, receptor_expression in results if len(receptor_expression) > 0]
+    expression_df = pd.concat(expression_df, ignore_index=True) if len(expression_df) > 0 else pd.DataFrame(columns=['receptor', 'experiment_id', 'plane', 'structure_id'])
+    expression_df['structure'] = expression_df['structure_id'].map({s: query_structure_name(s) for s in expression_df['structure_id'].unique()})
+    write_expression_table(table_path, receptors, experiments_df, expression_df)
+
+    # Manifest is updated after the expression table is written, so receptors of an interrupted run are queried again
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    manifest = {R: manifest[R] if R not in queried else {'criteria_hash': criteria_hash, 'experiments': [row['experiment_id'] for row in queried[R][0] if row['experiment_id'] != 'null'], 'timestamp': timestamp} for R in receptors}
+    write_mining_manifest(cfg, manifest)
+
+def excel_header_cell(sheet, value):
+    # Header and index cells are formatted as by DataFrame.to_excel
+    cell = WriteOnlyCell(sheet, value=value)
+    cell.font = Font(bold=True)
+    cell.border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    cell.alignment = Alignment(horizontal='center', vertical='top')
+    return cell
+
+def excel_value(value):
+    if isinstance(value, float) and np.isnan(value): return None
+    if isinstance(value, float) and np.isinf(value): return 'inf' if value > 0 else '-inf'
+    return value
+
+def write_excel_sheets(filename, sheets):
+    """
+    Writes DataFrames into sheets of an Excel file row by row with a write-only (streaming) workbook, in the same layout as DataFrame.to_excel.
+
+        Parameters:
+            filename (str): path to the Excel file.
+            sheets (dict): dictionary of the form {sheet_name: pandas.DataFrame}.
+    """
+    workbook = Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        sheet = workbook.create_sheet(sheet_name)
+        sheet.append([None] + [excel_header_cell(sheet, column) for column in df.columns])
+        for index, row in zip(df.index, df.itertuples(index=False, name=None)):
+            sheet.append([excel_header_cell(sheet, index)] + [excel_value(value) for value in row])
+    workbook.save(filename)
 
 def save_to_excel(cfg):
+    """
+    Builds 'Full Data', 'Averaged Experiments' and 'Averaged Structures' sheets for every variable in 'excel_data_to_save' and saves them into '{variable}_data.xlsx' files.
+    Sheets are derived from the expression table written by 'run_data_mining': the rows of all variables are read at once and aggregated with groupby.
+    """
     
     # Querying names corresponding to structure IDs from config
     structures = {query_structure_name(x): x for x in cfg['structures']}
+    structure_names = np.array(list(structures.keys()), dtype=object)
+    structure_ids = np.array(list(structures.values()), dtype=object)
+    variables = cfg["excel_data_to_save"]
     
-    # Loading metadata
-    info_df = pd.read_csv(cfg["output_file_path"]+"info.csv")
+    # Loading metadata of queried experiments, receptors without experiments are listed with 'null' values
+    table_path = expression_table_path(cfg["output_file_path"])
+    experiments_df = read_experiments(table_path)
+    receptors = read_receptors(table_path)
+    no_experiments = [R for R in receptors if R not in set(experiments_df['receptor'])]
+    info_df = pd.concat([experiments_df.astype(object), pd.DataFrame({'receptor': no_experiments, 'experiment_id': np.nan, 'plane': np.nan, 'has_data': False})], ignore_index=True)
 
     # plane_of_section_id = 1 for coronal
     # plane_of_section_id = 2 for saggital
     plane_dict = {1: 'coronal', 2: 'saggital'}
-    
-    # Main loop for reading, averaging and saving all data types specified in config
-    for variable in cfg["excel_data_to_save"]:
-        # Dataframe to be saved as excel file
-        data_df = []
-        # Receptor loop
-        for receptor in info_df['receptor'].unique():
-            # Experiment loop
-            for exp_id in info_df[info_df['receptor']==receptor]['experiment_id']:
-                exp_df = info_df[(info_df['receptor']==receptor) & (info_df['experiment_id']==exp_id)]
-                # Add 'null' values if receptor has no experiments
-                if isnan(exp_id):
-                    data_df.append({'receptor': receptor,'experiment_id': 'null','plane': 'null','structure': 'null','structure_id': 'null',variable: 'null'})
-                # Add 'null' values if experiment has no unionized data
-                elif exp_df['has_data'].item()==False:
-                    data_df.append({'receptor': receptor,'experiment_id': int(exp_id),'plane': plane_dict[int(exp_df['plane'].item())],
-                                    'structure': 'null','structure_id': 'null',variable: 'null'})
-                else:
-                    # Add queried value to the excel dataframe for each of the structures of interest
-                    for s in structures.keys():
-                        union_data_df = pd.read_csv(cfg["output_file_path"]+"area_filtered/"+exp_df['filename'].item())
-                        exp_var_df = union_data_df[union_data_df['structure_id']==structures[s]][variable]
-                        if len(exp_var_df)==0: exp_variable = 'null'
-                        else: exp_variable = exp_var_df.item()
-                        data_df.append({'receptor': receptor,'experiment_id': int(exp_id),'plane': plane_dict[int(exp_df['plane'].item())],
-                                'structure': s,'structure_id': structures[s],variable: exp_variable})  
-        sheet1_df = pd.DataFrame(data_df)
-
-        # Taking an average over experiments
+
+    # Experiments of every receptor are listed in the order of the receptor list
+    info_df = info_df.assign(receptor_rank=info_df['receptor'].map({r: i for i, r in enumerate(receptors)})).sort_values('receptor_rank', kind='stable').reset_index(drop=True)
+    no_experiment = info_df['experiment_id'].isna().to_numpy()
+    has_data = ~no_experiment & ~(info_df['has_data']==False).to_numpy()
+    info_df['experiment_id'] = pd.Series(['null' if n else int(e) for e, n in zip(info_df['experiment_id'], no_experiment)], dtype=object)
+    info_df['plane'] = pd.Series(['null' if n else plane_dict[int(p)] for p, n in zip(info_df['plane'], no_experiment)], dtype=object)
+
+    # Full data: one row per structure for experiments with data, one row with 'null' values otherwise
+    repeats = np.where(has_data, len(structures), 1)
+    full_df = info_df.loc[info_df.index.repeat(repeats)]
+    row_has_data = has_data[full_df.index]
+    full_df = full_df.assign(structure_position=np.where(row_has_data, full_df.groupby(level=0).cumcount().to_numpy(), -1)).reset_index(drop=True)
+    full_df['structure'] = np.where(row_has_data, structure_names[full_df['structure_position']], 'null')
+    full_df['structure_id'] = np.where(row_has_data, structure_ids[full_df['structure_position']], 'null')
+
+    values_df = read_expression_table(table_path, structures=list(structures.values()), columns=variables)
+    values_df = values_df[['receptor', 'experiment_id', 'structure_id'] + list(variables)].drop_duplicates(['receptor', 'experiment_id', 'structure_id']).astype(object)
+    full_df = full_df.merge(values_df.assign(found=True), on=['receptor', 'experiment_id', 'structure_id'], how='left', sort=False)
+    found = (full_df['found']==True).to_numpy()
+    sheet1_base = full_df[['receptor', 'experiment_id', 'plane', 'structure', 'structure_id']]
+
+    for variable in variables:
+        sheet1_df = sheet1_base.assign(**{variable: np.where(found, full_df[variable], 'null')})
+
+        # Taking an average over experiments (only float values are averaged, as 'null' values are strings)
+        numeric = pd.Series([x if isinstance(x, float) else np.nan for x in sheet1_df[variable]], dtype=np.float64)
+        grouped = pd.DataFrame({'receptor_rank': full_df['receptor_rank'], 'structure_position': full_df['structure_position'], variable: numeric})
+        grouped = grouped[row_has_data].groupby(['receptor_rank', 'structure_position'])[variable].mean()
         sheet2_df = []
-        for R in info_df['receptor'].unique():
-            for S in structures:
-                # Selecting all experiments for a particular receptor and structure
-                df = sheet1_df[(sheet1_df['receptor']==R) & (sheet1_df['structure']==S)]
-                if len(df)==0:
+        for r, R in enumerate(receptors):
+            for p, S in enumerate(structures):
+                if (r, p) not in grouped.index:
                     sheet2_df.append({'receptor': R,'structure': 'null','structure_id': 'null','average_'+variable: 'null'})
                     continue
-                # Taking the mean variable (e.g. expression density) over all experiments in one structure
-                exp_var = df[df[variable].apply(lambda x: isinstance(x, float))][variable].mean()
-                sheet2_df.append({'receptor': R,'structure': S,'structure_id': structures[S],'average_'+variable: exp_var})
+                sheet2_df.append({'receptor': R,'structure': S,'structure_id': structures[S],'average_'+variable: grouped[(r, p)]})
         sheet2_df = pd.DataFrame(sheet2_df)
 
-        # Taking an average over V2m structures
+        # Taking an average over V2m structures (all structures except V1_2/3 and V1)
+        averages = grouped.reset_index()
+        averages['structure_id'] = structure_ids[averages['structure_position']]
+        v2m = averages[~averages['structure_id'].isin([821, 385])].groupby('receptor_rank')[variable].mean()
+        v1_2_3 = averages[averages['structure_id']==821].groupby('receptor_rank')[variable].first()
+        v1 = averages[averages['structure_id']==385].groupby('receptor_rank')[variable].first()
         sheet3_df = []
-        for R in info_df['receptor'].unique():
-            # Selecting all experiment averages in three V2m structures
-            v2m_df = sheet2_df[(sheet2_df['receptor']==R) & (sheet2_df['structure_id']!=821) & (sheet2_df['structure_id']!=385)]
-            # Selecting all experiment averages in V1_2/3
-            v1_2_3_df = sheet2_df[(sheet2_df['receptor']==R) & (sheet2_df['structure_id']==821)]
-            # Selecting all experiment averages in V1
-            v1_df = sheet2_df[(sheet2_df['receptor']==R) & (sheet2_df['structure_id']==385)]
-            # Set to temporary variable to 'null' if there are no averaged entries, else set to average
-            if len(v2m_df[v2m_df['average_'+variable].apply(lambda x: isinstance(x, float))])==0: v2m_exp_var = 'null'
-            else: v2m_exp_var = v2m_df['average_'+variable].mean()
-
-            if len(v1_2_3_df[v1_2_3_df['average_'+variable].apply(lambda x: isinstance(x, float))])==0: v1_2_3_exp_var = 'null'
-            else: v1_2_3_exp_var = v1_2_3_df['average_'+variable].item()
-
-            if len(v1_df[v1_df['average_'+variable].apply(lambda x: isinstance(x, float))])==0: v1_exp_var = 'null'
-            else: v1_exp_var = v1_df['average_'+variable].item()
-
-            sheet3_df.append({'receptor': R,'structure': 'V2m2/3','average_'+variable: v2m_exp_var})
-            sheet3_df.append({'receptor': R,'structure': 'VISp2/3','average_'+variable: v1_2_3_exp_var})
-            sheet3_df.append({'receptor': R,'structure': 'VISp','average_'+variable: v1_exp_var})
+        for r, R in enumerate(receptors):
+            sheet3_df.append({'receptor': R,'structure': 'V2m2/3','average_'+variable: v2m[r] if r in v2m.index else 'null'})
+            sheet3_df.append({'receptor': R,'structure': 'VISp2/3','average_'+variable: v1_2_3[r] if r in v1_2_3.index else 'null'})
+            sheet3_df.append({'receptor': R,'structure': 'VISp','average_'+variable: v1[r] if r in v1.index else 'null'})
         sheet3_df = pd.DataFrame(sheet3_df)
 
         # Save dataframes as excel files
-        with pd.ExcelWriter(cfg["output_file_path"]+variable+'_data.xlsx') as writer:
-            sheet1_df.to_excel(writer, sheet_name='Full Data')
-            sheet2_df.to_excel(writer, sheet_name='Averaged Experiments')
-            sheet3_df.to_excel(writer, sheet_name='Averaged Structures')
+        write_excel_sheets(cfg["output_file_path"]+variable+'_data.xlsx', {'Full Data': sheet1_df, 'Averaged Experiments': sheet2_df, 'Averaged Structures': sheet3_df})
 
         print("Saving data to Excel completed.")
 
@@ -0,0 +1,122 @@
+import os
+import re
+import sys
+import inspect
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+# Input data is hashed in the same way as checkpoints of the connectivity pipeline
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', 'connectivity'))
+from Checkpoints import content_hash
+
+def use_agg_backend():
+    # Figures are rendered without a display
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+def render_figure(plot_function, data, parameters, path, file_format, dpi):
+    """
+    Renders one figure: calls plot_function(data, **parameters), which returns a matplotlib figure, and saves the figure to 'path'.
+    The figure is saved into a temporary file first, so an interrupted render never leaves a partial file under the name of its hash.
+    The backend is not changed here (worker processes are switched to Agg by the pool initializer): in the calling process the figure is created
+    with interactive mode off, so it is never shown and open figures of the caller are kept.
+    """
+    import matplotlib.pyplot as plt
+    # plt.ioff() is not a context manager before matplotlib 3.5 (allendata.yml pins 3.4.2), so the previous mode is restored explicitly
+    interactive = plt.isinteractive()
+    plt.ioff()
+    try: fig = plot_function(data, **parameters)
+    finally:
+        if interactive: plt.ion()
+    tmp_path = path + '.tmp'
+    fig.savefig(tmp_path, format=file_format, dpi=dpi)
+    plt.close(fig)
+    os.replace(tmp_path, path)
+    return path
+
+class BatchRenderer:
+    """
+    A class to render batches of matplotlib figures headless (Agg backend) in a process pool. Every figure is saved as '{name}_{hash}.{format}',
+    where the hash identifies its input data, plot parameters and the code of the module of the plot function. Figures whose file with the same hash exists are not rendered again,
+    so after a change of data only the affected figures are rendered. Files of previous versions of a figure (same name, other hash) are removed.
+
+    Attributes
+    ----------
+    output_dir : str
+        Directory where figures are saved.
+    file_format : str
+        Format of figure files (e.g. 'png', 'pdf').
+    dpi : int
+        Resolution of figures.
+    num_workers : int
+        Number of worker processes (number of CPUs if None, 1 renders in this process).
+    tasks : dict
+        Figures added to the batch: {name: (plot_function, data, parameters)}.
+
+    Methods
+    -------
+    add(name, plot_function, data, **parameters):
+        Adds a figure to the batch.
+    render():
+        Renders figures which changed and returns paths of all figures of the batch.
+    """
+    def __init__(self, output_dir, file_format='png', dpi=100, num_workers=None):
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.dpi = dpi
+        self.num_workers = num_workers or os.cpu_count()
+        self.tasks = {}
+        if not os.path.exists(self.output_dir): os.makedirs(self.output_dir)
+
+    def add(self, name, plot_function, data, **parameters):
+        """
+        Adds a figure to the batch.
+
+            Parameters:
+                name (str): name of the figure (prefix of its file name).
+                plot_function (function): function defined at the top level of a module (so that it can be sent to worker processes),
+                                          which takes 'data' and 'parameters' and returns a matplotlib figure.
+                                          The source of its whole module is hashed, so changes of helpers and constants of that module are detected,
+                                          but changes of code imported from other modules are not (remove the figures to render them again).
+                data: input data of the figure (e.g. DataFrame, numpy array, dictionary).
+                parameters: keyword arguments of plot_function.
+        """
+        self.tasks[name] = (plot_function, data, parameters)
+
+    def figure_hash(self, name):
+        plot_function, data, parameters = self.tasks[name]
+        # Source of the module of the plot function, so that edits of its helpers and module constants render the figure again
+        try: source = [inspect.getsource(inspect.getmodule(plot_function)), plot_function.__qualname__]
+        except (OSError, TypeError):
+            try: source = inspect.getsource(plot_function)
+            except (OSError, TypeError): source = plot_function.__module__ + '.' + plot_function.__qualname__
+        key_parts = [name, source, sorted(parameters.items()), content_hash(data), self.file_format, self.dpi]
+        return hashlib.sha256(repr(key_parts).encode()).hexdigest()[:16]
+
+    def figure_path(self, name, key):
+        return os.path.join(self.output_dir, f'{name}_{key}.{self.file_format}')
+
+    def remove_previous_versions(self, name, key):
+        pattern = re.compile(re.escape(name) + r'_[0-9a-f]{16}\.' + re.escape(self.file_format) + '$')
+        for filename in os.listdir(self.output_dir):
+            if pattern.match(filename) and filename != os.path.basename(self.figure_path(name, key)): os.remove(os.path.join(self.output_dir, filename))
+
+    def render(self):
+        """
+        Renders figures of the batch which are not saved with their current hash, in parallel.
+
+            Returns:
+                paths (dict): dictionary of the form {name: path to the figure file} for all figures of the batch.
+        """
+        keys = {name: self.figure_hash(name) for name in self.tasks}
+        changed = [name for name in self.tasks if not os.path.isfile(self.figure_path(name, keys[name]))]
+        print(f'Rendering {len(changed)} of {len(self.tasks)} figures ({len(self.tasks)-len(changed)} unchanged).')
+
+        arguments = [(*self.tasks[name], self.figure_path(name, keys[name]), self.file_format, self.dpi) for name in changed]
+        if self.num_workers == 1 or len(changed) < 2:
+            for args in arguments: render_figure(*args)
+        else:
+            with ProcessPoolExecutor(max_workers=self.num_workers, initializer=use_agg_backend) as executor:
+                for future in [executor.submit(render_figure, *args) for args in arguments]: future.result()
+
+        for name in self.tasks: self.remove_previous_versions(name, keys[name])
+        return {name: self.figure_path(name, keys[name]) for name in self.tasks}
@@ -0,0 +1,173 @@
+"""
+Chunked, memory-mapped copies of 3D volumes (e.g. the 10 um annotation volume) for viewers which display single slices.
+A volume is stored in a directory as one .npy array of chunks (chunk grid x chunk shape, 'chunks.npy'), so every chunk is contiguous on disk,
+and a 'volume.json' file with the shape of the volume. The array is memory-mapped when opened, so opening is instant and extracting a slice
+along any axis only reads the chunks which intersect it.
+Annotation volumes are stored as uint16 indexes of structure ids, with a lookup table of the ids ('lut.npy'), which halves the size of the uint32 volume.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+def chunk_grid(shape, chunk_shape):
+    # Number of chunks along every axis (chunks at the upper edges are padded)
+    return tuple(-(-s // c) for s, c in zip(shape, chunk_shape))
+
+def write_chunked_volume(store_path, volume, chunk_shape=(64, 64, 64), dtype=None, transform=None, metadata=None, arrays=None):
+    """
+    Writes a 3D volume into a chunked store directory. The volume is read in slabs of one chunk along the first axis,
+    so it can be a memory-mapped array which does not fit into memory.
+
+        Parameters:
+            store_path (str): path to the store directory (replaced if it exists).
+            volume (numpy.ndarray): 3D volume (or any array-like object supporting slicing of the first axis and a 'shape' attribute).
+            chunk_shape (tuple): shape of chunks.
+            dtype (numpy.dtype): data type of the store (data type of the volume if None).
+            transform (function): function applied to every slab before it is written (e.g. mapping of values).
+            metadata (dict): additional entries of 'volume.json'.
+            arrays (dict): additional arrays saved into the store as '{name}.npy', of the form {name: array}.
+    """
+    shape = tuple(int(s) for s in volume.shape)
+    chunk_shape = tuple(int(min(c, s)) for c, s in zip(chunk_shape, shape))
+    grid = chunk_grid(shape, chunk_shape)
+    dtype = np.dtype(dtype or volume.dtype)
+
+    # Store is written into a temporary directory which replaces the previous store at the end, so an interrupted conversion never leaves a partial store
+    tmp_path = store_path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path): shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    chunks = np.lib.format.open_memmap(os.path.join(tmp_path, 'chunks.npy'), mode='w+', dtype=dtype, shape=grid + chunk_shape)
+    c0, c1, c2 = chunk_shape
+    for i in range(grid[0]):
+        slab = np.asarray(volume[i*c0:(i+1)*c0])
+        if transform is not None: slab = transform(slab)
+        padded = np.zeros((c0, grid[1]*c1, grid[2]*c2), dtype=dtype)
+        padded[:slab.shape[0], :shape[1], :shape[2]] = slab
+        # (c0, n1*c1, n2*c2) -> (n1, n2, c0, c1, c2)
+        chunks[i] = padded.reshape(c0, grid[1], c1, grid[2], c2).transpose(1, 3, 0, 2, 4)
+    chunks.flush()
+    del chunks
+    for name, array in (arrays or {}).items(): np.save(os.path.join(tmp_path, name + '.npy'), array)
+    with open(os.path.join(tmp_path, 'volume.json'), 'w') as outfile: json.dump({'shape': shape, 'chunk_shape': chunk_shape, **(metadata or {})}, outfile)
+
+    if os.path.exists(store_path): shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+class ChunkedVolume:
+    """
+    A class to access a 3D volume written by 'write_chunked_volume'. Chunks are memory-mapped, so only the chunks of extracted slices are read from disk.
+
+    Attributes
+    ----------
+    store_path : str
+        Path to the store directory.
+    chunks : numpy.memmap
+        Read-only array of chunks of shape (chunk grid) + (chunk shape).
+    shape : tuple
+        Shape of the volume.
+    chunk_shape : tuple
+        Shape of chunks.
+    metadata : dict
+        Contents of 'volume.json'.
+
+    Methods
+    -------
+    slice(axis, index):
+        Returns the 2D slice of the volume at 'index' along 'axis'.
+    value(i, j, k):
+        Returns the value of a voxel.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'volume.json'), 'r') as file: self.metadata = json.loads(file.read())
+        self.shape = tuple(self.metadata['shape'])
+        self.chunk_shape = tuple(self.metadata['chunk_shape'])
+        self.chunks = np.load(os.path.join(store_path, 'chunks.npy'), mmap_mode='r')
+
+    @property
+    def dtype(self):
+        return self.chunks.dtype
+
+    def slice(self, axis, index):
+        """
+        Returns the slice of the volume at 'index' along 'axis' (the same as volume[index], volume[:,index] or volume[:,:,index]) as a 2D array.
+        Only chunks intersecting the slice are read, and only the rows of the slice within every chunk.
+        """
+        if not 0 <= index < self.shape[axis]: raise IndexError(f'Index {index} is out of bounds for axis {axis} with size {self.shape[axis]}')
+        chunk, offset = divmod(index, self.chunk_shape[axis])
+        selection = [slice(None)]*6
+        selection[axis], selection[3+axis] = chunk, offset
+        # (n_a, n_b, c_a, c_b) -> (n_a*c_a, n_b*c_b), cropped to the volume
+        block = self.chunks[tuple(selection)]
+        n_a, n_b, c_a, c_b = block.shape
+        rows, columns = [s for a, s in enumerate(self.shape) if a != axis]
+        return np.ascontiguousarray(block.transpose(0, 2, 1, 3).reshape(n_a*c_a, n_b*c_b)[:rows, :columns])
+
+    def value(self, i, j, k):
+        (ci, oi), (cj, oj), (ck, ok) = [divmod(index, c) for index, c in zip((i, j, k), self.chunk_shape)]
+        return self.chunks[ci, cj, ck, oi, oj, ok]
+
+class AnnotationVolume(ChunkedVolume):
+    """
+    A class to access an annotation volume written by 'write_annotation_volume': a chunked volume of uint16 labels (indexes into 'lut')
+    and a lookup table of structure ids ('lut.npy'). Slices are returned as structure ids.
+
+    Attributes
+    ----------
+    lut : numpy.ndarray
+        Sorted structure ids (0 is the label of voxels outside the brain if there are any).
+
+    Methods
+    -------
+    labels(axis, index):
+        Returns uint16 labels of a slice.
+    slice(axis, index):
+        Returns structure ids of a slice.
+    value(i, j, k):
+        Returns the structure id of a voxel.
+    """
+    def __init__(self, store_path):
+        super().__init__(store_path)
+        self.lut = np.load(os.path.join(store_path, 'lut.npy'))
+
+    def labels(self, axis, index):
+        return super().slice(axis, index)
+
+    def slice(self, axis, index):
+        return self.lut[self.labels(axis, index)]
+
+    def value(self, i, j, k):
+        return self.lut[super().value(i, j, k)]
+
+def label_lut(annotation, step=64):
+    # Sorted structure ids of an annotation volume, collected slab by slab, which uint16 labels index
+    lut = np.unique(np.concatenate([np.unique(np.asarray(annotation[i:i+step])) for i in range(0, annotation.shape[0], step)]))
+    if len(lut) > np.iinfo(np.uint16).max + 1: raise ValueError(f'Annotation volume has {len(lut)} structure ids, more than uint16 labels can index')
+    return lut
+
+def write_annotation_volume(store_path, annotation, chunk_shape=(64, 64, 64)):
+    """
+    Writes an annotation volume (structure ids) into a chunked store of uint16 labels and a lookup table of structure ids.
+    Ids are collected and mapped to labels slab by slab, so no temporary copy of the whole volume is made.
+    """
+    lut = label_lut(annotation, chunk_shape[0])
+    write_chunked_volume(store_path, annotation, chunk_shape, dtype=np.uint16, transform=lambda slab: np.searchsorted(lut, slab).astype(np.uint16), arrays={'lut': lut})
+
+def open_annotation_volume(annotation_path, store_path=None, resolution=10):
+    """
+    Opens the chunked store of the annotation volume, converting the annotation volume first if the store does not exist.
+    The annotation volume is loaded (downloaded if needed) with MouseConnectivityCache only for the conversion.
+    By default the store is the '{annotation file name}_chunked' directory next to the annotation file (e.g. annotation_10.nrrd).
+    """
+    annotation_path = str(annotation_path)
+    if store_path is None: store_path = os.path.splitext(annotation_path)[0] + '_chunked'
+    if not os.path.isfile(os.path.join(store_path, 'lut.npy')):
+        from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
+        print('Converting', annotation_path, 'into', store_path)
+        mcc = MouseConnectivityCache(resolution=resolution)
+        annotation, _ = mcc.get_annotation_volume(annotation_path)
+        write_annotation_volume(store_path, annotation)
+        del annotation
+    return AnnotationVolume(store_path)
@@ -1,4 +1,3 @@
-from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 import numpy as np
 import os
 import matplotlib
@@ -6,19 +5,28 @@ import matplotlib.pyplot as plt
 from pathlib import Path
 import pickle
 import time
+import sys
+# Acronyms of areas are looked up in the ontology index of the connectivity pipeline
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', 'connectivity'))
+from RMALoaders import get_ontology
+from ChunkedVolumes import open_annotation_volume
 
 class Plotter:
     def __init__(self, annotation_path, data_path):
         self.data_path = data_path
+        self.annotation_path = annotation_path
+        # Chunked copy of the annotation volume, opened (and converted on the first use) when a slice is plotted
+        self._annot_vol = None
 
-        mcc = MouseConnectivityCache(resolution=10)
-        print('Allen Mouse Connectivity library loaded.')
+        # Acronyms corresponding to area ids
+        self.areas_acronyms_dict = get_ontology().acronym_map()
 
-        self.annot_vol, _ = mcc.get_annotation_volume(annotation_path)
-        print(f'Annotation volume with shape {self.annot_vol.shape} loaded.')
-
-        # Reading acronyms corresponding to area ids
-        with open(data_path / 'areas_acronyms.pkl', 'rb') as f: self.areas_acronyms_dict = pickle.load(f)
+    @property
+    def annot_vol(self):
+        if self._annot_vol is None:
+            self._annot_vol = open_annotation_volume(self.annotation_path, resolution=10)
+            print(f'Annotation volume with shape {self._annot_vol.shape} opened.')
+        return self._annot_vol
 
     def load_parameters(self,parameters):
         print('Parameters loaded:')
@@ -66,7 +74,7 @@ class Plotter:
 
         plt.title(f'{self.parameters["projection_type"]} {self.parameters["area"]} hem={self.parameters["hemisphere_id"]} inj_vol_thresh={self.parameters["injection_volume_threshold"]} target_vol_thresh={self.parameters["projection_volume_threshold"]} {self.parameters["projection_metric"]}')
 
-        plt.imshow(self.annot_vol[:,400,:], cmap='gray', aspect='equal', vmin=0, vmax=2000)
+        plt.imshow(self.annot_vol.slice(1, 400), cmap='gray', aspect='equal', vmin=0, vmax=2000)
 
         norm = matplotlib.colors.Normalize(vmin=min(self.proj_metric), vmax=max(self.proj_metric))
 
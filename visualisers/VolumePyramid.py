@@ -0,0 +1,146 @@
+"""
+Multi-resolution pyramids of 3D volumes (e.g. mean difference volumes and annotation.npy from connectivity/exploring_projections.ipynb) for slice viewers.
+Every level is the volume downsampled by an integer factor (by default 1, 2, 4 and 8, i.e. 10, 20, 40 and 80 um for a 10 um volume),
+stored as a chunked, memory-mapped volume (see ChunkedVolumes.py) in the pyramid directory ('level_{factor}'), with 'pyramid.json' holding the factors
+and the range of values of the volume. Viewers show a coarse level while the slice index changes and the full resolution level when it stops.
+Data volumes are downsampled by block means, annotation volumes by taking every factor-th voxel (structure ids are stored as uint16 labels with a lookup table).
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+from ChunkedVolumes import ChunkedVolume, write_chunked_volume, label_lut
+
+class DownsampledVolume:
+    """
+    A view of a 3D volume downsampled by an integer factor along every axis, computed when slabs of the first axis are read (volume[start:stop]).
+    Every output row is computed from 'factor' rows of the source volume, so a memory-mapped source is never read at once.
+    With method 'mean' a voxel is the mean of its block (blocks at the upper edges are smaller), with method 'nearest' it is the first voxel of its block.
+    """
+    def __init__(self, volume, factor, method='mean'):
+        self.volume = volume
+        self.factor = factor
+        self.method = method
+        self.shape = tuple(-(-s // factor) for s in volume.shape)
+        self.dtype = volume.dtype if method == 'nearest' else np.result_type(volume.dtype, np.float32)
+
+    def __getitem__(self, rows):
+        start, stop, _ = rows.indices(self.shape[0])
+        f = self.factor
+        if self.method == 'nearest': return np.asarray(self.volume[start*f:stop*f:f, ::f, ::f])
+        slab = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        for row in range(start, stop):
+            block = np.asarray(self.volume[row*f:(row+1)*f], dtype=np.float64)
+            counts = np.ones(1)
+            for axis, size in enumerate(block.shape):
+                starts = np.arange(0, size, f)
+                block = np.add.reduceat(block, starts, axis=axis)
+                counts = np.multiply.outer(counts, np.diff(np.append(starts, size)))
+            slab[row - start] = (block/counts.reshape(block.shape))[0]
+        return slab
+
+def write_volume_pyramid(store_path, volume, factors=(1, 2, 4, 8), method='mean', labels=False, chunk_shape=(64, 64, 64)):
+    """
+    Writes a 3D volume into a pyramid directory.
+
+        Parameters:
+            store_path (str): path to the pyramid directory (replaced if it exists).
+            volume (numpy.ndarray): 3D volume, e.g. memory-mapped with numpy.load(path, mmap_mode='r').
+            factors (list): downsampling factors of levels, starting with 1 (full resolution).
+            method (str): downsampling method, 'mean' (data volumes) or 'nearest' (annotation volumes).
+            labels (bool): store values as uint16 labels with a lookup table ('lut.npy', for annotation volumes).
+            chunk_shape (tuple): shape of chunks of every level.
+    """
+    # Pyramid is written into a temporary directory which replaces the previous pyramid at the end, so an interrupted conversion never leaves a partial pyramid
+    tmp_path = store_path.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_path): shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # Range of values (NaN are ignored) for color scales of viewers, computed slab by slab
+    step = chunk_shape[0]
+    minimum, maximum = np.nan, np.nan
+    for i in range(0, volume.shape[0], step):
+        slab = np.asarray(volume[i:i+step])
+        if np.all(np.isnan(slab)): continue
+        minimum, maximum = float(np.fmin(minimum, np.nanmin(slab))), float(np.fmax(maximum, np.nanmax(slab)))
+
+    transform, dtype = None, None
+    if labels:
+        lut = label_lut(volume, step)
+        np.save(os.path.join(tmp_path, 'lut.npy'), lut)
+        transform, dtype = lambda slab: np.searchsorted(lut, slab).astype(np.uint16), np.uint16
+    for factor in factors:
+        level = volume if factor == 1 else DownsampledVolume(volume, factor, method)
+        write_chunked_volume(os.path.join(tmp_path, f'level_{factor}'), level, chunk_shape, dtype=dtype, transform=transform)
+
+    with open(os.path.join(tmp_path, 'pyramid.json'), 'w') as outfile:
+        json.dump({'shape': [int(s) for s in volume.shape], 'factors': list(factors), 'method': method, 'minimum': minimum, 'maximum': maximum}, outfile)
+    if os.path.exists(store_path): shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+class VolumePyramid:
+    """
+    A class to access a pyramid written by 'write_volume_pyramid'. Levels are memory-mapped, so opening is instant and a slice only reads chunks of its level.
+
+    Attributes
+    ----------
+    store_path : str
+        Path to the pyramid directory.
+    shape : tuple
+        Shape of the full resolution volume.
+    factors : list
+        Downsampling factors of levels (level 0 is the full resolution).
+    levels : list
+        ChunkedVolume of every level.
+    lut : numpy.ndarray
+        Lookup table of values of uint16 labels (None if values are stored directly).
+    minimum, maximum : float
+        Range of values of the volume.
+
+    Methods
+    -------
+    slice(axis, index, level=0):
+        Returns the slice at full resolution 'index' along 'axis' from a level.
+    preview_level(axis, max_pixels=256*256):
+        Returns the finest level whose slices along 'axis' have at most 'max_pixels' pixels.
+    value(i, j, k):
+        Returns the value of a voxel at full resolution.
+    """
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(os.path.join(store_path, 'pyramid.json'), 'r') as file: metadata = json.loads(file.read())
+        self.shape = tuple(metadata['shape'])
+        self.factors = metadata['factors']
+        self.minimum, self.maximum = metadata['minimum'], metadata['maximum']
+        self.levels = [ChunkedVolume(os.path.join(store_path, f'level_{factor}')) for factor in self.factors]
+        lut_path = os.path.join(store_path, 'lut.npy')
+        self.lut = np.load(lut_path) if os.path.isfile(lut_path) else None
+
+    def decode(self, values):
+        return values if self.lut is None else self.lut[values]
+
+    def slice(self, axis, index, level=0):
+        return self.decode(self.levels[level].slice(axis, index // self.factors[level]))
+
+    def preview_level(self, axis, max_pixels=256*256):
+        for level, volume in enumerate(self.levels):
+            if np.prod([s for a, s in enumerate(volume.shape) if a != axis]) <= max_pixels: return level
+        return len(self.levels) - 1
+
+    def value(self, i, j, k):
+        return self.decode(self.levels[0].value(i, j, k))
+
+def open_volume_pyramid(npy_path, store_path=None, labels=False, factors=(1, 2, 4, 8)):
+    """
+    Opens the pyramid of a volume saved as .npy, converting the volume first if the pyramid does not exist or is older than the .npy file.
+    The .npy file is memory-mapped for the conversion, so it is never loaded at once. By default the pyramid is the '{file name}_pyramid' directory next to the .npy file.
+    Annotation volumes (labels=True) are downsampled by taking every factor-th voxel and stored as uint16 labels.
+    """
+    npy_path = str(npy_path)
+    if store_path is None: store_path = os.path.splitext(npy_path)[0] + '_pyramid'
+    metadata_path = os.path.join(store_path, 'pyramid.json')
+    if not os.path.isfile(metadata_path) or os.path.getmtime(metadata_path) < os.path.getmtime(npy_path):
+        print('Converting', npy_path, 'into', store_path)
+        write_volume_pyramid(store_path, np.load(npy_path, mmap_mode='r'), factors, method='nearest' if labels else 'mean', labels=labels)
+    return VolumePyramid(store_path)
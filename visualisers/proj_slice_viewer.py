@@ -2,17 +2,23 @@ import numpy as np
 import matplotlib.pyplot as plt
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 from pathlib import Path
+from VolumePyramid import open_volume_pyramid
 
 class IndexTracker(object):
-    def __init__(self, ax, X):
+    # Slices along the first axis of a volume pyramid: a coarse level is shown while scrolling, the full resolution after refine_delay ms without scrolling
+    def __init__(self, ax, X, refine_delay=200):
         self.ax = ax
         ax.set_title('use scroll wheel to navigate images')
 
         self.X = X
-        rows, cols, self.slices = X.shape
+        self.slices, rows, cols = X.shape
         self.ind = self.slices//2
+        self.preview_level = X.preview_level(0)
 
-        self.im = ax.imshow(self.X[:, :, self.ind], cmap='hot')
+        self.im = ax.imshow(self.X.slice(0, self.ind), cmap='hot', extent=(-0.5, cols-0.5, rows-0.5, -0.5))
+        self.timer = ax.figure.canvas.new_timer(interval=refine_delay)
+        self.timer.single_shot = True
+        self.timer.add_callback(self.update)
         self.update()
 
     def onscroll(self, event):
@@ -21,10 +27,12 @@ class IndexTracker(object):
             self.ind = (self.ind + 1) % self.slices
         else:
             self.ind = (self.ind - 1) % self.slices
-        self.update()
+        self.update(self.preview_level)
+        self.timer.stop()
+        self.timer.start()
 
-    def update(self):
-        self.im.set_data(self.X[:, :, self.ind])
+    def update(self, level=0):
+        self.im.set_data(self.X.slice(0, self.ind, level))
         ax.set_ylabel('slice %s' % self.ind)
         self.im.axes.figure.canvas.draw()
 
@@ -35,13 +43,14 @@ class IndexTracker(object):
 path = Path.home() / 'Desktop' / 'data' / 'connectivity' / 'mean_difference_single_hemisphere_data'
 
 # array_to_visualise = pd
-# array_to_visualise = np.load('diff_VISpm_VISam.npy')
-# array_to_visualise = np.load('annotation.npy')
-array_to_visualise = np.load(path / 'VISpm_VISam_MAD.npy')
+# array_to_visualise = open_volume_pyramid('diff_VISpm_VISam.npy')
+# array_to_visualise = open_volume_pyramid('annotation.npy', labels=True)
+# Memory-mapped pyramid of the volume (converted on the first run), slices along its first axis are shown
+array_to_visualise = open_volume_pyramid(path / 'VISpm_VISam_MAD.npy')
 
 fig, ax = plt.subplots(1, 1)
 
-tracker = IndexTracker(ax, np.transpose(array_to_visualise, (1, 2, 0)))
+tracker = IndexTracker(ax, array_to_visualise)
 
 fig.canvas.mpl_connect('scroll_event', tracker.onscroll)
 plt.show()
\ No newline at end of file
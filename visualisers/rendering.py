@@ -1,9 +1,14 @@
 from brainrender import Scene
 from brainrender.actors import Point, Points
 import matplotlib
+import os
+import sys
 import pickle
 import numpy as np
 from pathlib import Path
+# Acronyms of areas are looked up in the ontology index of the connectivity pipeline (read from its cache, without allensdk)
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..', 'connectivity'))
+from Ontology import cached_ontology
 
 # Atlas dimensions
 # 13200 µm x 8000 µm x 11400 µm
@@ -29,8 +34,11 @@ area_ids = list(centroids_dict.keys())
 xyz = [area[:3] for area in vals]
 proj_metric = [area[3] for area in vals]
 
-# Reading acronyms corresponding to area ids
-with open(path / 'areas_acronyms.pkl', 'rb') as f: areas_acronyms_dict = pickle.load(f)
+# Acronyms corresponding to area ids (from areas_acronyms.pkl if the ontology was never loaded by the connectivity pipeline)
+ontology = cached_ontology()
+if ontology is not None: areas_acronyms_dict = ontology.acronym_map()
+else:
+    with open(path / 'areas_acronyms.pkl', 'rb') as f: areas_acronyms_dict = pickle.load(f)
 
 # Defining data normalisation
 norm = matplotlib.colors.Normalize(vmin=min(proj_metric), vmax=max(proj_metric))
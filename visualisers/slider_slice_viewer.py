@@ -6,41 +6,50 @@ from matplotlib.widgets import Slider
 from matplotlib import colors
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
+from VolumePyramid import open_volume_pyramid
+
+# Delay (ms) after the last change of the slider before the slice is shown at full resolution
+refine_delay = 200
 
 def run(filename):
     mcc = MouseConnectivityCache()
     structure_tree = mcc.get_structure_tree()
 
-    A = np.load(filename)
+    # Volumes are opened as memory-mapped pyramids (converted on the first run), a coarse level is shown while the slider moves
+    A = open_volume_pyramid(filename)
     absolute = True
-    if np.any(A<0): absolute = False
+    if A.minimum<0: absolute = False
 
     annotation_filename = '/'.join(filename.split('/')[:-1])+'/annotation.npy'
-    annot = np.load(annotation_filename)
+    annot = open_volume_pyramid(annotation_filename, labels=True)
+    preview_level, annot_preview_level = A.preview_level(0), annot.preview_level(0)
 
     fig,ax = plt.subplots(2,1,figsize=(10,10))
 
     if absolute: cmap = 'hot'
     else:
         cmap = 'seismic'
-        divnorm = colors.TwoSlopeNorm(vmin=A.min(), vcenter=0.0, vmax=A.max())
+        divnorm = colors.TwoSlopeNorm(vmin=A.minimum, vcenter=0.0, vmax=A.maximum)
     annot_cmap = 'gray'
 
     idx0 = 0
-    if absolute: plot1 = ax[0].imshow(A[idx0,:,:], cmap=cmap, vmin=A.min(), vmax=A.max())
-    else: plot1 = ax[0].imshow(A[idx0,:,:], cmap=cmap, norm=divnorm)
+    # Extents in full resolution voxels, so that coarse slices cover the same area and clicked coordinates are full resolution indexes
+    extent = (-0.5, A.shape[2]-0.5, A.shape[1]-0.5, -0.5)
+    annot_extent = (-0.5, annot.shape[2]-0.5, annot.shape[1]-0.5, -0.5)
+    if absolute: plot1 = ax[0].imshow(A.slice(0,idx0), cmap=cmap, vmin=A.minimum, vmax=A.maximum, extent=extent)
+    else: plot1 = ax[0].imshow(A.slice(0,idx0), cmap=cmap, norm=divnorm, extent=extent)
     ax[0].set_title(filename.split('/')[-1])
-    plot2 = ax[1].imshow(annot[idx0,:,:], cmap=annot_cmap, aspect='equal', vmin=0, vmax=2000)
+    plot2 = ax[1].imshow(annot.slice(0,idx0), cmap=annot_cmap, aspect='equal', vmin=0, vmax=2000, extent=annot_extent)
     ax[1].set_title(annotation_filename.split('/')[-1])
 
     axidx = plt.axes([0.1, 0.0, 0.65, 0.03])
-    slidx = Slider(axidx, 'index', 0, A.shape[0], valinit=idx0, valfmt='%d')
+    slidx = Slider(axidx, 'index', 0, A.shape[0]-1, valinit=idx0, valfmt='%d')
 
     def onclick(event):
         if event.inaxes == ax[0] or event.inaxes == ax[1]:
             x = event.xdata
             y = event.ydata
-            structure_id = annot[int(slidx.val),int(y),int(x)]
+            structure_id = annot.value(int(slidx.val),int(y),int(x))
             if structure_id:
                 s = structure_tree.get_structures_by_id([structure_id])[0]
                 name = s['name']
@@ -48,11 +57,21 @@ def run(filename):
                 ax[1].set_title(name+' ('+acronym+') / ID: '+str(structure_id))
             fig.canvas.draw_idle()
 
-    def update(val):
-        idx = slidx.val
-        plot1.set_data(A[int(idx),:,:])
-        plot2.set_data(annot[int(idx),:,:])
+    def show(level, annot_level):
+        idx = int(slidx.val)
+        plot1.set_data(A.slice(0,idx,level))
+        plot2.set_data(annot.slice(0,idx,annot_level))
         fig.canvas.draw_idle()
+
+    # Full resolution slices are shown when the slider has not moved for refine_delay ms
+    timer = fig.canvas.new_timer(interval=refine_delay)
+    timer.single_shot = True
+    timer.add_callback(show, 0, 0)
+
+    def update(val):
+        show(preview_level, annot_preview_level)
+        timer.stop()
+        timer.start()
     slidx.on_changed(update)
 
     divider = make_axes_locatable(ax[0])